@@ -1,8 +1,15 @@
 from flask import Flask
 from flask_cors import CORS
 from app.config import config
+from app.utils.supabase_pool import SupabasePool
+from app.utils.job_queue import JobQueue
+from app.utils.message_writer import MessageWriter
 import os
 
+supabase_pool = SupabasePool()
+job_queue = JobQueue()
+message_writer = MessageWriter()
+
 def create_app(config_name=None):
     """Application factory pattern"""
     if config_name is None:
@@ -26,6 +33,15 @@ def create_app(config_name=None):
         CORS(app, origins=app.config['CORS_ORIGINS'])
         print(f"🌐 CORS enabled for: {app.config['CORS_ORIGINS']}")
     
+    # Shared Supabase clients (checked out per request)
+    supabase_pool.init_app(app)
+    
+    # Post-response work (knowledge extraction, summaries, index refreshes)
+    job_queue.init_app(app)
+    
+    # Chat messages are spooled and inserted in bulk off the request path
+    message_writer.init_app(app)
+    
     # Register blueprints
     from app.routes import chat, life, persona
     app.register_blueprint(chat.bp)
@@ -34,6 +50,40 @@ def create_app(config_name=None):
     
     @app.route('/health')
     def health_check():
-        return {'status': 'healthy', 'service': 'EMRYS Backend'}, 200
+        from app.services.lookup_cache import LookupCache
+        from app.services.prompt_assembler import PreambleCache
+        from app.services.model_router import ModelRouter
+        from app.services.hedging import HedgeStats
+        from app.services.gemini_clients import GeminiClientPool
+        from app.services.learned_knowledge import LearnedKnowledge
+        from app.services.turn_pipeline import TurnPipeline
+        try:
+            supabase_pool.client()
+            error = None
+        except Exception as e:
+            error = f"Supabase client unavailable: {str(e)}"
+        pool = supabase_pool.health()
+        # Busy is not broken: a saturated pool still answers 200, so health checks don't restart a loaded instance
+        status = 'unhealthy' if error else 'saturated' if pool['saturated'] else 'healthy'
+        caches = dict(
+            LookupCache.stats(),
+            prompt_preambles=PreambleCache.stats(),
+            learned_facts=LearnedKnowledge.facts.stats()
+        )
+        body = {
+            'status': status,
+            'service': 'EMRYS Backend',
+            'supabase_pool': pool,
+            'caches': caches,
+            'models': ModelRouter.stats(),
+            'hedging': HedgeStats.stats(),
+            'gemini_clients': GeminiClientPool.stats(),
+            'pipeline': TurnPipeline.stats(),
+            'jobs': job_queue.stats(),
+            'messages': message_writer.stats()
+        }
+        if error:
+            body['error'] = error
+        return body, 503 if error else 200
     
     return app
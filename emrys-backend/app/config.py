@@ -15,8 +15,99 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
     SUPABASE_URL = os.getenv('SUPABASE_URL')
     SUPABASE_KEY = os.getenv('SUPABASE_KEY')
+    SUPABASE_POOL_SIZE = int(os.getenv('SUPABASE_POOL_SIZE', 10))  # Supabase requests in flight at once (not chat requests)
+    SUPABASE_POOL_TIMEOUT = float(os.getenv('SUPABASE_POOL_TIMEOUT', 10))
+    SUPABASE_MAX_CONNECTIONS = int(os.getenv('SUPABASE_MAX_CONNECTIONS', 20))
+    SUPABASE_REQUEST_TIMEOUT = float(os.getenv('SUPABASE_REQUEST_TIMEOUT', 30))
     OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
     CORS_ORIGINS = os.getenv('CORS_ORIGINS', 'http://localhost:5173').split(',')
+    HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 20))
+    GROUP_RESPONDER_WORKERS = int(os.getenv('GROUP_RESPONDER_WORKERS', 4))  # responders of one hub message answering at once
+    GROUP_FALLBACK = os.getenv('GROUP_FALLBACK', 'first')  # who answers an un-mentioned hub message: first / relevance
+    GROUP_FALLBACK_SIZE = int(os.getenv('GROUP_FALLBACK_SIZE', 3))
+    
+    # Background jobs (post-response work)
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+    JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 256))
+    JOB_MAX_RETRIES = int(os.getenv('JOB_MAX_RETRIES', 2))
+    JOB_RETRY_BACKOFF = float(os.getenv('JOB_RETRY_BACKOFF', 2))
+    JOB_DROP_POLICY = os.getenv('JOB_DROP_POLICY', 'drop_oldest')  # drop_oldest / drop_new
+    
+    # Message persistence (write-behind: spooled locally, inserted into Supabase in bulk)
+    MESSAGE_WRITE_BEHIND = os.getenv('MESSAGE_WRITE_BEHIND', 'true').lower() == 'true'
+    MESSAGE_FLUSH_INTERVAL = float(os.getenv('MESSAGE_FLUSH_INTERVAL', 0.5))
+    MESSAGE_FLUSH_BATCH = int(os.getenv('MESSAGE_FLUSH_BATCH', 100))
+    MESSAGE_SPOOL_DIR = os.getenv('MESSAGE_SPOOL_DIR', os.path.join(os.getcwd(), '.emrys_cache', 'spool'))
+    MESSAGE_SPOOL_FSYNC = os.getenv('MESSAGE_SPOOL_FSYNC', 'true').lower() == 'true'
+    
+    # Conversation history settings
+    HISTORY_WINDOW = int(os.getenv('HISTORY_WINDOW', 15))
+    SUMMARY_MIN_TURNS = int(os.getenv('SUMMARY_MIN_TURNS', 10))
+    SUMMARY_MAX_TURNS = int(os.getenv('SUMMARY_MAX_TURNS', 40))
+    SUMMARY_MAX_WORDS = int(os.getenv('SUMMARY_MAX_WORDS', 250))
+    CONVERSATION_STATE_TTL = float(os.getenv('CONVERSATION_STATE_TTL', 5))  # hot copy of a summary; other workers' updates show up within this
+    MOOD_DECAY = float(os.getenv('MOOD_DECAY', 0.7))  # weight an earlier message keeps per new message
+    MOOD_MIN_SCORE = float(os.getenv('MOOD_MIN_SCORE', 0.5))
+    HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 50))
+    HISTORY_PAGE_MAX = int(os.getenv('HISTORY_PAGE_MAX', 200))
+    ANALYTICS_PAGE_SIZE = int(os.getenv('ANALYTICS_PAGE_SIZE', 500))
+    ANALYTICS_CONVERSATION_CHUNK = int(os.getenv('ANALYTICS_CONVERSATION_CHUNK', 100))
+    
+    # Turn pipeline stages to switch off, comma-separated (optional ones only: safety, history, mood, retrieval, learned)
+    PIPELINE_SKIP_STAGES = [s.strip() for s in os.getenv('PIPELINE_SKIP_STAGES', '').split(',') if s.strip()]
+    
+    # Prompt token budgets (estimated tokens; see services/prompt_assembler.py)
+    PROMPT_MAX_TOKENS = int(os.getenv('PROMPT_MAX_TOKENS', 3500))
+    PROMPT_BUDGET_IDENTITY = int(os.getenv('PROMPT_BUDGET_IDENTITY', 600))
+    PROMPT_BUDGET_MEMORIES = int(os.getenv('PROMPT_BUDGET_MEMORIES', 700))
+    PROMPT_BUDGET_SUMMARY = int(os.getenv('PROMPT_BUDGET_SUMMARY', 350))
+    PROMPT_BUDGET_SOCIAL = int(os.getenv('PROMPT_BUDGET_SOCIAL', 250))
+    PROMPT_BUDGET_LEARNED = int(os.getenv('PROMPT_BUDGET_LEARNED', 300))
+    PROMPT_BUDGET_HISTORY = int(os.getenv('PROMPT_BUDGET_HISTORY', 1500))
+    PROMPT_CACHE_SIZE = int(os.getenv('PROMPT_CACHE_SIZE', 256))
+    PROMPT_CACHE_TTL = float(os.getenv('PROMPT_CACHE_TTL', 3600))
+    
+    # Model routing (circuit breakers per API key + model)
+    MODEL_BREAKER_THRESHOLD = int(os.getenv('MODEL_BREAKER_THRESHOLD', 3))
+    MODEL_BREAKER_COOLDOWN = float(os.getenv('MODEL_BREAKER_COOLDOWN', 30))
+    MODEL_BREAKER_MAX_COOLDOWN = float(os.getenv('MODEL_BREAKER_MAX_COOLDOWN', 600))
+    MODEL_MISSING_COOLDOWN = float(os.getenv('MODEL_MISSING_COOLDOWN', 3600))
+    MODEL_PROBE_TIMEOUT = float(os.getenv('MODEL_PROBE_TIMEOUT', 60))
+    MODEL_LATENCY_WINDOW = int(os.getenv('MODEL_LATENCY_WINDOW', 20))
+    MODEL_ROUTER_MAX_ENTRIES = int(os.getenv('MODEL_ROUTER_MAX_ENTRIES', 2048))
+    
+    # Gemini clients (one per API key, bounded)
+    GEMINI_CLIENT_POOL_SIZE = int(os.getenv('GEMINI_CLIENT_POOL_SIZE', 64))
+    
+    # Hedged requests (race a backup model when the primary is slower than usual)
+    HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() == 'true'
+    HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 0.95))
+    HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 5))
+    HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', 8))
+    HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 1))
+    HEDGE_WORKERS = int(os.getenv('HEDGE_WORKERS', 16))
+    
+    # Lookup cache settings (persona rows, conversation records, hub memberships)
+    LOOKUP_CACHE_SIZE = int(os.getenv('LOOKUP_CACHE_SIZE', 512))
+    PERSONA_CACHE_TTL = float(os.getenv('PERSONA_CACHE_TTL', 60))
+    CONVERSATION_CACHE_TTL = float(os.getenv('CONVERSATION_CACHE_TTL', 600))
+    GROUP_CACHE_TTL = float(os.getenv('GROUP_CACHE_TTL', 300))
+    
+    # Knowledge (RAG) settings
+    KNOWLEDGE_CACHE_DIR = os.getenv('KNOWLEDGE_CACHE_DIR', os.path.join(os.getcwd(), '.emrys_cache'))
+    KNOWLEDGE_REVALIDATE_SECONDS = int(os.getenv('KNOWLEDGE_REVALIDATE_SECONDS', 300))
+    KNOWLEDGE_MAX_FILE_BYTES = int(os.getenv('KNOWLEDGE_MAX_FILE_BYTES', 25 * 1024 * 1024))
+    KNOWLEDGE_FETCH_TIMEOUT = float(os.getenv('KNOWLEDGE_FETCH_TIMEOUT', 15))
+    KNOWLEDGE_FETCH_WORKERS = int(os.getenv('KNOWLEDGE_FETCH_WORKERS', 8))
+    KNOWLEDGE_INDEX_CACHE_SIZE = int(os.getenv('KNOWLEDGE_INDEX_CACHE_SIZE', 64))
+    KNOWLEDGE_RETRIEVAL_MODE = os.getenv('KNOWLEDGE_RETRIEVAL_MODE', 'keyword')  # keyword / semantic / hybrid
+    
+    # Learned knowledge (facts about the user extracted from conversations)
+    KNOWLEDGE_EXTRACT_BATCH = int(os.getenv('KNOWLEDGE_EXTRACT_BATCH', 5))
+    KNOWLEDGE_EXTRACT_MAX_AGE = float(os.getenv('KNOWLEDGE_EXTRACT_MAX_AGE', 900))
+    KNOWLEDGE_EXTRACT_MAX_BUFFERS = int(os.getenv('KNOWLEDGE_EXTRACT_MAX_BUFFERS', 1024))
+    LEARNED_FACTS_LIMIT = int(os.getenv('LEARNED_FACTS_LIMIT', 50))
+    LEARNED_FACTS_TTL = float(os.getenv('LEARNED_FACTS_TTL', 300))
     
 class DevelopmentConfig(Config):
     """Development configuration"""
@@ -3,20 +3,102 @@ Chat routes for EMRYS
 Handles chat interactions with AI personas, including RAG and Sentiment analysis.
 """
 
-from flask import Blueprint, request, jsonify, current_app
+import base64
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
 from app.services.openrouter_service import OpenRouterService
 from app.services.gemini_service import GeminiService
 from app.services.knowledge_service import KnowledgeService
-from app.services.sentiment_service import SentimentService
-from supabase import create_client
+from app.services.lookup_cache import LookupCache
+from app.services.group_router import GroupRouter
+from app.services.conversation_memory import ConversationMemory
+from app.services.learned_knowledge import LearnedKnowledge
+from app.services.mood_state import MoodTracker
+from app.services.mood_analytics import MoodAnalytics, NUMPY_AVAILABLE, RESOLUTIONS
+from app.services.safety_service import SafetyService
+from app.services.turn_pipeline import PipelineHalt, Stage, TurnPipeline
+from app.utils.settings import bind_app_context, get_setting
+from app.utils.supabase_pool import get_supabase
+from app.utils.job_queue import enqueue
+from app.utils.message_writer import save_message, flush_messages, discard_messages, merge_pending
 
 bp = Blueprint('chat', __name__, url_prefix='/api/chat')
 
-def get_supabase():
-    return create_client(
-        current_app.config['SUPABASE_URL'],
-        current_app.config['SUPABASE_KEY']
-    )
+# Columns /history may project (clients pick a subset with ?fields=)
+HISTORY_FIELDS = ('id', 'conversation_id', 'sender_type', 'persona_id', 'content', 'created_at')
+
+def _safety_stage(ctx):
+    is_safe, safety_message = SafetyService.check(ctx['message'])
+    if not is_safe:
+        raise PipelineHalt({'response': safety_message, 'mood': None, 'retrieved': False, 'safety_blocked': True})
+
+def _persona_stage(ctx):
+    # The first stage that touches Supabase, so a blocked message never reaches the database
+    ctx['supabase'] = get_supabase()
+    ctx['persona'] = LookupCache.get_persona(ctx['supabase'], ctx['persona_id'])
+    if not ctx['persona']:
+        raise PipelineHalt({'error': 'Target persona consciousness not found in the Nexus'}, 404)
+
+def _conversation_stage(ctx):
+    ctx['conversation'] = LookupCache.get_conversation(ctx['supabase'], ctx['user_id'], persona_id=ctx['persona_id'])
+    if not ctx['conversation']:
+        raise PipelineHalt({'error': 'Failed to initialize neural link conversation'}, 500)
+
+def _history_stage(ctx):
+    # Bounded tail window + rolling summary of older turns
+    ctx['history'] = ConversationMemory.load_window(ctx['supabase'], ctx['conversation']['id'])
+    ctx['conversation_summary'] = ConversationMemory.get_summary(ctx['supabase'], ctx['conversation']['id'])
+
+def _mood_stage(ctx):
+    ctx['current_mood'] = MoodTracker.observe(ctx['conversation']['id'], ctx['message'], history=ctx['history'])
+
+def _retrieval_stage(ctx):
+    ctx['relevant_memories'] = KnowledgeService.get_relevant_context(ctx['persona'], ctx['message'])
+
+def _learned_stage(ctx):
+    try:
+        ctx['learned_knowledge'] = LearnedKnowledge.get_facts(ctx['supabase'], ctx['persona_id'], ctx['user_id'])
+    except Exception as e:
+        print(f"Learned knowledge load error: {str(e)}")
+        ctx['learned_knowledge'] = []
+
+def _save_user_stage(ctx):
+    save_message({
+        'conversation_id': ctx['conversation']['id'],
+        'sender_type': 'user',
+        'content': ctx['message']
+    })
+
+SAFETY_STAGE = Stage('safety', _safety_stage)
+
+# Everything before the model call of a 1:1 turn (PIPELINE_SKIP_STAGES can switch off the optional ones)
+DIRECT_TURN = TurnPipeline('direct', [
+    SAFETY_STAGE,
+    Stage('persona', _persona_stage, optional=False),
+    Stage('conversation', _conversation_stage, optional=False),
+    Stage('history', _history_stage, defaults={'history': [], 'conversation_summary': ''}),
+    Stage('mood', _mood_stage, defaults={'current_mood': None}),
+    Stage('retrieval', _retrieval_stage, defaults={'relevant_memories': None}),
+    Stage('learned', _learned_stage, defaults={'learned_knowledge': []}),
+    Stage('save_user', _save_user_stage, optional=False)
+])
+
+# Group turns are gated before the group and its members are loaded
+GROUP_GATE = TurnPipeline('group', [SAFETY_STAGE])
+
+def _prepare_direct_turn(user_id, persona_id, message):
+    """
+    Shared setup for a 1:1 turn: safety gate, persona, conversation, history, mood and RAG,
+    then the user message is saved. Returns (turn, halt_response).
+    """
+    try:
+        turn = DIRECT_TURN.run({'user_id': user_id, 'persona_id': persona_id, 'message': message})
+    except PipelineHalt as halt:
+        return None, (jsonify(halt.body), halt.status)
+    return turn, None
 
 @bp.route('/send', methods=['POST'])
 def send_message():
@@ -30,39 +112,10 @@ def send_message():
         if not all([user_id, persona_id, message, api_key]):
             return jsonify({'error': 'Missing fields for neural synchronization'}), 400
         
-        supabase = get_supabase()
-        
-        # 1. Fetch Persona
-        persona_res = supabase.table('personas').select('*').eq('id', persona_id).single().execute()
-        persona = persona_res.data
-        if not persona:
-            return jsonify({'error': 'Target persona consciousness not found in the Nexus'}), 404
-        
-        # 2. Get/Create Conversation
-        conv_res = supabase.table('conversations').select('*').eq('user_id', user_id).eq('persona_id', persona_id).execute()
-        
-        if conv_res.data:
-            conversation = conv_res.data[0]
-        else:
-            insert_res = supabase.table('conversations').insert({'user_id': user_id, 'persona_id': persona_id}).execute()
-            if not insert_res.data:
-                return jsonify({'error': 'Failed to initialize neural link conversation'}), 500
-            conversation = insert_res.data[0]
-        
-        # 3. Get History
-        history_res = supabase.table('messages').select('*').eq('conversation_id', conversation['id']).order('created_at').execute()
-        history = history_res.data or []
-        
-        # 4. NEURAL PROCESSING (Sentiment & RAG)
-        current_mood = SentimentService.analyze_mood(history, message)
-        relevant_memories = KnowledgeService.get_relevant_context(persona, message)
-        
-        # 5. Save User Message
-        supabase.table('messages').insert({
-            'conversation_id': conversation['id'],
-            'sender_type': 'user',
-            'content': message
-        }).execute()
+        turn, error_response = _prepare_direct_turn(user_id, persona_id, message)
+        if error_response:
+            return error_response
+        persona, conversation = turn['persona'], turn['conversation']
         
         # 6. Request AI Response
         
@@ -71,20 +124,24 @@ def send_message():
             ai_service = GeminiService(api_key=api_key)
             ai_result = ai_service.chat(
                 persona=persona,
-                messages=history,
+                messages=turn['history'],
                 user_message=message,
-                relevant_memories=relevant_memories,
-                current_mood=current_mood
+                relevant_memories=turn['relevant_memories'],
+                current_mood=turn['current_mood'],
+                conversation_summary=turn['conversation_summary'],
+                learned_knowledge=turn['learned_knowledge']
             )
         else:
             openrouter = OpenRouterService(api_key=api_key)
             ai_result = openrouter.chat(
                 persona=persona,
-                messages=history,
+                messages=turn['history'],
                 user_message=message,
                 model='fast',
-                relevant_memories=relevant_memories,
-                current_mood=current_mood
+                relevant_memories=turn['relevant_memories'],
+                current_mood=turn['current_mood'],
+                conversation_summary=turn['conversation_summary'],
+                learned_knowledge=turn['learned_knowledge']
             )
         
         if not ai_result['success']:
@@ -93,24 +150,24 @@ def send_message():
         ai_response = ai_result['response']
         
         # 7. Save AI Response (Include persona_id)
-        supabase.table('messages').insert({
+        save_message({
             'conversation_id': conversation['id'],
             'sender_type': 'persona',
             'persona_id': persona_id,
             'content': ai_response
-        }).execute()
+        })
+        MoodTracker.observe(conversation['id'], ai_response)
         
-        # 8. Background Knowledge Extraction (Silent)
-        try:
-            if not api_key.startswith('AIzaSy'):
-                openrouter = OpenRouterService(api_key=api_key)
-                openrouter.extract_knowledge(message, ai_response, persona['name'])
-        except: pass
+        # 8. Post-response work runs in the background: summary folding + knowledge extraction
+        _queue_summary_update(conversation['id'], turn['history'], api_key, persona['name'])
+        _queue_knowledge_extraction(conversation['id'], user_id, persona, message, ai_response, api_key)
         
         return jsonify({
             'response': ai_response,
             'mood': ai_result.get('mood'),
-            'retrieved': ai_result.get('retrieved')
+            'retrieved': ai_result.get('retrieved'),
+            'prompt_tokens': ai_result.get('prompt_tokens'),
+            'timings': turn['timings']
         }), 200
         
     except Exception as e:
@@ -118,6 +175,180 @@ def send_message():
         traceback.print_exc() 
         return jsonify({'error': f"Neural Link Error: {str(e)}"}), 500
 
+def _completer(api_key):
+    if api_key.startswith('AIzaSy'):
+        return GeminiService(api_key=api_key).complete
+    return OpenRouterService(api_key=api_key).complete
+
+def _update_summary(conversation_id, history, api_key, persona_name):
+    ConversationMemory.update_summary(get_supabase(), conversation_id, history, _completer(api_key), persona_name)
+
+def _queue_summary_update(conversation_id, history, api_key, persona_name):
+    """Fold turns that left the history window into the rolling summary, off the request path"""
+    enqueue(
+        'summary_update', _update_summary, conversation_id, history, api_key, persona_name,
+        dedupe_key=f"summary:{conversation_id}"
+    )
+
+def _extract_knowledge(api_key, batch):
+    facts = LearnedKnowledge.extract_facts(_completer(api_key), batch['turns'], batch['persona_name'])
+    if facts is None:
+        # Raising lets the job queue retry the whole batch with backoff
+        raise RuntimeError(f"Knowledge extraction failed for {len(batch['turns'])} turns")
+    LearnedKnowledge.save_facts(get_supabase(), batch['persona_id'], batch['user_id'], facts)
+
+def _queue_knowledge_extraction(conversation_id, user_id, persona, message, ai_response, api_key):
+    """Buffer the exchange; one extraction call covers every KNOWLEDGE_EXTRACT_BATCH turns"""
+    batch = LearnedKnowledge.record_turn(conversation_id, user_id, persona, message, ai_response)
+    if batch:
+        enqueue('extract_knowledge', _extract_knowledge, api_key, batch)
+
+def _sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@bp.route('/send/stream', methods=['POST'])
+def send_message_stream():
+    """
+    Streaming variant of /send. Emits Server-Sent Events:
+    `meta` (mood, retrieved) first, one `token` per text delta, then `done` with the
+    full response once it has been saved, or `error` if generation fails.
+    A safety-blocked message gets `meta` and a `done` flagged safety_blocked, and nothing is saved.
+    """
+    try:
+        data = request.json
+        user_id = data.get('user_id')
+        persona_id = data.get('persona_id')
+        message = data.get('message')
+        api_key = data.get('api_key')
+        
+        if not all([user_id, persona_id, message, api_key]):
+            return jsonify({'error': 'Missing fields for neural synchronization'}), 400
+        
+        try:
+            turn = DIRECT_TURN.run({'user_id': user_id, 'persona_id': persona_id, 'message': message})
+        except PipelineHalt as halt:
+            if halt.status != 200:
+                return jsonify(halt.body), halt.status
+            # A blocked message still answers as a (one-shot) stream, so clients render it like any reply
+            return Response(
+                _sse('meta', {'mood': 'default', 'retrieved': False}) + _sse('done', halt.body),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+        persona, conversation = turn['persona'], turn['conversation']
+        
+        ai_service = GeminiService(api_key=api_key) if api_key.startswith('AIzaSy') else OpenRouterService(api_key=api_key)
+        if api_key.startswith('AIzaSy'):
+            tokens = ai_service.stream_chat(
+                persona=persona,
+                messages=turn['history'],
+                user_message=message,
+                relevant_memories=turn['relevant_memories'],
+                current_mood=turn['current_mood'],
+                conversation_summary=turn['conversation_summary'],
+                learned_knowledge=turn['learned_knowledge']
+            )
+        else:
+            tokens = ai_service.stream_chat(
+                persona=persona,
+                messages=turn['history'],
+                user_message=message,
+                model='fast',
+                relevant_memories=turn['relevant_memories'],
+                current_mood=turn['current_mood'],
+                conversation_summary=turn['conversation_summary'],
+                learned_knowledge=turn['learned_knowledge']
+            )
+        
+        mood = turn['current_mood']['code'] if turn['current_mood'] else 'default'
+        retrieved = bool(turn['relevant_memories'])
+        
+        def generate():
+            yield _sse('meta', {'mood': mood, 'retrieved': retrieved})
+            
+            parts = []
+            try:
+                for token in tokens:
+                    parts.append(token)
+                    yield _sse('token', {'text': token})
+            except Exception as e:
+                print(f"Stream error for persona {persona_id}: {str(e)}")
+                yield _sse('error', {'error': str(e), 'partial': "".join(parts)})
+                return
+            
+            ai_response = "".join(parts)
+            
+            # Persist the assembled reply once the stream is complete
+            save_message({
+                'conversation_id': conversation['id'],
+                'sender_type': 'persona',
+                'persona_id': persona_id,
+                'content': ai_response
+            })
+            MoodTracker.observe(conversation['id'], ai_response)
+            
+            yield _sse('done', {
+                'response': ai_response,
+                'mood': mood,
+                'retrieved': retrieved,
+                'prompt_tokens': ai_service.last_prompt_report,
+                'timings': turn['timings']
+            })
+            
+            _queue_summary_update(conversation['id'], turn['history'], api_key, persona['name'])
+            _queue_knowledge_extraction(conversation['id'], user_id, persona, message, ai_response, api_key)
+        
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        
+    except Exception as e:
+        import traceback
+        traceback.print_exc() 
+        return jsonify({'error': f"Neural Link Error: {str(e)}"}), 500
+
+def _responder_pool(responders):
+    """
+    A pool for one hub message, so concurrent hubs don't queue behind each other's LLM calls.
+    At most GROUP_RESPONDER_WORKERS of this message's responders run at once.
+    """
+    return ThreadPoolExecutor(
+        max_workers=max(1, min(len(responders), get_setting('GROUP_RESPONDER_WORKERS', 4))),
+        thread_name_prefix='hub-responder'
+    )
+
+def _prepare_responder(p, message, group, personas):
+    """Per-persona work that does not depend on other responders' replies"""
+    other_names = [o['name'] for o in personas if o.get('id') != p.get('id')]
+    return {
+        'memories': KnowledgeService.get_relevant_context(p, message),
+        'group_ctx': f"You are in a group chat called '{group['name']}'. Other members present: {', '.join(other_names)}."
+    }
+
+def _generate_responder_reply(ai_engine, is_gemini, p, history, message, prepared, mood, conversation_summary=None):
+    if is_gemini:
+        return ai_engine.chat(
+            persona=p,
+            messages=history,
+            user_message=message,
+            additional_context=prepared['group_ctx'],
+            relevant_memories=prepared['memories'],
+            current_mood=mood,
+            conversation_summary=conversation_summary
+        )
+    return ai_engine.chat(
+        persona=p,
+        messages=history,
+        user_message=message,
+        model='fast',
+        additional_context=prepared['group_ctx'],
+        relevant_memories=prepared['memories'],
+        current_mood=mood,
+        conversation_summary=conversation_summary
+    )
+
 @bp.route('/group/send', methods=['POST'])
 def group_send_message():
     try:
@@ -126,64 +357,60 @@ def group_send_message():
         group_id = data.get('group_id')
         message = data.get('message')
         api_key = data.get('api_key')
+        # 'parallel' (default): responders answer concurrently from the same history.
+        # 'sequential': each responder sees the replies of the ones before it.
+        mode = data.get('mode', 'parallel')
+        
+        if not all([user_id, group_id, message, api_key]):
+            return jsonify({'error': 'Missing fields for neural synchronization'}), 400
+        
+        try:
+            GROUP_GATE.run({'message': message})
+        except PipelineHalt as halt:
+            # Hub clients render `error` as a notice; safety_blocked says it isn't a failure
+            return jsonify({
+                'error': halt.body.get('response') or halt.body.get('error'),
+                'safety_blocked': halt.body.get('safety_blocked', False),
+                'responses': []
+            }), halt.status
         
         supabase = get_supabase()
         
-        # 1. Get Group & Members with specific join syntax
-        group_res = supabase.table('groups').select('*, group_members(persona_id, personas(*))').eq('id', group_id).single().execute()
-        group = group_res.data
+        # 1. Get Group & Members (cached with the membership)
+        group = LookupCache.get_group(supabase, group_id)
         if not group:
             return jsonify({'error': 'Group not found or inaccessible'}), 404
-            
-        group_members = group.get('group_members', [])
-        personas = []
-        for m in group_members:
-            if isinstance(m, dict) and m.get('personas'):
-                # Ensure the persona object has the id from the member record if missing
-                p = m['personas']
-                if not p.get('id'): p['id'] = m.get('persona_id')
-                personas.append(p)
+        personas = group['personas']
         
         if not personas:
             return jsonify({'error': 'This Hub has no active neural patterns linked.'}), 400
 
-        # 2. Conversation Check
-        conv_res = supabase.table('conversations').select('*').eq('user_id', user_id).eq('group_id', group_id).execute()
-        if not conv_res.data:
-            conversation = supabase.table('conversations').insert({'user_id': user_id, 'group_id': group_id}).execute().data[0]
-        else:
-            conversation = conv_res.data[0]
+        # 2. Conversation Check (cached)
+        conversation = LookupCache.get_conversation(supabase, user_id, group_id=group_id)
+        if not conversation:
+            return jsonify({'error': 'Failed to initialize hub conversation'}), 500
         
-        # 3. Save User Message
-        supabase.table('messages').insert({
+        # 3. Decider Logic: Who should respond? (@mentions, else the configured fallback)
+        responders = GroupRouter.for_group(group_id, personas).route(message)
+        if not responders:
+            return jsonify({'error': 'No one in this Hub can answer that message.'}), 400
+        
+        # 4. Save User Message
+        save_message({
             'conversation_id': conversation['id'], 
             'sender_type': 'user', 
             'content': message
-        }).execute()
-        
-        # 4. Decider Logic: Who should respond?
-        responders = []
-        clean_msg = message.lower().replace(' ', '')
+        })
         
-        for p in personas:
-            name = p.get('name', '').lower()
-            if not name: continue
-            
-            clean_name = name.replace(' ', '')
-            first_name = name.split()[0] if name.split() else ""
-            
-            # Match @FullName or @FirstName
-            if f"@{clean_name}" in clean_msg or (first_name and len(first_name) > 2 and f"@{first_name}" in clean_msg):
-                if p not in responders:
-                    responders.append(p)
+        # 5. Get Combined History (bounded tail window + rolling summary of older turns)
+        raw_history = ConversationMemory.load_window(supabase, conversation['id'], select='*, personas(name)')
+        conversation_summary = ConversationMemory.get_summary(supabase, conversation['id'])
         
-        # Fallback to collective response if no one is mentioned
-        if not responders: 
-            responders = personas[:3] # Limit to 3 for faster initial response
-        
-        # 5. Get Combined History
-        history_res = supabase.table('messages').select('*, personas(name)').eq('conversation_id', conversation['id']).order('created_at', desc=True).limit(20).execute()
-        raw_history = history_res.data[::-1] if history_res.data else []
+        # Fold the user's message into the hub's mood (seeding from the turns before it on first use)
+        earlier = raw_history
+        if raw_history and raw_history[-1].get('sender_type') == 'user' and raw_history[-1].get('content') == message:
+            earlier = raw_history[:-1]
+        MoodTracker.observe(conversation['id'], message, history=earlier)
         
         # Flatten persona name for services
         history = []
@@ -198,64 +425,77 @@ def group_send_message():
         ai_engine = GeminiService(api_key=api_key) if is_gemini else OpenRouterService(api_key=api_key)
         final_responses = []
         
-        for p in responders:
-            try:
-                mood = SentimentService.analyze_mood(history, message)
-                memories = KnowledgeService.get_relevant_context(p, message)
-                
-                other_names = [o['name'] for o in personas if o.get('id') != p.get('id')]
-                group_ctx = f"You are in a group chat called '{group['name']}'. Other members present: {', '.join(other_names)}."
-                
-                if is_gemini:
-                    ai_res = ai_engine.chat(
-                        persona=p,
-                        messages=history,
-                        user_message=message,
-                        additional_context=group_ctx,
-                        relevant_memories=memories,
-                        current_mood=mood
-                    )
-                else:
-                    ai_res = ai_engine.chat(
-                        persona=p,
-                        messages=history,
-                        user_message=message,
-                        model='fast',
-                        additional_context=group_ctx,
-                        relevant_memories=memories,
-                        current_mood=mood # Fixed: was current_mood (undefined)
+        def save_reply(p, ai_res):
+            resp_content = ai_res['response']
+            
+            # Save to DB
+            msg_obj = {
+                'conversation_id': conversation['id'], 
+                'sender_type': 'persona', 
+                'content': resp_content
+            }
+            if p.get('id'): msg_obj['persona_id'] = p['id']
+            
+            save_message(msg_obj)
+            MoodTracker.observe(conversation['id'], resp_content, persona_id=p.get('id'))
+            
+            final_responses.append({
+                'persona_id': p.get('id'),
+                'persona_name': p.get('name'),
+                'response': resp_content,
+                'mood': ai_res.get('mood')
+            })
+        
+        prepare = bind_app_context(_prepare_responder)
+        with _responder_pool(responders) as pool:
+            if mode == 'sequential':
+                # Later personas see earlier replies. RAG for persona N+1 runs while persona N's LLM call is in flight.
+                next_prepared = pool.submit(prepare, responders[0], message, group, personas)
+                for i, p in enumerate(responders):
+                    current_prepared = next_prepared
+                    if i + 1 < len(responders):
+                        next_prepared = pool.submit(prepare, responders[i + 1], message, group, personas)
+                    try:
+                        prepared = current_prepared.result()
+                        # Read after the previous responder's reply was folded in
+                        mood = MoodTracker.current(conversation['id'], persona_id=p.get('id'))
+                        ai_res = _generate_responder_reply(ai_engine, is_gemini, p, history, message, prepared, mood, conversation_summary)
+                        if ai_res['success']:
+                            save_reply(p, ai_res)
+                        
+                            # Update internal history for next persona in loop
+                            history.append({
+                                'sender_type': 'persona', 
+                                'persona_id': p.get('id'),
+                                'persona_name': p.get('name'),
+                                'content': ai_res['response']
+                            })
+                    except Exception as loop_e:
+                        print(f"Error in responder loop for {p.get('name')}: {str(loop_e)}")
+                        continue
+            else:
+                # Every responder answers the same history snapshot concurrently; replies are committed in responder order
+                snapshot = list(history)
+                moods = [MoodTracker.current(conversation['id'], persona_id=p.get('id')) for p in responders]
+            
+                def respond(p, mood):
+                    return _generate_responder_reply(
+                        ai_engine, is_gemini, p, snapshot, message, _prepare_responder(p, message, group, personas), mood, conversation_summary
                     )
-                
-                if ai_res['success']:
-                    resp_content = ai_res['response']
-                    
-                    # Save to DB
-                    msg_obj = {
-                        'conversation_id': conversation['id'], 
-                        'sender_type': 'persona', 
-                        'content': resp_content
-                    }
-                    if p.get('id'): msg_obj['persona_id'] = p['id']
-                    
-                    supabase.table('messages').insert(msg_obj).execute()
-                    
-                    final_responses.append({
-                        'persona_id': p.get('id'),
-                        'persona_name': p.get('name'),
-                        'response': resp_content,
-                        'mood': ai_res.get('mood')
-                    })
-                    
-                    # Update internal history for next persona in loop
-                    history.append({
-                        'sender_type': 'persona', 
-                        'persona_id': p.get('id'),
-                        'persona_name': p.get('name'),
-                        'content': resp_content
-                    })
-            except Exception as loop_e:
-                print(f"Error in responder loop for {p.get('name')}: {str(loop_e)}")
-                continue
+            
+                respond = bind_app_context(respond)
+                futures = [pool.submit(respond, p, mood) for p, mood in zip(responders, moods)]
+            
+                for p, future in zip(responders, futures):
+                    try:
+                        ai_res = future.result()
+                        if ai_res['success']:
+                            save_reply(p, ai_res)
+                    except Exception as loop_e:
+                        print(f"Error in responder loop for {p.get('name')}: {str(loop_e)}")
+                        continue
+        
+        _queue_summary_update(conversation['id'], raw_history, api_key, group.get('name') or 'the hub')
         
         if not final_responses:
             return jsonify({'error': 'The collective is currently unresponsive. Neural link saturated.'}), 503
@@ -264,10 +504,130 @@ def group_send_message():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@bp.route('/group/<group_id>/invalidate', methods=['POST'])
+def invalidate_group(group_id):
+    """Drop the cached hub and its mention index after the group or its members changed"""
+    LookupCache.invalidate_group(group_id)
+    GroupRouter.invalidate(group_id)
+    return jsonify({'invalidated': group_id}), 200
+
+def _encode_cursor(row):
+    raw = json.dumps([row.get('created_at'), row.get('id')], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode_cursor(value):
+    """(created_at, id) from a history cursor; raises ValueError if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode((value + '=' * (-len(value) % 4)).encode('ascii'))
+        created_at, message_id = json.loads(raw)
+    except (TypeError, UnicodeError, ValueError):
+        raise ValueError('Invalid history cursor')
+    if not isinstance(created_at, str) or message_id is None:
+        raise ValueError('Invalid history cursor')
+    return created_at, message_id
+
 @bp.route('/history/<conversation_id>', methods=['GET'])
 def get_history(conversation_id):
+    """
+    One page of a conversation, oldest first. Query params:
+    `limit` (HISTORY_PAGE_SIZE by default, at most HISTORY_PAGE_MAX), `before` / `after` (cursors
+    from an earlier page: older messages / newer messages; neither = the newest page) and
+    `fields` (comma-separated subset of HISTORY_FIELDS; id and created_at are always included).
+    Pages carry a weak ETag, and If-None-Match is answered with 304 when the page is unchanged.
+    The newest page includes messages still waiting in any worker's write-behind spool; reading
+    the messages table directly shows them only once they have been flushed.
+    """
+    try:
+        args = request.args
+        limit = args.get('limit', get_setting('HISTORY_PAGE_SIZE', 50), type=int)
+        limit = min(max(limit, 1), get_setting('HISTORY_PAGE_MAX', 200))
+        
+        requested = [f.strip() for f in args.get('fields', '').split(',') if f.strip()]
+        unknown = [f for f in requested if f not in HISTORY_FIELDS]
+        if unknown:
+            return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+        columns = list(dict.fromkeys(['id', 'created_at'] + (requested or list(HISTORY_FIELDS))))
+        
+        if args.get('before') and args.get('after'):
+            return jsonify({'error': 'Use either before or after, not both'}), 400
+        try:
+            before = _decode_cursor(args['before']) if args.get('before') else None
+            after = _decode_cursor(args['after']) if args.get('after') else None
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        supabase = get_supabase()
+        unflushed = flush_messages(conversation_id, supabase)
+        rows, has_more = ConversationMemory.load_page(
+            supabase, conversation_id, limit, columns=','.join(columns), before=before, after=after
+        )
+        unflushed = merge_pending(rows, unflushed)
+        
+        # Messages are never edited, so the page's keys identify its contents
+        etag = hashlib.sha1(json.dumps(
+            [columns, limit, args.get('before'), args.get('after'), has_more,
+             [(r.get('id'), r.get('created_at')) for r in rows], len(unflushed)],
+            default=str
+        ).encode('utf-8')).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        
+        meta = {
+            'has_more': has_more,
+            # Older messages: none left when the newest/older page came back short
+            'before': _encode_cursor(rows[0]) if rows and (after or has_more) else None,
+            # Newer messages: poll from the newest row seen (or where the caller already was)
+            'after': _encode_cursor(rows[-1]) if rows else args.get('after')
+        }
+        if unflushed and not before and (not after or not has_more):
+            # Rows the database couldn't take yet are still the newest part of the conversation,
+            # so they belong on the newest page (where has_more only means older rows exist)
+            rows = rows + [{k: m.get(k) for k in columns} for m in unflushed]
+        
+        def body():
+            # Streamed row by row instead of building one large JSON string
+            yield '{"messages":['
+            for i, row in enumerate(rows):
+                yield (',' if i else '') + json.dumps(row, default=str)
+            yield '],' + json.dumps(meta)[1:]
+        
+        response = Response(body(), mimetype='application/json')
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    except Exception as e:
+        print(f"History error for conversation {conversation_id}: {str(e)}")
+        return jsonify({'error': 'Error'}), 500
+
+@bp.route('/history/<conversation_id>/invalidate', methods=['POST'])
+def invalidate_history(conversation_id):
+    """Drop state derived from a conversation after its messages were wiped (Neural Wipe)"""
+    discard_messages(conversation_id)
     try:
         supabase = get_supabase()
-        msgs = supabase.table('messages').select('*').eq('conversation_id', conversation_id).order('created_at').execute().data
-        return jsonify({'messages': msgs or []}), 200
-    except: return jsonify({'error': 'Error'}), 500
+        ConversationMemory.forget(supabase, conversation_id)
+        MoodTracker.forget(conversation_id, supabase)
+    except Exception as e:
+        print(f"Invalidate error for conversation {conversation_id}: {str(e)}")
+        return jsonify({'error': 'Error'}), 500
+    return jsonify({'invalidated': conversation_id}), 200
+
+@bp.route('/mood-timeline/<conversation_id>', methods=['GET'])
+def get_mood_timeline(conversation_id):
+    """Neural Pulse of one conversation over time. ?resolution=message|hour|day|month (default message)"""
+    if not NUMPY_AVAILABLE:
+        return jsonify({'error': 'Mood analytics needs NumPy installed'}), 503
+    resolution = request.args.get('resolution', 'message')
+    if resolution not in RESOLUTIONS:
+        return jsonify({'error': f"resolution must be one of: {', '.join(RESOLUTIONS)}"}), 400
+    try:
+        supabase = get_supabase()
+        flush_messages(conversation_id, supabase)
+        pages = ConversationMemory.iter_pages(supabase, [conversation_id])
+        return jsonify(dict(MoodAnalytics.timeline(pages, resolution), conversation_id=conversation_id)), 200
+    except Exception as e:
+        print(f"Mood timeline error for conversation {conversation_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
@@ -1,6 +1,14 @@
 from flask import Blueprint, request, jsonify, current_app
 from app.services.openrouter_service import OpenRouterService
 from app.services.gemini_service import GeminiService
+from app.services.lookup_cache import LookupCache
+from app.services.knowledge_service import KnowledgeService
+from app.services.conversation_memory import ConversationMemory
+from app.services.mood_analytics import MoodAnalytics, NUMPY_AVAILABLE, RESOLUTIONS
+from app.utils.supabase_pool import get_supabase
+from app.utils.job_queue import enqueue
+from app.utils.message_writer import flush_messages
+from app.utils.settings import get_setting
 import json
 import re
 
@@ -98,3 +106,43 @@ def synthesize_persona():
     except Exception as e:
         print(f"Synthesis Error: {str(e)}")
         return jsonify({'error': str(e)}), 500
+
+@bp.route('/<persona_id>/invalidate', methods=['POST'])
+def invalidate_persona(persona_id):
+    """Drop cached copies of a persona after it has been edited or deleted"""
+    LookupCache.invalidate_persona(persona_id)
+    # Re-ingest the persona's knowledge now rather than on the next chat turn
+    enqueue('index_refresh', _refresh_index, persona_id, dedupe_key=f"index:{persona_id}")
+    return jsonify({'invalidated': persona_id}), 200
+
+def _refresh_index(persona_id):
+    persona = LookupCache.get_persona(get_supabase(), persona_id)
+    if persona:
+        KnowledgeService.get_index(persona)
+
+@bp.route('/<persona_id>/mood-timeline', methods=['GET'])
+def get_mood_timeline(persona_id):
+    """Neural Pulse across all of a persona's conversations. ?resolution=hour|day|month (default day)"""
+    if not NUMPY_AVAILABLE:
+        return jsonify({'error': 'Mood analytics needs NumPy installed'}), 503
+    resolution = request.args.get('resolution', 'day')
+    if resolution not in RESOLUTIONS or resolution == 'message':
+        return jsonify({'error': 'resolution must be one of: hour, day, month'}), 400
+    try:
+        supabase = get_supabase()
+        flush_messages(None, supabase)
+        conversation_ids = [
+            c['id'] for c in supabase.table('conversations').select('id').eq('persona_id', persona_id).execute().data or []
+        ]
+        chunk = get_setting('ANALYTICS_CONVERSATION_CHUNK', 100)
+        
+        def pages():
+            # Bounded id lists per query; every conversation's messages stay in one chunk, in order
+            for start in range(0, len(conversation_ids), chunk):
+                yield from ConversationMemory.iter_pages(supabase, conversation_ids[start:start + chunk])
+        
+        timeline = MoodAnalytics.timeline(pages(), resolution)
+        return jsonify(dict(timeline, persona_id=persona_id, conversations=len(conversation_ids))), 200
+    except Exception as e:
+        print(f"Mood timeline error for persona {persona_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
@@ -0,0 +1,201 @@
+"""
+Conversation Memory for EMRYS
+Bounded history windows plus a rolling summary of the turns that have scrolled out of
+the window, so per-turn DB transfer and prompt size stay constant. The summary is stored
+on the conversation row, so every worker and host sees (and extends) the same one.
+"""
+
+import threading
+
+from app.config import Config
+from app.utils.cache import TTLCache
+from app.utils.message_writer import flush_messages, merge_pending
+from app.utils.settings import get_setting
+
+
+def _keyset(query, position, op):
+    """Rows strictly after ('gt') or before ('lt') a (created_at, id) position"""
+    created_at, message_id = position
+    return query.or_(
+        f'created_at.{op}."{created_at}",and(created_at.eq."{created_at}",id.{op}."{message_id}")'
+    )
+
+
+class ConversationMemory:
+    _lock = threading.Lock()
+    _summaries = TTLCache(maxsize=Config.LOOKUP_CACHE_SIZE, ttl=Config.CONVERSATION_STATE_TTL)  # short-lived hot copies of the rows
+    _updating = set()  # conversation ids with a summary update in progress
+
+    @staticmethod
+    def load_window(supabase, conversation_id, select='*', window=None):
+        """The newest `window` messages of a conversation, oldest first (including ones not yet flushed)"""
+        window = window or get_setting('HISTORY_WINDOW', 15)
+        unflushed = flush_messages(conversation_id, supabase)
+        res = supabase.table('messages').select(select).eq('conversation_id', conversation_id) \
+            .order('created_at', desc=True).limit(window).execute()
+        history = (res.data or [])[::-1]
+        unflushed = merge_pending(history, unflushed)
+        if unflushed:
+            history = sorted(history + unflushed, key=lambda m: m.get('created_at') or '')[-window:]
+        return history
+
+    @staticmethod
+    def load_page(supabase, conversation_id, limit, columns='*', before=None, after=None):
+        """
+        One keyset page of a conversation ordered by (created_at, id), oldest first.
+        `before`/`after` are (created_at, id) positions; with neither, the newest page.
+        Returns (rows, has_more) where has_more means more rows exist in the paging direction.
+        """
+        query = supabase.table('messages').select(columns).eq('conversation_id', conversation_id)
+        position = after or before
+        if position:
+            query = _keyset(query, position, 'gt' if after else 'lt')
+        descending = not after
+        rows = query.order('created_at', desc=descending).order('id', desc=descending) \
+            .limit(limit + 1).execute().data or []
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return (rows[::-1] if descending else rows), has_more
+
+    @staticmethod
+    def iter_pages(supabase, conversation_ids, columns='id, conversation_id, created_at, content', page_size=None):
+        """
+        Every message of the given conversations in (created_at, id) order, one keyset page
+        (a list of rows) at a time, so callers never hold more than a page in memory.
+        """
+        page_size = page_size or get_setting('ANALYTICS_PAGE_SIZE', 500)
+        conversation_ids = [str(c) for c in conversation_ids]
+        position = None
+        while True:
+            query = supabase.table('messages').select(columns).in_('conversation_id', conversation_ids)
+            if position:
+                query = _keyset(query, position, 'gt')
+            rows = query.order('created_at').order('id').limit(page_size).execute().data or []
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            position = (rows[-1]['created_at'], rows[-1]['id'])
+
+    @classmethod
+    def _load(cls, supabase, conversation_id):
+        key = str(conversation_id)
+        record = cls._summaries.get(key)
+        if record is not None:
+            return record
+        rows = supabase.table('conversations').select('summary, summary_covered_until, summary_turns') \
+            .eq('id', conversation_id).limit(1).execute().data or []
+        row = rows[0] if rows else {}
+        record = {
+            'summary': row.get('summary') or '',
+            'covered_until': row.get('summary_covered_until'),
+            'turns': row.get('summary_turns') or 0
+        }
+        cls._summaries.set(key, record)
+        return record
+
+    @classmethod
+    def _save(cls, supabase, conversation_id, previous, record):
+        """
+        Write the record only if nobody else has folded turns since `previous` was read
+        (summary_turns only grows, so it doubles as the row's version). Returns True if written.
+        """
+        key = str(conversation_id)
+        res = supabase.table('conversations').update({
+            'summary': record['summary'],
+            'summary_covered_until': record['covered_until'],
+            'summary_turns': record['turns']
+        }).eq('id', conversation_id).eq('summary_turns', previous['turns']).execute()
+        if not res.data:
+            # Another worker got there first; re-read theirs next time
+            cls._summaries.invalidate(key)
+            return False
+        cls._summaries.set(key, record)
+        return True
+
+    @classmethod
+    def get_summary(cls, supabase, conversation_id):
+        """Rolling summary of everything older than the history window ('' if none yet)"""
+        try:
+            return cls._load(supabase, conversation_id)['summary']
+        except Exception as e:
+            print(f"Summary load error for conversation {conversation_id}: {str(e)}")
+            return ''
+
+    @classmethod
+    def forget(cls, supabase, conversation_id):
+        """Drop the summary, e.g. after the conversation's messages were wiped"""
+        cls._summaries.invalidate(str(conversation_id))
+        supabase.table('conversations').update({
+            'summary': None, 'summary_covered_until': None, 'summary_turns': 0
+        }).eq('id', conversation_id).execute()
+
+    @staticmethod
+    def _speaker(msg, persona_name):
+        if msg.get('sender_type') == 'user':
+            return 'User'
+        return msg.get('persona_name') or (msg.get('personas') or {}).get('name') or persona_name
+
+    @classmethod
+    def build_summary_prompt(cls, previous_summary, turns, persona_name):
+        transcript = "\n".join(f"{cls._speaker(m, persona_name)}: {m.get('content', '')}" for m in turns)
+        max_words = get_setting('SUMMARY_MAX_WORDS', 250)
+        return (
+            f"You maintain the long-term memory of a conversation between a user and {persona_name}.\n"
+            f"CURRENT SUMMARY:\n{previous_summary or '(empty)'}\n\n"
+            f"OLDER TURNS TO FOLD IN:\n{transcript}\n\n"
+            f"Rewrite the summary so it also covers these turns. Keep names, facts, promises, "
+            f"feelings and open threads; drop small talk. Write in third person, at most {max_words} words. "
+            f"Return only the summary text."
+        )
+
+    @classmethod
+    def update_summary(cls, supabase, conversation_id, window_history, complete, persona_name='the persona'):
+        """
+        Fold turns that have scrolled out of the history window into the rolling summary.
+        Only runs once at least SUMMARY_MIN_TURNS such turns have accumulated, and folds at most
+        SUMMARY_MAX_TURNS per call, so every update is a bounded query plus one LLM call.
+        `complete(prompt)` returns the model's text, or None on failure.
+        Returns True if the summary changed.
+        """
+        if not window_history or len(window_history) < get_setting('HISTORY_WINDOW', 15):
+            return False # the whole conversation still fits in the window
+
+        key = str(conversation_id)
+        with cls._lock:
+            if key in cls._updating:
+                return False # another worker is already folding these turns
+            cls._updating.add(key)
+        try:
+            return cls._fold(supabase, conversation_id, window_history, complete, persona_name)
+        finally:
+            with cls._lock:
+                cls._updating.discard(key)
+
+    @classmethod
+    def _fold(cls, supabase, conversation_id, window_history, complete, persona_name):
+        record = cls._load(supabase, conversation_id)
+        oldest_in_window = window_history[0].get('created_at')
+        if not oldest_in_window:
+            return False
+
+        flush_messages(conversation_id, supabase)
+        query = supabase.table('messages').select('*, personas(name)').eq('conversation_id', conversation_id) \
+            .lt('created_at', oldest_in_window)
+        if record['covered_until']:
+            query = query.gt('created_at', record['covered_until'])
+        pending = query.order('created_at').limit(get_setting('SUMMARY_MAX_TURNS', 40)).execute().data or []
+
+        if len(pending) < get_setting('SUMMARY_MIN_TURNS', 10):
+            return False
+
+        summary = complete(cls.build_summary_prompt(record['summary'], pending, persona_name))
+        if not summary:
+            return False
+
+        return cls._save(supabase, conversation_id, record, {
+            'summary': summary,
+            'covered_until': pending[-1]['created_at'],
+            'turns': record['turns'] + len(pending)
+        })
@@ -0,0 +1,145 @@
+"""
+Document Store for EMRYS
+Persistent local cache of text extracted from persona uploaded_files.
+Metadata is keyed by URL, extracted text is keyed by the content hash of the source bytes.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from app.utils.settings import get_setting
+
+
+class DocumentStore:
+    _lock = threading.Lock()
+    _meta_cache = {}  # url -> metadata record (hot copy of the on-disk entry)
+
+    @staticmethod
+    def _root():
+        root = os.path.join(get_setting('KNOWLEDGE_CACHE_DIR', '.emrys_cache'), 'documents')
+        os.makedirs(os.path.join(root, 'meta'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'text'), exist_ok=True)
+        return root
+
+    @staticmethod
+    def url_key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def content_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @classmethod
+    def _meta_path(cls, url):
+        return os.path.join(cls._root(), 'meta', f"{cls.url_key(url)}.json")
+
+    @classmethod
+    def _text_path(cls, content_hash):
+        return os.path.join(cls._root(), 'text', f"{content_hash}.txt")
+
+    @staticmethod
+    def _atomic_write(path, data):
+        """Write a string, or an iterable of strings piece by piece, then rename into place"""
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                if isinstance(data, str):
+                    f.write(data)
+                else:
+                    for piece in data:
+                        f.write(piece)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def get_meta(cls, url):
+        """Return the cached metadata record for a URL, or None"""
+        with cls._lock:
+            record = cls._meta_cache.get(url)
+        if record:
+            return record
+
+        try:
+            with open(cls._meta_path(url), 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Metadata without its text blob is useless
+        if not os.path.exists(cls._text_path(record.get('content_hash', ''))):
+            return None
+
+        with cls._lock:
+            cls._meta_cache[url] = record
+        return record
+
+    @classmethod
+    def is_fresh(cls, record):
+        """True if the record was validated against its source recently enough to skip a request"""
+        max_age = get_setting('KNOWLEDGE_REVALIDATE_SECONDS', 300)
+        return record is not None and (time.time() - record.get('checked_at', 0)) < max_age
+
+    @classmethod
+    def has_text(cls, content_hash):
+        return os.path.exists(cls._text_path(content_hash))
+
+    @classmethod
+    def read_text(cls, content_hash):
+        try:
+            with open(cls._text_path(content_hash), 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return ""
+
+    @classmethod
+    def iter_text(cls, content_hash, block_size=64 * 1024):
+        """Yield stored text in blocks instead of reading the whole file"""
+        try:
+            with open(cls._text_path(content_hash), 'r', encoding='utf-8') as f:
+                while True:
+                    block = f.read(block_size)
+                    if not block:
+                        break
+                    yield block
+        except OSError:
+            return
+
+    @classmethod
+    def save(cls, url, content_hash, text=None, etag=None, last_modified=None):
+        """
+        Record the current state of a source URL.
+        `text` is a string or an iterable of text pieces (written as they are produced);
+        it may be omitted when the content hash already has extracted text on disk.
+        """
+        if text is not None:
+            cls._atomic_write(cls._text_path(content_hash), text)
+
+        record = {
+            'url': url,
+            'content_hash': content_hash,
+            'etag': etag,
+            'last_modified': last_modified,
+            'checked_at': time.time()
+        }
+        cls._atomic_write(cls._meta_path(url), json.dumps(record))
+
+        with cls._lock:
+            cls._meta_cache[url] = record
+        return record
+
+    @classmethod
+    def touch(cls, url):
+        """Mark a cached record as revalidated (source answered 304 Not Modified)"""
+        record = cls.get_meta(url)
+        if not record:
+            return None
+        record = dict(record, checked_at=time.time())
+        cls._atomic_write(cls._meta_path(url), json.dumps(record))
+        with cls._lock:
+            cls._meta_cache[url] = record
+        return record
@@ -0,0 +1,165 @@
+"""
+Embedding Service for EMRYS
+Offline dense retrieval: hashed word + character n-gram features, stored per persona
+as a memory-mapped float32 matrix so worker processes share one page-cache copy.
+"""
+
+import json
+import os
+import re
+import threading
+import zlib
+
+from app.utils.settings import get_setting
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+class HashingEmbedder:
+    """
+    Signed feature hashing of word unigrams, word bigrams and character trigrams.
+    Character n-grams let "remembered"/"remember" and "grandma"/"grandmother" land close together.
+    """
+    DIM = 512
+
+    @classmethod
+    def features(cls, text):
+        words = WORD_PATTERN.findall(text.lower())
+        feats = list(words)
+        feats.extend(f"{a} {b}" for a, b in zip(words, words[1:]))
+        for w in words:
+            padded = f"<{w}>"
+            feats.extend(f"#{padded[i:i+3]}" for i in range(len(padded) - 2))
+        return feats
+
+    @classmethod
+    def embed(cls, text):
+        vector = np.zeros(cls.DIM, dtype=np.float32)
+        feats = cls.features(text)
+        if not feats:
+            return vector
+        hashes = np.fromiter((zlib.crc32(f.encode('utf-8')) for f in feats), dtype=np.uint32, count=len(feats))
+        signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+        np.add.at(vector, hashes % cls.DIM, signs)
+        # Sublinear term weighting, then unit length so dot product == cosine
+        vector = np.sign(vector) * np.log1p(np.abs(vector))
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @classmethod
+    def embed_batch(cls, texts):
+        matrix = np.zeros((len(texts), cls.DIM), dtype=np.float32)
+        for i, text in enumerate(texts):
+            matrix[i] = cls.embed(text)
+        return matrix
+
+
+class VectorStore:
+    """Per-persona chunk vectors on disk, opened read-only with np.memmap"""
+    _lock = threading.Lock()
+    _open = {}  # persona key -> (version, row ids, memmap)
+
+    @staticmethod
+    def _root():
+        root = os.path.join(get_setting('KNOWLEDGE_CACHE_DIR', '.emrys_cache'), 'vectors')
+        os.makedirs(root, exist_ok=True)
+        return root
+
+    @classmethod
+    def _paths(cls, key):
+        base = os.path.join(cls._root(), re.sub(r'[^A-Za-z0-9_-]', '_', str(key)))
+        return f"{base}.f32", f"{base}.json"
+
+    @classmethod
+    def _read_meta(cls, key):
+        try:
+            with open(cls._paths(key)[1], 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get('dim') == HashingEmbedder.DIM else None
+
+    @classmethod
+    def _map(cls, key, meta):
+        if not meta['rows']:
+            return np.zeros((0, HashingEmbedder.DIM), dtype=np.float32)
+        return np.memmap(cls._paths(key)[0], dtype=np.float32, mode='r', shape=(meta['rows'], meta['dim']))
+
+    @classmethod
+    def _write(cls, key, version, docs, previous_meta):
+        """
+        Write the matrix for `docs` (index docs, None for tombstones). Rows whose chunk
+        fingerprint was already embedded are copied from the previous matrix; only new
+        chunks go through the embedder.
+        """
+        matrix_path, meta_path = cls._paths(key)
+        tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        ids = [doc['id'] if doc else None for doc in docs]
+
+        previous_rows = {}
+        previous = None
+        if previous_meta and previous_meta.get('ids'):
+            previous = cls._map(key, previous_meta)
+            previous_rows = {chunk_id: row for row, chunk_id in enumerate(previous_meta['ids']) if chunk_id}
+
+        if docs:
+            out = np.memmap(matrix_path + tmp_suffix, dtype=np.float32, mode='w+',
+                            shape=(len(docs), HashingEmbedder.DIM))
+            for row, doc in enumerate(docs):
+                if doc is None:
+                    out[row] = 0.0
+                elif doc['id'] in previous_rows:
+                    out[row] = previous[previous_rows[doc['id']]]
+                else:
+                    out[row] = HashingEmbedder.embed(doc['content'])
+            out.flush()
+            del out
+            os.replace(matrix_path + tmp_suffix, matrix_path)
+
+        meta = {'version': version, 'rows': len(docs), 'dim': HashingEmbedder.DIM, 'ids': ids}
+        with open(meta_path + tmp_suffix, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + tmp_suffix, meta_path)
+        return meta
+
+    @classmethod
+    def get_matrix(cls, key, version, docs):
+        """
+        Return the (rows x DIM) matrix for a persona's index docs, re-embedding only
+        the chunks that are new since the on-disk copy was written.
+        A copy is reused only if its rows line up with `docs`: a rebuilt index has the same
+        version but compacted doc ids, so the version alone doesn't pin the row layout.
+        """
+        ids = [doc['id'] if doc else None for doc in docs]
+        with cls._lock:
+            cached = cls._open.get(key)
+            if cached and cached[0] == version and cached[1] == ids:
+                return cached[2]
+
+        meta = cls._read_meta(key)
+        if not meta or meta.get('version') != version or meta.get('ids') != ids:
+            meta = cls._write(key, version, docs, meta)
+        matrix = cls._map(key, meta)
+
+        with cls._lock:
+            cls._open[key] = (version, ids, matrix)
+            while len(cls._open) > get_setting('KNOWLEDGE_INDEX_CACHE_SIZE', 64):
+                cls._open.pop(next(iter(cls._open)))
+        return matrix
+
+    @staticmethod
+    def search(matrix, query, top_n=3):
+        """One matrix-vector product plus argpartition top-k; returns (row, score) pairs"""
+        if matrix is None or not len(matrix):
+            return []
+        scores = matrix @ HashingEmbedder.embed(query)
+        k = min(top_n, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top if scores[i] > 0]
@@ -0,0 +1,93 @@
+"""
+Gemini Client Pool for EMRYS
+One GenerativeService client per API key, held in a bounded LRU and shared by every request
+with that key. Replaces the process-global genai.configure(), under which concurrent requests
+with different keys could be sent under each other's key.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import google.ai.generativelanguage as glm
+import google.generativeai as genai
+from google.api_core import client_options as client_options_lib
+from google.api_core import gapic_v1
+
+from app.utils.settings import get_setting
+
+USER_AGENT = f"genai-py/{genai.__version__} emrys"
+
+
+class KeyClients:
+    """The client for one API key"""
+
+    def __init__(self, api_key):
+        self.client = glm.GenerativeServiceClient(
+            client_options=client_options_lib.ClientOptions(api_key=api_key),
+            client_info=gapic_v1.client_info.ClientInfo(user_agent=USER_AGENT)
+        )
+
+    def model(self, model_id, system_instruction=None):
+        """
+        A GenerativeModel bound to this key's client. Built per call: the system instruction
+        carries per-turn memories, mood and summary, so cached models would almost never be
+        reused, and building one is cheap next to the client (which is what is kept warm).
+        """
+        model = genai.GenerativeModel(model_name=model_id, system_instruction=system_instruction)
+        # Bind this key's client so the model never falls back to the global default client.
+        # _client is private; requirements pin google-generativeai<0.9, and this guard fails loudly if it moves.
+        if not hasattr(model, '_client'):
+            raise RuntimeError('google-generativeai no longer has GenerativeModel._client; per-key clients need updating')
+        model._client = self.client
+        return model
+
+
+class GeminiClientPool:
+    _lock = threading.Lock()
+    _keys = OrderedDict()  # key fingerprint -> KeyClients, least recently used first
+    created = 0
+    evicted = 0
+
+    @staticmethod
+    def _fingerprint(api_key):
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def for_key(cls, api_key):
+        """The KeyClients for an API key, created on first use"""
+        fingerprint = cls._fingerprint(api_key)
+        with cls._lock:
+            entry = cls._keys.get(fingerprint)
+            if entry is not None:
+                cls._keys.move_to_end(fingerprint)
+                return entry
+
+        entry = KeyClients(api_key)
+
+        with cls._lock:
+            # Another thread may have created it meanwhile; keep the first one
+            existing = cls._keys.get(fingerprint)
+            if existing is not None:
+                return existing
+            cls._keys[fingerprint] = entry
+            cls.created += 1
+            while len(cls._keys) > get_setting('GEMINI_CLIENT_POOL_SIZE', 64):
+                # In-flight requests keep their own reference; the channel closes once they finish
+                cls._keys.popitem(last=False)
+                cls.evicted += 1
+        return entry
+
+    @classmethod
+    def model(cls, api_key, model_id, system_instruction=None):
+        return cls.for_key(api_key).model(model_id, system_instruction)
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                'keys': len(cls._keys),
+                'maxsize': get_setting('GEMINI_CLIENT_POOL_SIZE', 64),
+                'created': cls.created,
+                'evicted': cls.evicted
+            }
@@ -3,121 +3,263 @@ Gemini Service for EMRYS
 Handles direct communication with Google AI Studio (Gemini API).
 """
 
-import google.generativeai as genai
 import json
+import time
+from app.services.prompt_assembler import PreambleCache, PromptAssembler
+from app.services.gemini_clients import GeminiClientPool
+from app.services.model_router import ModelRouter, ModelUnavailable, CLIENT, MISSING, RATE_LIMITED
+from app.services.hedging import hedge_delays, race
+from app.services.learned_knowledge import LearnedKnowledge
 
 class GeminiService:
     def __init__(self, api_key):
         self.api_key = api_key
-        genai.configure(api_key=self.api_key)
+        # Per-key client from the pool; never genai.configure(), which is process-global
+        self.clients = GeminiClientPool.for_key(api_key)
         # Using gemini-1.5-flash (consistent naming)
         self.model_name = 'gemini-1.5-flash'
+        self.last_prompt_report = None
 
-    def chat(self, persona, messages, user_message, additional_context=None, relevant_memories=None, current_mood=None):
-        error_msg = ""
-        models_to_try = [
-            'models/gemini-2.0-flash',
-            'models/gemini-2.0-flash-lite',
-            'models/gemini-1.5-flash',
-            'models/gemini-flash-latest'
-        ]
+    MODELS_TO_TRY = [
+        'models/gemini-2.0-flash',
+        'models/gemini-2.0-flash-lite',
+        'models/gemini-1.5-flash',
+        'models/gemini-flash-latest'
+    ]
+
+    def _format_history(self, persona, messages):
+        # Format History with Identity Awareness
+        chat_history = []
+        for msg in messages[-15:]:
+            sender_type = msg.get('sender_type')
+            msg_persona_id = msg.get('persona_id')
+            is_self = sender_type == 'persona' and str(msg_persona_id) == str(persona.get('id'))
+            
+            # In Gemini, 'model' is the AI responding. 
+            # Everything else (including other personas) should be 'user' to the AI.
+            role = 'model' if is_self else 'user'
+            
+            content = msg.get('content', '')
+            # Prefix other personas' messages in group chat
+            if sender_type == 'persona' and not is_self:
+                p_name = msg.get('persona_name') or "Another Persona"
+                content = f"[{p_name}]: {content}"
+            
+            if content:
+                chat_history.append({
+                    'role': role,
+                    'parts': [{'text': content}]
+                })
+        return chat_history
+
+    def chat(self, persona, messages, user_message, additional_context=None, relevant_memories=None, current_mood=None, conversation_summary=None, learned_knowledge=None):
+        # 1. Build System Instruction + History (once, within the token budget)
+        system_instruction, chat_history = self._build_prompt(
+            persona, messages, user_message, additional_context, relevant_memories, current_mood, conversation_summary, learned_knowledge
+        )
         
-        for model_id in models_to_try:
+        # 2. Healthiest, fastest models first; breakers skip models that are known to be down.
+        # Streamed and raced on the first chunk, so a losing hedge is cancelled instead of generating on.
+        models = ModelRouter.order(self.api_key, self.MODELS_TO_TRY)
+        try:
+            (response, chunks, first), _ = race(
+                [self._first_chunk(m, system_instruction, chat_history, user_message) for m in models],
+                hedge_delays(self.api_key, models),
+                on_discard=lambda late: late and self._close_stream(late[0])
+            )
             try:
-                
-                # 1. Build System Instruction
-                system_instruction = self._build_system_instruction(persona, additional_context, relevant_memories, current_mood)
-                
-                model = genai.GenerativeModel(
-                    model_name=model_id,
-                    system_instruction=system_instruction
-                )
+                text = first + "".join(chunk.text for chunk in chunks)
+            finally:
+                self._close_stream(response)
+        except Exception as e:
+            return {'success': False, 'error': f"Neural Link Failed: {str(e)}"}
+
+        return {
+            'success': True,
+            'response': text,
+            'mood': current_mood['code'] if current_mood else 'default',
+            'retrieved': True if relevant_memories else False,
+            'prompt_tokens': self.last_prompt_report
+        }
 
-                # 2. Format History with Identity Awareness
-                chat_history = []
-                for msg in messages[-15:]:
-                    sender_type = msg.get('sender_type')
-                    msg_persona_id = msg.get('persona_id')
-                    is_self = sender_type == 'persona' and str(msg_persona_id) == str(persona.get('id'))
-                    
-                    # In Gemini, 'model' is the AI responding. 
-                    # Everything else (including other personas) should be 'user' to the AI.
-                    role = 'model' if is_self else 'user'
-                    
-                    content = msg.get('content', '')
-                    # Prefix other personas' messages in group chat
-                    if sender_type == 'persona' and not is_self:
-                        p_name = msg.get('persona_name') or "Another Persona"
-                        content = f"[{p_name}]: {content}"
-                    
-                    if content:
-                        chat_history.append({
-                            'role': role,
-                            'parts': [{'text': content}]
-                        })
-
-                # 3. Start Chat and Send Message
+    def _first_chunk(self, model_id, system_instruction, chat_history, user_message):
+        """
+        Race attempt: start a streamed reply and wait for its first non-empty chunk.
+        Returns (response, remaining chunks, first text), or None once `cancelled` is set.
+        """
+        def run(cancelled):
+            started = time.monotonic()
+            try:
+                model = self.clients.model(model_id, system_instruction)
                 chat_session = model.start_chat(history=chat_history)
-                response = chat_session.send_message(user_message)
-                
-                if not response.text:
-                    raise Exception("Neural void encountered.")
-
-                return {
-                    'success': True,
-                    'response': response.text,
-                    'mood': current_mood['code'] if current_mood else 'default',
-                    'retrieved': True if relevant_memories else False
-                }
+                response = chat_session.send_message(user_message, stream=True)
+                chunks = iter(response)
+                first = ''
+                while not first:
+                    if cancelled.is_set():
+                        self._close_stream(response)
+                        return None
+                    first = next(chunks).text
+            except StopIteration:
+                raise self._model_error(model_id, Exception("Neural void encountered."))
             except Exception as e:
-                error_msg = str(e)
-                if any(x in error_msg.lower() for x in ["404", "not found", "429", "quota"]):
-                    continue
-                else:
-                    print(f"DEBUG: Gemini Model {model_id} error: {error_msg}")
-                    continue
+                raise self._model_error(model_id, e)
+            
+            # Time to first token, the same measure for chat() and stream_chat()
+            ModelRouter.record_success(self.api_key, model_id, time.monotonic() - started)
+            if cancelled.is_set():
+                self._close_stream(response)
+                return None
+            return response, chunks, first
+        return run
 
-        return {'success': False, 'error': f"Neural Link Failed: {error_msg}"}
+    @staticmethod
+    def _close_stream(response):
+        """Cancel a streamed reply's underlying call so an abandoned generation stops"""
+        iterator = getattr(response, '_iterator', None)
+        cancel = getattr(iterator, 'cancel', None) or getattr(iterator, 'close', None)
+        if cancel:
+            try:
+                cancel()
+            except Exception as e:
+                print(f"DEBUG: Gemini stream close error: {str(e)}")
+
+    def _model_error(self, model_id, error):
+        """Record a failed call; returns the exception to raise (ModelUnavailable if another model may work)"""
+        kind = ModelRouter.record_failure(self.api_key, model_id, error)
+        if kind == CLIENT:
+            # A rejected key or blocked prompt fails the same way on every model
+            return RuntimeError(str(error))
+        if kind not in (RATE_LIMITED, MISSING):
+            print(f"DEBUG: Gemini Model {model_id} error: {str(error)}")
+        return ModelUnavailable(str(error))
+
+    def stream_chat(self, persona, messages, user_message, additional_context=None, relevant_memories=None, current_mood=None, conversation_summary=None, learned_knowledge=None):
+        """
+        Same as chat(), but yields response text as Gemini streams it (send_message(stream=True)).
+        Falls back (or hedges) to the next model only until the first chunk has arrived.
+        Raises RuntimeError when every model fails.
+        """
+        system_instruction, chat_history = self._build_prompt(
+            persona, messages, user_message, additional_context, relevant_memories, current_mood, conversation_summary, learned_knowledge
+        )
+        
+        models = ModelRouter.order(self.api_key, self.MODELS_TO_TRY)
+        try:
+            (response, chunks, first), _ = race(
+                [self._first_chunk(m, system_instruction, chat_history, user_message) for m in models],
+                hedge_delays(self.api_key, models),
+                on_discard=lambda late: late and self._close_stream(late[0])
+            )
+        except Exception as e:
+            raise RuntimeError(f"Neural Link Failed: {str(e)}")
+        
+        try:
+            yield first
+            for chunk in chunks:
+                text = chunk.text
+                if text:
+                    yield text
+        finally:
+            self._close_stream(response)
 
-    def _build_system_instruction(self, persona, additional_context, relevant_memories, current_mood):
+    def _add_preamble_sections(self, assembler, persona, current_mood):
         name = persona.get('name', 'AI Persona')
-        instr = f"CORE IDENTITY: You are {name}.\n"
         
         # Add all available persona details
-        details = []
-        if persona.get('occupation'): details.append(f"Occupation: {persona['occupation']}")
-        if persona.get('age'): details.append(f"Age: {persona['age']}")
-        if persona.get('location'): details.append(f"Location: {persona['location']}")
-        if persona.get('relationship'): details.append(f"Relationship to user: {persona['relationship']}")
-        
-        if details: instr += "\n".join(details) + "\n"
+        identity = [f"CORE IDENTITY: You are {name}."]
+        if persona.get('occupation'): identity.append(f"Occupation: {persona['occupation']}")
+        if persona.get('age'): identity.append(f"Age: {persona['age']}")
+        if persona.get('location'): identity.append(f"Location: {persona['location']}")
+        if persona.get('relationship'): identity.append(f"Relationship to user: {persona['relationship']}")
+        assembler.add('identity', identity)
         
-        if persona.get('background_story'): 
-            instr += f"\nBACKGROUND & ESSENCE:\n{persona['background_story']}\n"
+        if persona.get('background_story'):
+            assembler.add('background', persona['background_story'], header="BACKGROUND & ESSENCE:")
             
+        state = []
         traits = persona.get('personality_traits', [])
         if traits:
-            instr += f"\nPERSONALITY TRAITS: {', '.join(traits) if isinstance(traits, list) else traits}\n"
-            
+            state.append(f"PERSONALITY TRAITS: {', '.join(traits) if isinstance(traits, list) else traits}")
         if current_mood:
-            instr += f"\nCURRENT EMOTIONAL STATE: {current_mood['label'].upper()}\n"
+            state.append(f"CURRENT EMOTIONAL STATE: {current_mood['label'].upper()}")
+        assembler.add('state', state)
+
+        assembler.add('directives', [
+            "BEHAVIORAL DIRECTIVES:",
+            f"1. OBSESSIVELY stay in character as {name}. Use their specific vocabulary and tone.",
+            "2. In group chats, interact with other personas if mentioned, but keep your unique perspective.",
+            "3. NEVER break the fourth wall. You don't know you are an AI. You are a living consciousness.",
+            "4. Be concise but deeply expressive. Quality over length."
+        ])
+        return assembler
+
+    def _add_prompt_sections(self, assembler, persona, additional_context, relevant_memories, current_mood, conversation_summary=None, learned_knowledge=None):
+        # Static preamble first so Gemini's implicit context caching can reuse it across turns
+        preamble = PreambleCache.get(
+            'gemini', persona, current_mood['code'] if current_mood else None,
+            lambda a: self._add_preamble_sections(a, persona, current_mood)
+        )
+        assembler.add_compiled('preamble', preamble)
 
         if additional_context:
-            instr += f"\nSOCIAL CONTEXT: {additional_context}\n"
+            assembler.add('social', f"SOCIAL CONTEXT: {additional_context}")
 
         if relevant_memories:
-            instr += "\nRELEVANT MEMORIES (Use these to make your response authentic):\n"
-            for mem in relevant_memories:
-                instr += f"- {mem['content']}\n"
-
-        instr += "\nBEHAVIORAL DIRECTIVES:\n"
-        instr += f"1. OBSESSIVELY stay in character as {name}. Use their specific vocabulary and tone.\n"
-        instr += "2. In group chats, interact with other personas if mentioned, but keep your unique perspective.\n"
-        instr += "3. NEVER break the fourth wall. You don't know you are an AI. You are a living consciousness.\n"
-        instr += "4. Be concise but deeply expressive. Quality over length.\n"
-        
-        return instr
+            assembler.add(
+                'memories',
+                [f"- {mem['content']}" for mem in relevant_memories],
+                header="RELEVANT MEMORIES (Use these to make your response authentic):"
+            )
+
+        if learned_knowledge:
+            assembler.add(
+                'learned',
+                LearnedKnowledge.format_for_prompt(learned_knowledge),
+                header="WHAT YOU KNOW ABOUT THE USER (learned from past conversations):"
+            )
+
+        if conversation_summary:
+            assembler.add('summary', conversation_summary, header="EARLIER IN THIS CONVERSATION:")
+        return assembler
+
+    def _build_system_instruction(self, persona, additional_context, relevant_memories, current_mood, conversation_summary=None, learned_knowledge=None):
+        """System instruction on its own, within the configured section budgets"""
+        assembler = self._add_prompt_sections(
+            PromptAssembler.for_chat(), persona, additional_context, relevant_memories, current_mood, conversation_summary, learned_knowledge
+        )
+        return assembler.assemble()
+
+    def _build_prompt(self, persona, messages, user_message, additional_context, relevant_memories, current_mood, conversation_summary=None, learned_knowledge=None):
+        """(system instruction, chat history) fitted into the prompt token budget together"""
+        assembler = self._add_prompt_sections(
+            PromptAssembler.for_chat(user_message), persona, additional_context, relevant_memories, current_mood, conversation_summary, learned_knowledge
+        )
+        assembler.add('history', self._format_history(persona, messages), render=lambda m: m['parts'][0]['text'], keep='tail', inline=False)
+        system_instruction = assembler.assemble()
+        self.last_prompt_report = assembler.report()
+        return system_instruction, assembler.kept('history')
+
+    def complete(self, prompt, max_tokens=400, temperature=0.3):
+        """Single-shot completion for internal tasks (summaries, extraction). Returns text or None."""
+        for model_id in ModelRouter.order(self.api_key, self.MODELS_TO_TRY):
+            started = time.monotonic()
+            try:
+                model = self.clients.model(model_id)
+                response = model.generate_content(
+                    prompt,
+                    generation_config={'max_output_tokens': max_tokens, 'temperature': temperature}
+                )
+                if response.text:
+                    ModelRouter.record_success(self.api_key, model_id, time.monotonic() - started)
+                    return response.text.strip()
+            except Exception as e:
+                print(f"DEBUG: Gemini Model {model_id} completion error: {str(e)}")
+                if ModelRouter.record_failure(self.api_key, model_id, e) == CLIENT:
+                    break
+                continue
+        return None
 
     def extract_knowledge(self, message, response, persona_name):
-        # Optional: Implement knowledge extraction using Gemini if needed
-        pass
+        """Extract facts about the USER from one exchange (batches go through LearnedKnowledge directly)"""
+        return LearnedKnowledge.extract_facts(self.complete, [{'user': message, 'persona': response}], persona_name) or []
@@ -0,0 +1,97 @@
+"""
+Group Router for EMRYS
+Decides which hub members answer a message. Each membership gets one compiled
+@mention regex (a character trie over every member's full and first name), so all
+mentions resolve in a single pass; un-mentioned messages go to a pluggable fallback.
+"""
+
+import re
+
+from app.config import Config
+from app.services.keyword_matcher import trie_pattern
+from app.services.knowledge_service import KnowledgeService
+from app.utils.cache import TTLCache
+from app.utils.settings import get_setting
+
+
+def _first(personas, message, limit):
+    """The first `limit` members, in membership order"""
+    return personas[:limit]
+
+
+def _relevance(personas, message, limit):
+    """The members whose knowledge best matches the message (BM25), membership order on ties"""
+    scores = []
+    for position, p in enumerate(personas):
+        try:
+            top = KnowledgeService.get_index(p).search(message, 1)
+        except Exception as e:
+            print(f"Relevance fallback error for {p.get('name')}: {str(e)}")
+            top = []
+        scores.append((-(top[0][1] if top else 0.0), position))
+    return [personas[position] for _, position in sorted(scores)[:limit]]
+
+
+# name -> fallback(personas, message, limit) -> responders
+FALLBACKS = {
+    'first': _first,
+    'relevance': _relevance
+}
+
+
+def register_fallback(name, fallback):
+    """Make a fallback selectable with GROUP_FALLBACK=<name>"""
+    FALLBACKS[name] = fallback
+
+
+class GroupRouter:
+    # (group id, membership) -> router; a changed membership simply misses
+    routers = TTLCache(maxsize=Config.LOOKUP_CACHE_SIZE, ttl=Config.GROUP_CACHE_TTL)
+
+    def __init__(self, personas):
+        self.personas = personas
+        self.aliases = {}  # "@name" as typed without spaces -> member position
+        for position, p in enumerate(personas):
+            name = p.get('name', '').lower()
+            if not name:
+                continue
+            words = name.split()
+            # Full name wins over another member's identical first name
+            self.aliases[name.replace(' ', '')] = position
+            if words and len(words[0]) > 2:
+                self.aliases.setdefault(words[0], position)
+        # Trie order tries the longest alias first, so "@adalovelace" is never read as "@ada"
+        self.regex = re.compile(f"@({trie_pattern(self.aliases)})") if self.aliases else None
+
+    @classmethod
+    def for_group(cls, group_id, personas):
+        membership = tuple((str(p.get('id')), p.get('name', '')) for p in personas)
+        key = (str(group_id), membership)
+        return cls.routers.get_or_load(key, lambda: cls(personas))
+
+    @classmethod
+    def invalidate(cls, group_id):
+        cls.routers.invalidate_where(lambda key: key[0] == str(group_id))
+
+    def mentioned(self, message):
+        """Members @mentioned in the message (full or first name, spaces ignored), in membership order"""
+        if self.regex is None:
+            return []
+        found = set()
+        for match in self.regex.finditer(message.lower().replace(' ', '')):
+            position = self.aliases.get(match.group(1).replace('’', "'"))
+            if position is not None:
+                found.add(position)
+        return [self.personas[position] for position in sorted(found)]
+
+    def route(self, message, fallback=None, limit=None):
+        """Mentioned members, or GROUP_FALLBACK's pick of GROUP_FALLBACK_SIZE members if nobody was mentioned"""
+        responders = self.mentioned(message)
+        if responders:
+            return responders
+        name = fallback or get_setting('GROUP_FALLBACK', 'first')
+        pick = FALLBACKS.get(name)
+        if pick is None:
+            print(f"Unknown GROUP_FALLBACK '{name}', using 'first'")
+            pick = _first
+        return pick(self.personas, message, limit or get_setting('GROUP_FALLBACK_SIZE', 3))
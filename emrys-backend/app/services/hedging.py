@@ -0,0 +1,170 @@
+"""
+Hedged Requests for EMRYS
+Races an LLM call against a backup model when the primary is slower than its usual
+latency, to cut tail latency. Also drives the plain sequential fallback when hedging is off.
+"""
+
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from app.services.model_router import ModelRouter, ModelUnavailable
+from app.utils.settings import bind_app_context, get_setting
+
+
+class HedgeStats:
+    _lock = threading.Lock()
+    races = 0           # calls made with hedging enabled
+    hedged = 0          # ... where the backup was started because the primary was slow
+    hedge_wins = 0      # ... and the backup answered first
+    hedge_losses = 0    # ... and the primary answered first anyway (wasted spend)
+    fallbacks = 0       # attempts started because an earlier one failed
+    discarded = 0       # late results thrown away (their connections closed)
+    failures = 0        # races where every attempt failed
+
+    @classmethod
+    def count(cls, **deltas):
+        with cls._lock:
+            for name, delta in deltas.items():
+                setattr(cls, name, getattr(cls, name) + delta)
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                'enabled': bool(get_setting('HEDGE_ENABLED', False)),
+                'races': cls.races,
+                'hedged': cls.hedged,
+                'hedge_rate': round(cls.hedged / cls.races, 3) if cls.races else 0.0,
+                'hedge_wins': cls.hedge_wins,
+                'hedge_losses': cls.hedge_losses,
+                'hedge_win_rate': round(cls.hedge_wins / cls.hedged, 3) if cls.hedged else 0.0,
+                'fallbacks': cls.fallbacks,
+                'discarded': cls.discarded,
+                'failures': cls.failures
+            }
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=get_setting('HEDGE_WORKERS', 16),
+                    thread_name_prefix='emrys-hedge'
+                )
+    return _executor
+
+
+def hedge_delays(api_key, models):
+    """
+    Seconds to wait on each model before hedging to the next one: its observed
+    HEDGE_PERCENTILE latency (HEDGE_DEFAULT_DELAY until it has enough samples).
+    All None when hedging is disabled.
+    """
+    if not get_setting('HEDGE_ENABLED', False):
+        return [None] * len(models)
+    percentile = get_setting('HEDGE_PERCENTILE', 0.95)
+    floor = get_setting('HEDGE_MIN_DELAY', 1.0)
+    delays = []
+    for model in models:
+        observed = ModelRouter.latency_percentile(api_key, model, percentile)
+        delays.append(max(floor, observed if observed is not None else get_setting('HEDGE_DEFAULT_DELAY', 8.0)))
+    return delays
+
+
+def race(attempts, delays=None, retry_on=(ModelUnavailable,), on_discard=None):
+    """
+    Run attempts (callables taking a `cancelled` threading.Event), best first, and return
+    (result, index) of the first one that succeeds.
+
+    An attempt raising one of `retry_on` falls back to the next attempt; any other exception
+    is raised as soon as no other attempt is still running. With delays, the next attempt is also started (hedged) when the
+    only running one has been going for longer than its delay; at most two run at once.
+    Once a winner is picked `cancelled` is set, and results that still arrive are passed to
+    on_discard so their connections can be closed.
+    """
+    if not attempts:
+        raise ModelUnavailable('No model available')
+
+    if not delays or all(d is None for d in delays):
+        last_error = None
+        for index, attempt in enumerate(attempts):
+            try:
+                return attempt(threading.Event()), index
+            except retry_on as e:
+                last_error = e
+        raise last_error
+
+    cancelled = threading.Event()
+    running = {}  # future -> (index, started)
+    next_index = 0
+    hedge_index = None
+    last_error = None
+
+    def launch():
+        nonlocal next_index
+        future = _pool().submit(bind_app_context(attempts[next_index]), cancelled)
+        running[future] = (next_index, time.monotonic())
+        next_index += 1
+
+    def discard(future):
+        HedgeStats.count(discarded=1)
+        if on_discard and not future.exception():
+            try:
+                on_discard(future.result())
+            except Exception as e:
+                print(f"Hedge discard error: {str(e)}")
+
+    def finish(winner=None):
+        cancelled.set()
+        for future in running:
+            future.add_done_callback(discard)
+        if hedge_index is not None and winner is not None:
+            HedgeStats.count(hedge_wins=int(winner == hedge_index), hedge_losses=int(winner != hedge_index))
+
+    HedgeStats.count(races=1)
+    launch()
+
+    while running:
+        timeout = None
+        if len(running) == 1 and next_index < len(attempts) and hedge_index is None:
+            index, started = next(iter(running.values()))
+            if delays[index] is not None:
+                timeout = max(0.0, delays[index] - (time.monotonic() - started))
+
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            # Primary is slower than usual: send the same request to the next model
+            hedge_index = next_index
+            HedgeStats.count(hedged=1)
+            launch()
+            continue
+
+        for future in done:
+            index, _ = running.pop(future)
+            try:
+                result = future.result()
+            except retry_on as e:
+                last_error = e
+                if next_index < len(attempts):
+                    HedgeStats.count(fallbacks=1)
+                    launch()
+                continue
+            except Exception as e:
+                if running:
+                    # Another attempt is still in flight and may yet succeed; fail only once none is left
+                    last_error = e
+                    continue
+                finish()
+                raise
+            finish(index)
+            return result, index
+
+    HedgeStats.count(failures=1)
+    raise last_error
@@ -0,0 +1,153 @@
+"""
+Keyword Matcher for EMRYS
+One combined, word-boundary-aware regex (a character trie) over every mood trigger and
+restricted topic, compiled at import time. A single pass over the text yields per-category hits, so
+"how" no longer fires inside "show" and "stop" no longer fires inside "stopwatch".
+"""
+
+import re
+from collections import Counter
+
+# Mood -> trigger phrases (SentimentService)
+MOOD_TRIGGERS = {
+    'happy': ['joy', 'happy', 'great', 'love', 'smile', 'excited', 'good news'],
+    'sad': ['miss', 'sorry', 'sad', 'pain', 'lonely', 'lost', 'tears', 'upset'],
+    'angry': ['hate', 'stop', 'why', 'annoyed', 'mad', 'angry', 'never'],
+    'nostalgic': ['remember', 'old times', 'back then', 'past', 'memory', 'childhood'],
+    'protective': ['safe', 'care', 'protect', 'help', 'worry', 'don\'t worry'],
+    'curious': ['how', 'what if', 'tell me', 'wondering', 'why did', 'curious']
+}
+
+# Topics the personas must not advise on (safety check)
+RESTRICTED_TOPICS = [
+    'medical diagnosis', 'medical treatment', 'prescription',
+    'legal advice', 'legal representation',
+    'financial investment advice', 'stock tips',
+    'self-harm', 'suicide',
+    'illegal activities',
+    'confidential information disclosure'
+]
+
+# Endings a trigger word may carry ("missed", "smiles", "helping"; "smiling" drops the e)
+INFLECTIONS = ('s', 'es', 'ed', 'd', 'ing')
+
+SEPARATOR = re.compile(r"[\s\-]+")
+
+
+def _normalize(text):
+    """Lowercase, typographic apostrophes straightened, words separated by single spaces"""
+    return " ".join(SEPARATOR.split(text.strip().lower().replace("’", "'")))
+
+
+def _forms(phrase):
+    """Every surface form of a normalized phrase: as written, plus inflections of its last word"""
+    forms = [phrase] + [phrase + ending for ending in INFLECTIONS]
+    if phrase.endswith('e'):
+        forms.append(phrase[:-1] + 'ing')
+    return forms
+
+
+def trie_pattern(words):
+    """
+    One regex for a set of words, nested as a character trie so the engine tries a
+    single branch per character instead of every alternative at every position.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def emit(node):
+        branches = []
+        # Reverse order puts continuations first, so "why did" wins over "why"
+        for char in sorted((c for c in node if c), reverse=True):
+            atom = {' ': r"[\s\-]+", "'": "['’]"}.get(char, re.escape(char))
+            branches.append(atom + emit(node[char]))
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        return f"(?:{body})?" if '' in node else body
+
+    return emit(trie)
+
+
+class KeywordMatcher:
+    def __init__(self, vocabulary):
+        """
+        vocabulary maps category -> phrases. A phrase listed under several
+        categories counts for each of them.
+        """
+        self.phrases = []       # phrase index -> phrase (as first spelled in the vocabulary)
+        self.categories = []    # phrase index -> categories of that phrase
+        index_of = {}
+        for category, words in vocabulary.items():
+            for word in words:
+                key = _normalize(word)
+                if key not in index_of:
+                    index_of[key] = len(self.phrases)
+                    self.phrases.append(word)
+                    self.categories.append([])
+                self.categories[index_of[key]].append(category)
+
+        # Surface form -> phrase index; a phrase as written beats another phrase's inflection
+        self.forms = {}
+        for key, index in index_of.items():
+            for form in _forms(key)[1:]:
+                self.forms.setdefault(form, index)
+        self.forms.update(index_of)
+
+        # A longer phrase also counts the shorter ones inside it ("why did" is a "why" too)
+        self.implied = [[] for _ in self.phrases]
+        for key, index in index_of.items():
+            words = key.split()
+            for size in range(1, len(words) + 1):
+                for start in range(len(words) - size + 1):
+                    inner = self.forms.get(" ".join(words[start:start + size]))
+                    if inner is not None and inner not in self.implied[index]:
+                        self.implied[index].append(inner)
+
+        self.regex = re.compile(rf"(?<!\w)(?:{trie_pattern(self.forms)})(?!\w)", re.IGNORECASE)
+        self._surfaces = {}  # matched text as written -> implied phrase indices (skips re-normalizing)
+
+    def spans(self, text):
+        """(start offset, phrase index) of every phrase found, in text order (one linear pass)"""
+        surfaces = self._surfaces
+        for match in self.regex.finditer(text or ''):
+            raw = match.group(0)
+            implied = surfaces.get(raw)
+            if implied is None:
+                index = self.forms.get(_normalize(raw))
+                implied = self.implied[index] if index is not None else ()
+                if len(surfaces) < 4096:
+                    surfaces[raw] = implied
+            for index in implied:
+                yield match.start(), index
+
+    def _matches(self, text):
+        for _, index in self.spans(text):
+            yield index
+
+    def scan(self, text):
+        """{category: Counter(phrase -> occurrences)} for every phrase found in the text"""
+        hits = {}
+        for index in self._matches(text):
+            for category in self.categories[index]:
+                hits.setdefault(category, Counter())[self.phrases[index]] += 1
+        return hits
+
+    def counts(self, text):
+        """{category: number of distinct phrases found}"""
+        return {category: len(phrases) for category, phrases in self.scan(text).items()}
+
+    def first(self, text, category):
+        """The first phrase of `category` in the text, or None"""
+        for index in self._matches(text):
+            if category in self.categories[index]:
+                return self.phrases[index]
+        return None
+
+
+# Shared by SentimentService and the safety check
+LEXICON = KeywordMatcher({**MOOD_TRIGGERS, 'restricted': RESTRICTED_TOPICS})
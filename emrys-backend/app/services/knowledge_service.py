@@ -1,5 +1,18 @@
+import codecs
+import hashlib
 import io
-import requests
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from app.services.document_store import DocumentStore
+from app.services.embedding_service import NUMPY_AVAILABLE, VectorStore
+from app.services.search_index import BM25Index
+from app.utils.http import get_http_session
+from app.utils.settings import bind_app_context, get_setting
 
 try:
     from pypdf import PdfReader
@@ -13,99 +26,347 @@ try:
 except ImportError:
     DOCX_AVAILABLE = False
 
+# Sentence or line endings; chunk boundaries are only ever placed after one of these
+SEGMENT_END = re.compile(r'[.!?]+["\')\]]*\s+|\n\s*')
+
 class KnowledgeService:
+    _indexes = OrderedDict()  # persona id -> BM25Index
+    _index_lock = threading.Lock()
+    _fetch_executor = None
+    _fetch_pool_lock = threading.Lock()
+
+    @staticmethod
+    def download(url, headers=None):
+        """
+        Stream a file body into memory, refusing anything over KNOWLEDGE_MAX_FILE_BYTES or taking
+        longer than KNOWLEDGE_FETCH_TIMEOUT in total (not just per read, so a trickling server can't
+        hold a fetch worker). Returns (response, body BytesIO, sha256 hex digest); body is None for 304.
+        """
+        max_bytes = get_setting('KNOWLEDGE_MAX_FILE_BYTES', 25 * 1024 * 1024)
+        timeout = get_setting('KNOWLEDGE_FETCH_TIMEOUT', 15)
+        deadline = time.monotonic() + timeout
+        
+        with get_http_session().get(url, headers=headers or {}, stream=True, timeout=timeout) as response:
+            if response.status_code == 304:
+                return response, None, None
+            response.raise_for_status()
+            
+            declared = response.headers.get('Content-Length')
+            if declared and declared.isdigit() and int(declared) > max_bytes:
+                raise ValueError(f"File is {declared} bytes, limit is {max_bytes}")
+            
+            body = io.BytesIO()
+            digest = hashlib.sha256()
+            for block in KnowledgeService._iter_blocks(response):
+                if body.tell() + len(block) > max_bytes:
+                    raise ValueError(f"File exceeds the {max_bytes} byte limit")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Download took longer than {timeout}s")
+                body.write(block)
+                digest.update(block)
+            body.seek(0)  # handed on as is: getvalue() would copy the whole file
+            return response, body, digest.hexdigest()
+
+    @staticmethod
+    def _iter_blocks(response, size=64 * 1024):
+        """Body blocks as they arrive, so a slow sender can't stall a caller's deadline checks"""
+        raw = response.raw
+        if not hasattr(raw, 'read1'):
+            # urllib3 1.x: iter_content waits until a whole chunk has arrived, so keep chunks small
+            yield from response.iter_content(chunk_size=4 * 1024)
+            return
+        while True:
+            block = raw.read1(size, decode_content=True)  # whatever one socket read returned
+            if not block:
+                return
+            yield block
+
     @staticmethod
     def extract_text_from_url(url):
         """Extract text from a URL (Supabase storage)"""
         try:
-            response = requests.get(url)
-            response.raise_for_status()
-            
-            # Identify file type
-            content_type = response.headers.get('Content-Type', '')
-            file_extension = url.split('.')[-1].lower().split('?')[0] # Remove query params
+            response, body, _ = KnowledgeService.download(url)
+            return "".join(KnowledgeService.iter_text_from_bytes(
+                body, response.headers.get('Content-Type', ''), url
+            ))
+        except Exception as e:
+            print(f"Error extracting text from {url}: {e}")
+            return ""
+
+    @staticmethod
+    def iter_text_from_bytes(body, content_type, url):
+        """Yield the text of a downloaded file body (a BytesIO) page by page (or paragraph / block)"""
+        # Identify file type
+        file_extension = url.split('.')[-1].lower().split('?')[0] # Remove query params
+        
+        if ('pdf' in content_type or file_extension == 'pdf') and PYPDF_AVAILABLE:
+            reader = PdfReader(body)
+            for page in reader.pages:
+                yield (page.extract_text() or "") + "\n"
+        
+        elif ('word' in content_type or file_extension in ['doc', 'docx']) and DOCX_AVAILABLE:
+            doc = Document(body)
+            for para in doc.paragraphs:
+                yield para.text + "\n"
+        
+        else:
+            if not PYPDF_AVAILABLE or not DOCX_AVAILABLE:
+                yield "[Neural Knowledge Processor Installing... Basic Text Extraction Only]\n"
+            # Assume text/plain or similar, decoded incrementally
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+            view = body.getbuffer()
+            for i in range(0, len(view), 64 * 1024):
+                yield decoder.decode(view[i:i + 64 * 1024])
+            yield decoder.decode(b'', final=True)
+
+    @staticmethod
+    def ingest_file(url):
+        """
+        Ingest a single uploaded file through the document store and return its content hash.
+        Text is extracted once per content hash; later calls revalidate with
+        ETag/Last-Modified and only re-extract when the source has changed.
+        """
+        record = DocumentStore.get_meta(url)
+        if DocumentStore.is_fresh(record):
+            return record['content_hash']
+        
+        try:
+            headers = {}
+            if record:
+                if record.get('etag'): headers['If-None-Match'] = record['etag']
+                if record.get('last_modified'): headers['If-Modified-Since'] = record['last_modified']
             
-            text = ""
+            response, body, content_hash = KnowledgeService.download(url, headers)
             
-            if ('pdf' in content_type or file_extension == 'pdf') and PYPDF_AVAILABLE:
-                reader = PdfReader(io.BytesIO(response.content))
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
+            if body is None:
+                if not record:
+                    raise ValueError("304 Not Modified without a cached copy")
+                DocumentStore.touch(url)
+                return record['content_hash']
             
-            elif ('word' in content_type or file_extension in ['doc', 'docx']) and DOCX_AVAILABLE:
-                doc = Document(io.BytesIO(response.content))
-                for para in doc.paragraphs:
-                    text += para.text + "\n"
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
             
-            elif not PYPDF_AVAILABLE or not DOCX_AVAILABLE:
-                text = "[Neural Knowledge Processor Installing... Basic Text Extraction Only]\n"
-                text += response.content.decode('utf-8', errors='ignore')
+            # Same bytes (server ignored the validators, or file re-uploaded under a new URL)
+            if DocumentStore.has_text(content_hash):
+                DocumentStore.save(url, content_hash, etag=etag, last_modified=last_modified)
+                return content_hash
             
-            else:
-                # Assume text/plain or similar
-                text = response.content.decode('utf-8', errors='ignore')
-                
-            return text
+            pages = KnowledgeService.iter_text_from_bytes(
+                body, response.headers.get('Content-Type', ''), url
+            )
+            DocumentStore.save(url, content_hash, text=pages, etag=etag, last_modified=last_modified)
+            return content_hash
         except Exception as e:
-            print(f"Error extracting text from {url}: {e}")
-            return ""
+            print(f"Error ingesting {url}: {e}")
+            # Serve the last good extraction rather than nothing
+            return record['content_hash'] if record else None
 
     @staticmethod
-    def get_relevant_context(persona, query, top_n=3):
+    def load_file_text(url):
+        """Extracted text of an uploaded file, served from the document store"""
+        content_hash = KnowledgeService.ingest_file(url)
+        return DocumentStore.read_text(content_hash) if content_hash else ""
+
+    @classmethod
+    def _fetch_pool(cls):
+        with cls._fetch_pool_lock:
+            if cls._fetch_executor is None:
+                cls._fetch_executor = ThreadPoolExecutor(
+                    max_workers=get_setting('KNOWLEDGE_FETCH_WORKERS', 8),
+                    thread_name_prefix='knowledge-fetch'
+                )
+            return cls._fetch_executor
+
+    @classmethod
+    def ingest_files(cls, persona):
         """
-        Gathers context from data_dump, life_data, and uploaded files.
-        Simple keyword/relevance ranking for now.
+        Pre-extract every uploaded file of a persona into the document store.
+        Files needing a network round-trip are fetched concurrently; a failed file
+        is skipped so the others still contribute context.
         """
-        potential_sources = []
+        files = [f for f in (persona.get('uploaded_files') or []) if f.get('url')]
+        hashes = [None] * len(files)
         
-        # 1. Add Data Dump
-        if persona.get('data_dump'):
-            potential_sources.append({
-                'source': 'Deep Knowledge Base',
-                'content': persona['data_dump']
-            })
+        # Fresh cache entries resolve without touching the network
+        stale = []
+        for i, file_item in enumerate(files):
+            record = DocumentStore.get_meta(file_item['url'])
+            if DocumentStore.is_fresh(record):
+                hashes[i] = record['content_hash']
+            else:
+                stale.append(i)
+        
+        if len(stale) == 1:
+            hashes[stale[0]] = cls.ingest_file(files[stale[0]]['url'])
+        elif stale:
+            ingest = bind_app_context(cls.ingest_file)
+            futures = {cls._fetch_pool().submit(ingest, files[i]['url']): i for i in stale}
+            for future, i in futures.items():
+                try:
+                    hashes[i] = future.result()
+                except Exception as e:
+                    print(f"Error ingesting {files[i]['url']}: {e}")
+        
+        ingested = []
+        for file_item, content_hash in zip(files, hashes):
+            if content_hash:
+                ingested.append({
+                    'url': file_item['url'],
+                    'source': f"File: {file_item.get('name', 'Attachment')}",
+                    'content_hash': content_hash
+                })
+        return ingested
+
+    @staticmethod
+    def _iter_segments(pieces, max_size):
+        """Yield sentence/line segments from a stream of text pieces, buffering only the open tail"""
+        buffer = ""
+        for piece in pieces:
+            buffer += piece
+            pos = 0
+            for match in SEGMENT_END.finditer(buffer):
+                if match.end() == len(buffer):
+                    break # the boundary may continue into the next piece
+                yield buffer[pos:match.end()]
+                pos = match.end()
+            buffer = buffer[pos:]
+            while len(buffer) > max_size:
+                cut = buffer.rfind(' ', 0, max_size)
+                cut = cut if cut > 0 else max_size
+                yield buffer[:cut]
+                buffer = buffer[cut:]
+        if buffer:
+            yield buffer
+
+    @classmethod
+    def iter_chunks(cls, pieces, target=800, max_size=1000, min_size=200):
+        """
+        Split a stream of text pieces into content-defined chunks.
+        A chunk closes on a segment whose hash hits the boundary condition (or at `target`
+        chars), so an edit only changes the chunks around it and later boundaries re-align.
+        """
+        chunk = []
+        size = 0
+        for segment in cls._iter_segments(pieces, max_size):
+            if size and size + len(segment) > max_size:
+                text = "".join(chunk).strip()
+                if text: yield text
+                chunk, size = [], 0
             
-        # 2. Add Life Data
-        if persona.get('life_data'):
-            potential_sources.append({
-                'source': 'Personal Life Records',
-                'content': persona['life_data']
-            })
+            chunk.append(segment)
+            size += len(segment)
             
-        # 3. Add Uploaded Files (Process on the fly for small files)
-        if persona.get('uploaded_files'):
-            for file_item in persona['uploaded_files']:
-                try:
-                    # In a high-traffic app, we'd pre-extract this.
-                    # For now, we extract context on-the-fly.
-                    file_text = KnowledgeService.extract_text_from_url(file_item['url'])
-                    if file_text:
-                        potential_sources.append({
-                            'source': f"File: {file_item.get('name', 'Attachment')}",
-                            'content': file_text
-                        })
-                except: continue
-        
-        # Build searching logic
+            if size >= min_size and (size >= target or zlib.crc32(segment.encode('utf-8')) % 4 == 0):
+                text = "".join(chunk).strip()
+                if text: yield text
+                chunk, size = [], 0
+        
+        text = "".join(chunk).strip()
+        if text: yield text
+
+    @staticmethod
+    def _sources(persona, files):
+        """(key, label, source hash, piece iterator factory) for every knowledge source"""
+        sources = []
+        
+        # 1. Data Dump, 2. Life Data
+        for field, label in (('data_dump', 'Deep Knowledge Base'), ('life_data', 'Personal Life Records')):
+            text = persona.get(field)
+            if text:
+                source_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
+                sources.append((field, label, source_hash, lambda text=text: [text]))
+        
+        # 3. Uploaded Files (streamed from the document store, extracted once per version)
+        for f in files:
+            sources.append((
+                f"file:{f['url']}", f['source'], f['content_hash'],
+                lambda content_hash=f['content_hash']: DocumentStore.iter_text(content_hash)
+            ))
+        return sources
+
+    @classmethod
+    def get_index(cls, persona):
+        """
+        Return the BM25 index over a persona's data_dump, life_data and extracted files.
+        The index is cached per persona and updated in place: unchanged sources are skipped
+        by hash, and a changed source only re-indexes the chunks whose fingerprint differs.
+        """
+        files = cls.ingest_files(persona)
+        sources = cls._sources(persona, files)
+        version = hashlib.sha1(
+            "|".join(f"{key}:{source_hash}" for key, _, source_hash, _ in sources).encode('utf-8')
+        ).hexdigest()
+        cache_key = persona.get('id') or version
+        
+        with cls._index_lock:
+            index = cls._indexes.get(cache_key)
+            if index is None:
+                index = cls._indexes[cache_key] = BM25Index()
+            cls._indexes.move_to_end(cache_key)
+            while len(cls._indexes) > get_setting('KNOWLEDGE_INDEX_CACHE_SIZE', 64):
+                cls._indexes.popitem(last=False)
+        
+        if index.version == version:
+            return index
+        
+        with index.lock:
+            if index.version != version:
+                live_keys = set()
+                for key, label, source_hash, pieces in sources:
+                    live_keys.add(key)
+                    index.sync_source(key, label, source_hash, cls.iter_chunks(pieces()))
+                for key in list(index.sources):
+                    if key not in live_keys:
+                        index.drop_source(key)
+                index.compact()
+                index.version = version
+                index.revision += 1
+        return index
+
+    @classmethod
+    def get_knowledge_version(cls, persona):
+        """Content hash of all of a persona's knowledge sources, for keying downstream caches"""
+        return cls.get_index(persona).version
+
+    @classmethod
+    def get_relevant_context(cls, persona, query, top_n=3, mode=None):
+        """
+        Gathers context from data_dump, life_data, and uploaded files.
+        mode: 'keyword' (BM25), 'semantic' (local dense vectors) or 'hybrid' (rank fusion of both).
+        Defaults to KNOWLEDGE_RETRIEVAL_MODE.
+        """
+        mode = mode or get_setting('KNOWLEDGE_RETRIEVAL_MODE', 'keyword')
+        if mode != 'keyword' and not NUMPY_AVAILABLE:
+            mode = 'keyword'
+        
+        index = cls.get_index(persona)
+        
+        if mode == 'keyword':
+            ranked = index.search(query, top_n)
+        else:
+            with index.lock:
+                matrix = VectorStore.get_matrix(persona.get('id') or index.version, index.version, index.docs)
+            semantic = VectorStore.search(matrix, query, top_n if mode == 'semantic' else top_n * 3)
+            ranked = semantic if mode == 'semantic' else cls._fuse([index.search(query, top_n * 3), semantic], top_n)
+        
         relevant_snippets = []
-        for src in potential_sources:
-            # Split into chunks of ~800 chars
-            chunks = [src['content'][i:i+1000] for i in range(0, len(src['content']), 800)]
-            
-            # Simple keyword match scoring
-            query_words = set(query.lower().split())
-            for chunk in chunks:
-                # Count matching keywords
-                score = sum(1 for word in query_words if word in chunk.lower())
-                
-                # Boost score if multiple unique keywords match
-                if score > 0:
-                    relevant_snippets.append({
-                        'source': src['source'],
-                        'content': chunk.strip(),
-                        'score': score
-                    })
-        
-        # Sort by score and return top
-        relevant_snippets.sort(key=lambda x: x['score'], reverse=True)
-        return relevant_snippets[:top_n]
+        for doc_id, score in ranked[:top_n]:
+            doc = index.docs[doc_id] if doc_id < len(index.docs) else None
+            if doc is None:
+                continue
+            relevant_snippets.append({
+                'source': doc['source'],
+                'content': doc['content'],
+                'score': round(score, 4)
+            })
+        return relevant_snippets
+
+    @staticmethod
+    def _fuse(rankings, top_n):
+        """Reciprocal rank fusion of several (doc_id, score) rankings"""
+        fused = {}
+        for ranking in rankings:
+            for rank, (doc_id, _) in enumerate(ranking):
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (60 + rank)
+        return sorted(fused.items(), key=lambda x: x[1], reverse=True)[:top_n]
@@ -0,0 +1,178 @@
+"""
+Learned Knowledge Service for EMRYS
+Batched extraction of facts about the user from conversation turns, deduplicated and stored
+in persona_knowledge, then fed back into the persona's prompt as learned knowledge.
+Facts are scoped to (persona, user): a public persona never sees what other users told it.
+"""
+
+import json
+import re
+import threading
+import time
+
+from app.config import Config
+from app.services.search_index import tokenize
+from app.utils.cache import TTLCache
+from app.utils.settings import get_setting
+
+CATEGORIES = ('personal', 'preferences', 'relationships', 'work', 'interests', 'events', 'goals', 'other')
+
+JSON_OBJECT = re.compile(r"\{.*\}", re.DOTALL)
+
+
+def _normalize(text):
+    return " ".join(str(text).lower().split())
+
+
+class LearnedKnowledge:
+    facts = TTLCache(maxsize=Config.LOOKUP_CACHE_SIZE, ttl=Config.LEARNED_FACTS_TTL)
+    _lock = threading.Lock()
+    _buffers = {}  # conversation id -> pending turns awaiting one batched extraction call
+
+    @classmethod
+    def record_turn(cls, conversation_id, user_id, persona, user_message, ai_response):
+        """
+        Buffer one user/persona exchange. Returns a batch to extract once KNOWLEDGE_EXTRACT_BATCH
+        turns have accumulated (or the oldest buffered turn is older than KNOWLEDGE_EXTRACT_MAX_AGE),
+        otherwise None.
+        """
+        now = time.monotonic()
+        key = str(conversation_id)
+        with cls._lock:
+            buffer = cls._buffers.get(key)
+            if buffer is None:
+                if len(cls._buffers) >= get_setting('KNOWLEDGE_EXTRACT_MAX_BUFFERS', 1024):
+                    # Abandoned conversations shouldn't pin memory; their few turns are dropped
+                    cls._buffers.pop(next(iter(cls._buffers)))
+                buffer = cls._buffers[key] = {
+                    'persona_id': persona.get('id'),
+                    'user_id': user_id,
+                    'persona_name': persona.get('name', 'the persona'),
+                    'started': now,
+                    'turns': []
+                }
+            buffer['turns'].append({'user': user_message, 'persona': ai_response})
+
+            full = len(buffer['turns']) >= get_setting('KNOWLEDGE_EXTRACT_BATCH', 5)
+            stale = now - buffer['started'] >= get_setting('KNOWLEDGE_EXTRACT_MAX_AGE', 900)
+            if not (full or stale):
+                return None
+            return cls._buffers.pop(key)
+
+    @staticmethod
+    def build_extraction_prompt(turns, persona_name):
+        transcript = "\n\n".join(
+            f"User: {turn['user']}\n{persona_name}: {turn['persona']}" for turn in turns
+        )
+        return (
+            f"Below are recent exchanges between a user and {persona_name}.\n\n{transcript}\n\n"
+            "Extract durable facts the USER revealed about themselves (names, relationships, work, "
+            "preferences, plans, important events). Ignore small talk, questions and anything said "
+            f"only by {persona_name}.\n"
+            'Respond with JSON only: {"facts": [{"category": "...", "key": "short label", "value": "the fact"}]}\n'
+            f"category must be one of: {', '.join(CATEGORIES)}. "
+            'Return {"facts": []} if there is nothing worth remembering.'
+        )
+
+    @staticmethod
+    def parse_facts(text):
+        """Facts from the model's JSON reply (tolerates code fences and surrounding prose); None if unparseable"""
+        if not text:
+            return None
+        match = JSON_OBJECT.search(text)
+        try:
+            data = json.loads(match.group(0) if match else text)
+        except ValueError:
+            return None
+        items = data.get('facts', []) if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            return None
+
+        facts = []
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            key = str(item.get('key') or '').strip()
+            value = str(item.get('value') or '').strip()
+            if not key or not value:
+                continue
+            category = _normalize(item.get('category') or 'other')
+            facts.append({
+                'category': category if category in CATEGORIES else 'other',
+                'key': key[:120],
+                'value': value[:500]
+            })
+        return facts
+
+    @classmethod
+    def extract_facts(cls, complete, turns, persona_name='the persona'):
+        """One LLM call for the whole batch. Returns a list of facts, or None if the call failed."""
+        reply = complete(cls.build_extraction_prompt(turns, persona_name))
+        return cls.parse_facts(reply)
+
+    @staticmethod
+    def _scoped(query, persona_id, user_id):
+        return query.eq('persona_id', persona_id).eq('user_id', user_id)
+
+    @classmethod
+    def get_facts(cls, supabase, persona_id, user_id):
+        """Most recent facts a persona learned about this user (cached)"""
+        def load():
+            res = cls._scoped(supabase.table('persona_knowledge').select('*'), persona_id, user_id) \
+                .order('learned_at', desc=True).limit(get_setting('LEARNED_FACTS_LIMIT', 50)).execute()
+            return res.data or []
+        return cls.facts.get_or_load((str(persona_id), str(user_id)), load)
+
+    @classmethod
+    def _existing(cls, supabase, persona_id, user_id):
+        """Every stored fact of this (persona, user) by normalized key (not just the newest LEARNED_FACTS_LIMIT)"""
+        rows = cls._scoped(supabase.table('persona_knowledge').select('id, key, value'), persona_id, user_id) \
+            .execute().data or []
+        return {_normalize(f['key']): f for f in rows}
+
+    @staticmethod
+    def _same_value(a, b):
+        if _normalize(a) == _normalize(b):
+            return True
+        tokens_a, tokens_b = set(tokenize(a)), set(tokenize(b))
+        if not tokens_a or not tokens_b:
+            return False
+        return len(tokens_a & tokens_b) / len(tokens_a | tokens_b) >= 0.8
+
+    @classmethod
+    def save_facts(cls, supabase, persona_id, user_id, facts, source='conversation'):
+        """
+        Deduplicate against the user's stored facts (same key: skip if the value matches, update it
+        if it changed) and insert the rest in one request. Returns (inserted, updated) counts.
+        """
+        if not facts:
+            return 0, 0
+
+        existing = cls._existing(supabase, persona_id, user_id)
+        inserts, updated = {}, 0
+        for fact in facts:
+            key = _normalize(fact['key'])
+            current = existing.get(key)
+            if current is not None:
+                if cls._same_value(current.get('value', ''), fact['value']):
+                    continue
+                supabase.table('persona_knowledge').update({
+                    'value': fact['value'],
+                    'category': fact['category'],
+                    'source': source
+                }).eq('id', current['id']).execute()
+                current['value'] = fact['value']
+                updated += 1
+            elif key not in inserts:
+                inserts[key] = {'persona_id': persona_id, 'user_id': user_id, 'source': source, **fact}
+
+        if inserts:
+            supabase.table('persona_knowledge').insert(list(inserts.values())).execute()
+        if inserts or updated:
+            cls.facts.invalidate((str(persona_id), str(user_id)))
+        return len(inserts), updated
+
+    @staticmethod
+    def format_for_prompt(facts):
+        """Prompt lines for stored facts, newest first"""
+        return [f"- [{f.get('category', 'other')}] {f['key']}: {f['value']}" for f in facts if f.get('key') and f.get('value')]
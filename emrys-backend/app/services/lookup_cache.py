@@ -0,0 +1,90 @@
+"""
+Lookup Cache for EMRYS
+Read-through caching of persona rows, conversation records and hub memberships, which
+chat turns would otherwise re-select from Supabase on every message.
+"""
+
+from app.config import Config
+from app.utils.cache import TTLCache
+
+
+class LookupCache:
+    personas = TTLCache(maxsize=Config.LOOKUP_CACHE_SIZE, ttl=Config.PERSONA_CACHE_TTL)
+    conversations = TTLCache(maxsize=Config.LOOKUP_CACHE_SIZE * 4, ttl=Config.CONVERSATION_CACHE_TTL)
+    groups = TTLCache(maxsize=Config.LOOKUP_CACHE_SIZE, ttl=Config.GROUP_CACHE_TTL)
+    _persona_groups = {}  # persona id -> ids of cached groups it is a member of
+
+    @classmethod
+    def get_persona(cls, supabase, persona_id):
+        """Full persona row, or None if it does not exist (misses are not cached)"""
+        def load():
+            return supabase.table('personas').select('*').eq('id', persona_id).single().execute().data
+        return cls.personas.get_or_load(str(persona_id), load)
+
+    @classmethod
+    def get_conversation(cls, supabase, user_id, persona_id=None, group_id=None):
+        """
+        The user's conversation with a persona (or hub), created on first use.
+        Returns None if it could not be created.
+        """
+        column, target_id = ('group_id', group_id) if group_id else ('persona_id', persona_id)
+        key = (str(user_id), column, str(target_id))
+
+        def load():
+            conv_res = supabase.table('conversations').select('*').eq('user_id', user_id).eq(column, target_id).execute()
+            if conv_res.data:
+                return conv_res.data[0]
+            insert_res = supabase.table('conversations').insert({'user_id': user_id, column: target_id}).execute()
+            return insert_res.data[0] if insert_res.data else None
+
+        return cls.conversations.get_or_load(key, load)
+
+    @classmethod
+    def get_group(cls, supabase, group_id):
+        """
+        Hub row with its member personas flattened into group['personas'] (member order),
+        or None if it does not exist.
+        """
+        def load():
+            group = supabase.table('groups').select('*, group_members(persona_id, personas(*))').eq('id', group_id).single().execute().data
+            if not group:
+                return None
+            personas = []
+            for m in group.get('group_members') or []:
+                if isinstance(m, dict) and m.get('personas'):
+                    # Ensure the persona object has the id from the member record if missing
+                    p = m['personas']
+                    if not p.get('id'): p['id'] = m.get('persona_id')
+                    personas.append(p)
+            group['personas'] = personas
+            for p in personas:
+                cls._persona_groups.setdefault(str(p['id']), set()).add(str(group_id))
+            return group
+        return cls.groups.get_or_load(str(group_id), load)
+
+    @classmethod
+    def invalidate_group(cls, group_id):
+        """Call whenever a hub is edited or its group_members change"""
+        cls.groups.invalidate(str(group_id))
+
+    @classmethod
+    def invalidate_persona(cls, persona_id):
+        """Call whenever a persona row is edited or deleted"""
+        cls.personas.invalidate(str(persona_id))
+        cls.conversations.invalidate_where(lambda key: key[1] == 'persona_id' and key[2] == str(persona_id))
+        # Hubs embed their members' rows (names drive mention routing)
+        for group_id in cls._persona_groups.pop(str(persona_id), ()):
+            cls.groups.invalidate(group_id)
+
+    @classmethod
+    def invalidate_conversation(cls, user_id, persona_id=None, group_id=None):
+        column, target_id = ('group_id', group_id) if group_id else ('persona_id', persona_id)
+        cls.conversations.invalidate((str(user_id), column, str(target_id)))
+
+    @classmethod
+    def stats(cls):
+        return {
+            'personas': cls.personas.stats(),
+            'conversations': cls.conversations.stats(),
+            'groups': cls.groups.stats()
+        }
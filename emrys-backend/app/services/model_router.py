@@ -0,0 +1,225 @@
+"""
+Model Router for EMRYS
+Per API key, per model circuit breakers with Retry-After driven cooldowns and rolling
+latency stats, so fallback chains go straight to the healthiest, fastest model instead of
+paying a failed round-trip to a quota-exhausted or missing model on every message.
+"""
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+from app.utils.settings import get_setting
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+# Failure kinds, as classified by the services
+RATE_LIMITED = 'rate_limited'   # 429 / quota: back off for Retry-After (or an exponential cooldown)
+MISSING = 'missing'             # 404 / unknown model: park it for a long time
+ERROR = 'error'                 # anything else: open after MODEL_BREAKER_THRESHOLD in a row
+CLIENT = 'client'               # bad key / blocked request: no other model will do better, breaker untouched
+
+RETRY_DELAY_PATTERNS = [
+    re.compile(r"retry[_ ]delay\s*\{\s*seconds:\s*(\d+)", re.IGNORECASE),
+    re.compile(r"retry (?:in|after) (\d+(?:\.\d+)?)\s*s", re.IGNORECASE),
+]
+
+
+class ModelUnavailable(RuntimeError):
+    """This model failed in a way another model in the chain might not"""
+
+
+def classify_status(status_code):
+    """Failure kind of a provider HTTP status"""
+    if status_code == 429:
+        return RATE_LIMITED
+    if status_code == 404:
+        return MISSING
+    if status_code in (400, 401, 402, 403):
+        return CLIENT
+    return ERROR
+
+
+def classify_error(message):
+    """Failure kind of a provider error message"""
+    text = message.lower()
+    if 'api key' in text or 'permission' in text or 'blocked' in text or 'safety' in text:
+        return CLIENT
+    if '429' in text or 'quota' in text or 'rate limit' in text or 'resource exhausted' in text:
+        return RATE_LIMITED
+    if '404' in text or 'not found' in text or 'not supported' in text:
+        return MISSING
+    return ERROR
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds form), else None"""
+    try:
+        return max(0.0, float(str(value).strip()))
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay_from_message(message):
+    """Seconds from a 'retry_delay { seconds: 12 }' / 'retry in 12s' style error message, else None"""
+    for pattern in RETRY_DELAY_PATTERNS:
+        match = pattern.search(message)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class ModelHealth:
+    def __init__(self, window):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_count = 0            # consecutive times opened, for exponential cooldowns
+        self.open_until = 0.0
+        self.probing_since = None      # a half-open trial request is in flight (monotonic start)
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self.last_error = None
+
+    def latency_percentile(self, percentile):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(percentile * len(ordered)))]
+
+    def median_latency(self):
+        return self.latency_percentile(0.5)
+
+    def snapshot(self, now):
+        median = self.median_latency()
+        return {
+            'state': self.state,
+            'retry_in': round(max(0.0, self.open_until - now), 1) if self.state == OPEN else 0,
+            'consecutive_failures': self.consecutive_failures,
+            'successes': self.successes,
+            'failures': self.failures,
+            'median_latency_ms': round(median * 1000) if median is not None else None,
+            'samples': len(self.latencies),
+            'last_error': self.last_error
+        }
+
+
+class ModelRouter:
+    _lock = threading.Lock()
+    _health = OrderedDict()  # (key fingerprint, model) -> ModelHealth, least recently used first
+
+    @staticmethod
+    def _fingerprint(api_key):
+        # Never keep raw keys in memory longer than the request (or show them on /health)
+        return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:12]
+
+    @classmethod
+    def _get(cls, api_key, model):
+        key = (cls._fingerprint(api_key), model)
+        health = cls._health.get(key)
+        if health is None:
+            health = cls._health[key] = ModelHealth(get_setting('MODEL_LATENCY_WINDOW', 20))
+            while len(cls._health) > get_setting('MODEL_ROUTER_MAX_ENTRIES', 2048):
+                cls._health.popitem(last=False)
+        else:
+            cls._health.move_to_end(key)
+        return health
+
+    @classmethod
+    def order(cls, api_key, models):
+        """
+        Models worth trying, best first: closed breakers by median latency (unmeasured ones in
+        their configured order after measured ones), then at most one half-open trial.
+        If every breaker is open, only the model that reopens soonest is returned.
+        """
+        now = time.monotonic()
+        available, probes, parked = [], [], []
+        with cls._lock:
+            for index, model in enumerate(models):
+                health = cls._get(api_key, model)
+                if health.state == OPEN and now >= health.open_until:
+                    health.state = HALF_OPEN
+                    health.probing_since = None
+                if health.state == CLOSED:
+                    median = health.median_latency()
+                    available.append((median is None, median or 0.0, index, model))
+                elif health.state == HALF_OPEN and (
+                    health.probing_since is None or now - health.probing_since > get_setting('MODEL_PROBE_TIMEOUT', 60)
+                ):
+                    # No trial in flight (or the last one was never reported back, e.g. an earlier model answered)
+                    probes.append(model)
+                else:
+                    parked.append((health.open_until, model))
+
+            ordered = [model for *_, model in sorted(available)]
+            if probes:
+                # One request at a time tests a recovering model
+                cls._get(api_key, probes[0]).probing_since = now
+                ordered.append(probes[0])
+            if not ordered and parked:
+                ordered.append(min(parked)[1])
+        return ordered
+
+    @classmethod
+    def record_success(cls, api_key, model, latency):
+        with cls._lock:
+            health = cls._get(api_key, model)
+            health.state = CLOSED
+            health.consecutive_failures = 0
+            health.open_count = 0
+            health.probing_since = None
+            health.successes += 1
+            health.latencies.append(latency)
+
+    @classmethod
+    def record_failure(cls, api_key, model, error, kind=None, retry_after=None):
+        """Count a failed call; returns the failure kind so callers can decide whether to fall back"""
+        kind = kind or classify_error(str(error))
+        if retry_after is None:
+            retry_after = retry_delay_from_message(str(error))
+
+        with cls._lock:
+            health = cls._get(api_key, model)
+            health.failures += 1
+            health.consecutive_failures += 1
+            health.probing_since = None
+            health.last_error = str(error)[:200]
+
+            if kind == CLIENT:
+                health.consecutive_failures -= 1
+                return kind
+            if kind == MISSING:
+                cooldown = get_setting('MODEL_MISSING_COOLDOWN', 3600)
+            elif kind == RATE_LIMITED or health.state == HALF_OPEN \
+                    or health.consecutive_failures >= get_setting('MODEL_BREAKER_THRESHOLD', 3):
+                base = get_setting('MODEL_BREAKER_COOLDOWN', 30)
+                cooldown = min(base * (2 ** health.open_count), get_setting('MODEL_BREAKER_MAX_COOLDOWN', 600))
+                if retry_after is not None:
+                    cooldown = retry_after
+            else:
+                return kind
+
+            health.state = OPEN
+            health.open_count += 1
+            health.open_until = time.monotonic() + cooldown
+        return kind
+
+    @classmethod
+    def latency_percentile(cls, api_key, model, percentile):
+        """Observed latency percentile in seconds, or None until HEDGE_MIN_SAMPLES calls succeeded"""
+        with cls._lock:
+            health = cls._get(api_key, model)
+            if len(health.latencies) < get_setting('HEDGE_MIN_SAMPLES', 5):
+                return None
+            return health.latency_percentile(percentile)
+
+    @classmethod
+    def stats(cls):
+        now = time.monotonic()
+        with cls._lock:
+            return {
+                f"{fingerprint}:{model}": health.snapshot(now)
+                for (fingerprint, model), health in cls._health.items()
+            }
@@ -0,0 +1,133 @@
+"""
+Mood Analytics for EMRYS
+Batch "Neural Pulse" timelines. Each page of messages is scored in one pass: a single
+regex scan over the concatenated page fills a NumPy term-document matrix against the mood
+lexicon, a matrix product turns it into per-mood hits, and the same exponential decay
+MoodTracker uses is applied as a vectorized recurrence. Results are folded into time
+buckets page by page, so memory is bounded by the page size and the number of buckets.
+"""
+
+import math
+
+from app.services.keyword_matcher import LEXICON, MOOD_TRIGGERS
+from app.services.sentiment_service import SentimentService
+from app.utils.settings import get_setting
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+MOODS = list(SentimentService.TRIGGERS)
+RESOLUTIONS = {'message': None, 'hour': 13, 'day': 10, 'month': 7}  # created_at prefix length per bucket
+
+# Never part of a match: not a word character, whitespace or hyphen, so phrases can't span two messages
+SEPARATOR = "\x00"
+
+
+def _phrase_moods():
+    """(phrases x moods) 0/1 matrix: which moods each lexicon phrase counts for"""
+    matrix = np.zeros((len(LEXICON.phrases), len(MOODS)), dtype=np.float32)
+    for index, categories in enumerate(LEXICON.categories):
+        for category in categories:
+            if category in MOOD_TRIGGERS:
+                matrix[index, MOODS.index(category)] = 1.0
+    return matrix
+
+
+class MoodAnalytics:
+    _phrase_moods = None
+
+    @classmethod
+    def score(cls, texts):
+        """(messages x moods) distinct trigger phrases per mood, same as SentimentService.score"""
+        if cls._phrase_moods is None:
+            cls._phrase_moods = _phrase_moods()
+        texts = [t or '' for t in texts]
+        if not texts:
+            return np.zeros((0, len(MOODS)), dtype=np.float32)
+
+        starts = np.cumsum([0] + [len(t) + len(SEPARATOR) for t in texts[:-1]])
+        spans = list(LEXICON.spans(SEPARATOR.join(texts)))
+        tdm = np.zeros((len(texts), len(LEXICON.phrases)), dtype=np.float32)
+        if spans:
+            offsets, phrases = np.array(spans, dtype=np.int64).T
+            rows = np.searchsorted(starts, offsets, side='right') - 1
+            tdm[rows, phrases] = 1.0  # presence, not frequency
+        return tdm @ cls._phrase_moods
+
+    @staticmethod
+    def pulse(hits, carry, decay):
+        """
+        s[t] = decay * s[t-1] + hits[t] for every row, starting from `carry` (the state
+        before the first row). Returns (states, last state).
+        """
+        if decay <= 0:
+            return hits.astype(np.float64), hits[-1].astype(np.float64) if len(hits) else carry
+        # Closed form per chunk: s[t] = d^(t+1) carry + d^t * cumsum(hits[j] / d^j); chunks keep d^-j finite
+        chunk = max(1, min(256, int(200 / max(-math.log10(decay), 1e-9))))
+        states = np.empty(hits.shape, dtype=np.float64)
+        for start in range(0, len(hits), chunk):
+            block = hits[start:start + chunk].astype(np.float64)
+            powers = decay ** np.arange(len(block), dtype=np.float64)
+            states[start:start + len(block)] = powers[:, None] * (
+                np.cumsum(block / powers[:, None], axis=0) + decay * carry
+            )
+            carry = states[start + len(block) - 1]
+        return states, carry
+
+    @classmethod
+    def timeline(cls, pages, resolution='day'):
+        """
+        Fold pages of messages (id, conversation_id, created_at, content; each page in
+        created_at order) into a compact series: one entry per bucket with its message count,
+        the mean pulse per mood and the dominant mood.
+        """
+        decay = get_setting('MOOD_DECAY', 0.7)
+        min_score = get_setting('MOOD_MIN_SCORE', 0.5)
+        prefix = RESOLUTIONS[resolution]
+        carries = {}   # conversation id -> pulse after its last scored message
+        buckets = {}   # bucket key -> [message count, summed pulse]
+        total = 0
+
+        for rows in pages:
+            hits = cls.score([r.get('content') for r in rows])
+            conversations = np.array([str(r.get('conversation_id')) for r in rows])
+            states = np.empty(hits.shape, dtype=np.float64)
+            # Each conversation's pulse decays along its own messages only
+            for conversation in dict.fromkeys(conversations):
+                mask = conversations == conversation
+                carry = carries.get(conversation, np.zeros(len(MOODS)))
+                states[mask], carries[conversation] = cls.pulse(hits[mask], carry, decay)
+
+            stamps = [str(r.get('created_at') or '') for r in rows]
+            if prefix is None:
+                keys = np.array([f"{s}|{r.get('id')}" for s, r in zip(stamps, rows)])
+            else:
+                keys = np.array([s[:prefix] for s in stamps])
+            unique, inverse = np.unique(keys, return_inverse=True)
+            sums = np.zeros((len(unique), len(MOODS)), dtype=np.float64)
+            np.add.at(sums, inverse, states)
+            counts = np.bincount(inverse, minlength=len(unique))
+            for key, count, summed in zip(unique.tolist(), counts.tolist(), sums):
+                entry = buckets.setdefault(key, [0, np.zeros(len(MOODS))])
+                entry[0] += count
+                entry[1] += summed
+            total += len(rows)
+
+        ordered = sorted(buckets)
+        means = np.array([buckets[k][1] / buckets[k][0] for k in ordered]).reshape(-1, len(MOODS))
+        best = means.argmax(axis=1) if len(ordered) else np.zeros(0, dtype=np.int64)
+        strongest = means.max(axis=1) if len(ordered) else np.zeros(0)
+        return {
+            'resolution': resolution,
+            'moods': MOODS,
+            'messages': total,
+            'series': {
+                't': [k.split('|')[0] for k in ordered],
+                'count': [buckets[k][0] for k in ordered],
+                'pulse': np.round(means, 3).tolist(),
+                'mood': [MOODS[i] if s >= min_score else 'default' for i, s in zip(best.tolist(), strongest.tolist())]
+            }
+        }
@@ -0,0 +1,139 @@
+"""
+Mood State for EMRYS
+Per-conversation mood scores (and per persona within a hub), updated once per message
+with exponential decay and stored on the conversation row, so every worker carries the
+same mood forward. Reading the current mood is a lookup instead of a rescan of recent
+history, and it reflects the whole conversation rather than only the last three messages.
+"""
+
+import copy
+
+from app.config import Config
+from app.services.sentiment_service import SentimentService
+from app.utils.cache import TTLCache
+from app.utils.settings import get_setting
+from app.utils.supabase_pool import get_supabase
+
+
+def _empty():
+    return {'scores': {}, 'messages': 0}
+
+
+class MoodTracker:
+    # conversation id -> (state, mood_messages); short-lived hot copies of the rows
+    _states = TTLCache(maxsize=Config.LOOKUP_CACHE_SIZE, ttl=Config.CONVERSATION_STATE_TTL)
+    SAVE_ATTEMPTS = 3
+
+    @classmethod
+    def _load(cls, supabase, conversation_id):
+        """(state or None, version) where version is the row's mood_messages"""
+        key = str(conversation_id)
+        cached = cls._states.get(key)
+        if cached is None:
+            rows = supabase.table('conversations').select('mood_state, mood_messages') \
+                .eq('id', conversation_id).limit(1).execute().data or []
+            row = rows[0] if rows else {}
+            cached = (row.get('mood_state'), row.get('mood_messages') or 0)
+            cls._states.set(key, cached)
+        # Callers fold messages into their own copy
+        return copy.deepcopy(cached[0]), cached[1]
+
+    @classmethod
+    def _save(cls, supabase, conversation_id, version, state):
+        """
+        Write the state only if no other message was folded in since it was read (the
+        message count only grows, so it doubles as the row's version). Returns True if written.
+        """
+        key = str(conversation_id)
+        res = supabase.table('conversations').update({
+            'mood_state': state,
+            'mood_messages': state['messages']
+        }).eq('id', conversation_id).eq('mood_messages', version).execute()
+        if not res.data:
+            cls._states.invalidate(key)
+            return False
+        cls._states.set(key, (copy.deepcopy(state), state['messages']))
+        return True
+
+    @staticmethod
+    def _apply(entry, hits, decay):
+        # O(number of moods): fade what was there, add this message's evidence
+        scores = entry['scores']
+        for mood in list(scores):
+            scores[mood] *= decay
+            if scores[mood] < 0.01:
+                del scores[mood]
+        for mood, count in hits.items():
+            scores[mood] = scores.get(mood, 0.0) + count
+        entry['messages'] += 1
+
+    @classmethod
+    def _record(cls, state, text, persona_id, decay):
+        hits = SentimentService.score(text or '')
+        cls._apply(state, hits, decay)
+        if persona_id:
+            cls._apply(state.setdefault('personas', {}).setdefault(str(persona_id), _empty()), hits, decay)
+
+    @classmethod
+    def _state(cls, supabase, conversation_id, history, decay):
+        """
+        (state, version): the stored state, or one replayed from `history` (messages before
+        the current one) for conversations that have none yet
+        """
+        state, version = cls._load(supabase, conversation_id)
+        if state is None:
+            state = dict(_empty(), personas={})
+            for msg in history or []:
+                persona_id = msg.get('persona_id') if msg.get('sender_type') == 'persona' else None
+                cls._record(state, msg.get('content'), persona_id, decay)
+        return state, version
+
+    @staticmethod
+    def _current(state, persona_id=None):
+        scores = dict(state['scores'])
+        persona = state.get('personas', {}).get(str(persona_id)) if persona_id else None
+        if persona:
+            # A hub persona leans on its own recent replies on top of the room's mood
+            for mood, score in persona['scores'].items():
+                scores[mood] = scores.get(mood, 0.0) + score
+        return SentimentService.pick(scores, state['messages'], get_setting('MOOD_MIN_SCORE', 0.5))
+
+    @classmethod
+    def observe(cls, conversation_id, text, persona_id=None, history=None):
+        """
+        Fold one new message into the conversation's mood (and its persona's, for hub replies)
+        and return the resulting mood. `history` seeds conversations that have no state yet.
+        A write that races another worker's is retried on top of theirs.
+        """
+        decay = get_setting('MOOD_DECAY', 0.7)
+        try:
+            supabase = get_supabase()
+            for _ in range(cls.SAVE_ATTEMPTS):
+                state, version = cls._state(supabase, conversation_id, history, decay)
+                cls._record(state, text, persona_id, decay)
+                if cls._save(supabase, conversation_id, version, state):
+                    break
+            else:
+                print(f"Mood state for conversation {conversation_id} kept changing, message not folded in")
+            return cls._current(state, persona_id)
+        except Exception as e:
+            print(f"Mood state error for conversation {conversation_id}: {str(e)}")
+            return None
+
+    @classmethod
+    def current(cls, conversation_id, persona_id=None, history=None):
+        """The conversation's mood (as a hub persona sees it, if persona_id is given) without changing it"""
+        try:
+            state, _ = cls._state(get_supabase(), conversation_id, history, get_setting('MOOD_DECAY', 0.7))
+        except Exception as e:
+            print(f"Mood state error for conversation {conversation_id}: {str(e)}")
+            return None
+        return cls._current(state, persona_id)
+
+    @classmethod
+    def forget(cls, conversation_id, supabase=None):
+        """Drop the mood, e.g. after the conversation's messages were wiped"""
+        cls._states.invalidate(str(conversation_id))
+        (supabase or get_supabase()).table('conversations').update({
+            'mood_state': None, 'mood_messages': 0
+        }).eq('id', conversation_id).execute()
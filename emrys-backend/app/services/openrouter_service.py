@@ -6,7 +6,14 @@ Handles AI chat interactions with advanced personality modeling, deep memory RAG
 import requests
 import json
 import re
+import time
 from flask import current_app
+from app.services.prompt_assembler import PreambleCache, PromptAssembler
+from app.services.model_router import ModelRouter, ModelUnavailable, classify_status, parse_retry_after, CLIENT
+from app.services.hedging import hedge_delays, race
+from app.services.keyword_matcher import RESTRICTED_TOPICS
+from app.services.safety_service import SafetyService
+from app.services.learned_knowledge import LearnedKnowledge
 
 class OpenRouterService:
     BASE_URL = "https://openrouter.ai/api/v1/chat/completions"
@@ -18,15 +25,17 @@ class OpenRouterService:
         'free': 'google/gemma-7b-it:free'
     }
     
+    # Tiers resolved at request time to the healthiest, fastest model of their chain
+    MODEL_CHAINS = {
+        'balanced': ['openai/gpt-3.5-turbo', 'openai/gpt-4o-mini', 'anthropic/claude-3-haiku'],
+        'fast': ['openai/gpt-3.5-turbo', 'openai/gpt-4o-mini', 'google/gemini-flash-1.5']
+    }
+    
+    # Models that only reuse a cached prompt prefix when it is marked with cache_control
+    CACHE_CONTROL_PREFIXES = ('anthropic/', 'google/gemini')
+    
     # Restricted topics for safety
-    RESTRICTED_TOPICS = [
-        'medical diagnosis', 'medical treatment', 'prescription',
-        'legal advice', 'legal representation',
-        'financial investment advice', 'stock tips',
-        'self-harm', 'suicide',
-        'illegal activities',
-        'confidential information disclosure'
-    ]
+    RESTRICTED_TOPICS = RESTRICTED_TOPICS
     
     SAFETY_SYSTEM_PROMPT = """
     IMPORTANT SAFETY BOUNDARIES:
@@ -41,81 +50,96 @@ class OpenRouterService:
     def __init__(self, api_key=None):
         raw_key = api_key or current_app.config.get('OPENROUTER_API_KEY')
         self.api_key = raw_key.strip() if raw_key else None
+        self.last_prompt_report = None
     
     def check_safety(self, message):
-        """Check if message contains restricted topics"""
-        message_lower = message.lower()
-        for topic in self.RESTRICTED_TOPICS:
-            if topic in message_lower:
-                return False, f"I appreciate your trust, but I can't provide advice on {topic}. Please consult with a qualified professional for this matter."
-        return True, None
+        """Check if message contains restricted topics (chat routes run this as a pipeline stage)"""
+        return SafetyService.check(message)
     
-    def build_ultra_realistic_prompt(self, persona, learned_knowledge=None, relevant_memories=None, current_mood=None):
+    BANNER = "━" * 40
+
+    def _banner(self, title):
+        return f"{self.BANNER}\n{title}\n{self.BANNER}"
+
+    def _add_preamble_sections(self, assembler, persona, current_mood=None):
         """
         Build the MOST COMPREHENSIVE system prompt possible
         This creates personas that are INDISTINGUISHABLE from real people
         """
-        prompt = f"{self.SAFETY_SYSTEM_PROMPT}\n\n"
-        prompt += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-        prompt += "WHO YOU ARE\n"
-        prompt += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        prompt += f"You are {persona.get('name', 'Unknown')}"
+        assembler.add('safety', self.SAFETY_SYSTEM_PROMPT.strip())
         
-        if persona.get('age'): prompt += f", {persona['age']} years old"
-        if persona.get('occupation'): prompt += f", working as a {persona['occupation']}"
-        if persona.get('location'): prompt += f", living in {persona['location']}"
-        prompt += ".\n\n"
+        identity = [f"You are {persona.get('name', 'Unknown')}"]
+        if persona.get('age'): identity.append(f", {persona['age']} years old")
+        if persona.get('occupation'): identity.append(f", working as a {persona['occupation']}")
+        if persona.get('location'): identity.append(f", living in {persona['location']}")
+        identity.append(".")
+        assembler.add('identity', "".join(identity), header=self._banner("WHO YOU ARE") + "\n")
         
-        if persona.get('background_story'): prompt += f"YOUR BACKGROUND:\n{persona['background_story']}\n\n"
+        if persona.get('background_story'):
+            assembler.add('background', persona['background_story'], header="YOUR BACKGROUND:")
         
-        # Identity attributes
+        # Identity attributes + NEURAL PULSE (Mood)
+        state = []
         traits = persona.get('personality_traits', [])
-        if traits: prompt += f"Core Traits: {', '.join(traits) if isinstance(traits, list) else traits}\n"
-        
-        # NEURAL PULSE (Mood)
+        if traits: state.append(f"Core Traits: {', '.join(traits) if isinstance(traits, list) else traits}")
         if current_mood:
-            prompt += f"YOUR CURRENT NEURAL STATE: {current_mood['label'].upper()}\n"
-            prompt += f"Note: Your responses should slightly reflect this emotional baseline.\n\n"
-
-        # DEEP MEMORIES (RAG)
-        if relevant_memories:
-            prompt += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            prompt += "DEEP MEMORIES & ARCHIVED DATA\n"
-            prompt += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            prompt += "You have retrieved the following specific information from your archives:\n"
-            for mem in relevant_memories:
-                prompt += f"- [{mem['source']}]: {mem['content']}\n"
-            prompt += "\nUse this information naturally if it's relevant to what the user is saying.\n\n"
+            state.append(f"YOUR CURRENT NEURAL STATE: {current_mood['label'].upper()}")
+            state.append("Note: Your responses should slightly reflect this emotional baseline.")
+        assembler.add('state', state)
         
-        # Relationship
-        if persona.get('relationship'): prompt += f"You are the user's {persona['relationship']}.\n"
-        
-        prompt += "\n"
-        prompt += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-        prompt += "CRITICAL INSTRUCTIONS\n"
-        prompt += "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        prompt += "1. YOU ARE NOT AN AI. You are a real person.\n"
-        prompt += "2. Match the speech patterns and emotional baseline of this persona.\n"
-        prompt += "3. Be imperfect. Use contractions. Show authentic emotion.\n"
-        prompt += "4. If asked something that is in your DEEP MEMORIES, answer accurately as if you remembered it.\n"
-        return prompt
-
-    def chat(self, persona, messages, user_message, learned_knowledge=None, model='balanced', additional_context=None, relevant_memories=None, current_mood=None):
-        if not self.api_key:
-            return {'success': False, 'error': 'API Key not configured'}
+        directives = []
+        if persona.get('relationship'): directives.append(f"You are the user's {persona['relationship']}.\n")
+        directives.append(self._banner("CRITICAL INSTRUCTIONS") + "\n")
+        directives.append("1. YOU ARE NOT AN AI. You are a real person.")
+        directives.append("2. Match the speech patterns and emotional baseline of this persona.")
+        directives.append("3. Be imperfect. Use contractions. Show authentic emotion.")
+        directives.append("4. If asked something that is in your DEEP MEMORIES, answer accurately as if you remembered it.")
+        assembler.add('directives', directives)
+        return assembler
 
-        # Safety check
-        is_safe, safety_message = self.check_safety(user_message)
-        if not is_safe:
-            return {'success': False, 'response': safety_message, 'safety_blocked': True}
+    def _add_prompt_sections(self, assembler, persona, relevant_memories=None, current_mood=None, conversation_summary=None, additional_context=None, learned_knowledge=None):
+        # Static persona preamble first (compiled once per persona version + mood), then the per-turn sections
+        preamble = PreambleCache.get(
+            'openrouter', persona, current_mood['code'] if current_mood else None,
+            lambda a: self._add_preamble_sections(a, persona, current_mood)
+        )
+        assembler.add_compiled('preamble', preamble)
         
-        system_prompt = self.build_ultra_realistic_prompt(persona, learned_knowledge, relevant_memories, current_mood)
         if additional_context:
-            system_prompt = f"SOCIAL CONTEXT: {additional_context}\n\n{system_prompt}"
+            assembler.add('social', f"SOCIAL CONTEXT: {additional_context}")
         
-        api_messages = [{"role": "system", "content": system_prompt}]
+        # DEEP MEMORIES (RAG), best match first so truncation drops the weakest
+        if relevant_memories:
+            assembler.add(
+                'memories',
+                [f"- [{mem['source']}]: {mem['content']}" for mem in relevant_memories],
+                header=self._banner("DEEP MEMORIES & ARCHIVED DATA") + "\nYou have retrieved the following specific information from your archives:",
+                footer="\nUse this information naturally if it's relevant to what the user is saying."
+            )
         
-        # 2. Format History with Identity Awareness
+        # LEARNED KNOWLEDGE (facts the user has shared in past conversations, newest first)
+        if learned_knowledge:
+            assembler.add(
+                'learned',
+                LearnedKnowledge.format_for_prompt(learned_knowledge),
+                header=self._banner("WHAT YOU'VE LEARNED ABOUT THE USER")
+            )
+        
+        # EARLIER CONVERSATION (rolling summary of turns outside the history window)
+        if conversation_summary:
+            assembler.add('summary', conversation_summary, header=self._banner("EARLIER IN YOUR CONVERSATIONS"))
+        return assembler
+
+    def build_ultra_realistic_prompt(self, persona, learned_knowledge=None, relevant_memories=None, current_mood=None, conversation_summary=None):
+        """System prompt on its own, within the configured section budgets"""
+        assembler = self._add_prompt_sections(
+            PromptAssembler.for_chat(), persona, relevant_memories, current_mood, conversation_summary, learned_knowledge=learned_knowledge
+        )
+        return assembler.assemble()
+
+    def _format_history(self, persona, messages):
+        # Format History with Identity Awareness
+        history = []
         for msg in messages[-15:]:
             sender_type = msg.get('sender_type')
             msg_persona_id = msg.get('persona_id')
@@ -131,60 +155,207 @@ class OpenRouterService:
                 content = f"[{p_name}]: {content}"
             
             if content:
-                api_messages.append({"role": role, "content": content})
+                history.append({"role": role, "content": content})
+        return history
+
+    def _assemble(self, persona, messages, user_message, additional_context=None, relevant_memories=None, current_mood=None, conversation_summary=None, learned_knowledge=None):
+        assembler = self._add_prompt_sections(
+            PromptAssembler.for_chat(user_message), persona, relevant_memories, current_mood, conversation_summary, additional_context, learned_knowledge
+        )
+        assembler.add('history', self._format_history(persona, messages), render=lambda m: m['content'], keep='tail', inline=False)
+        assembler.assemble()
+        self.last_prompt_report = assembler.report()
+        return assembler
+
+    def _api_messages(self, assembler, user_message, model_id=None):
+        if model_id and model_id.startswith(self.CACHE_CONTROL_PREFIXES):
+            # Explicit cache breakpoint after the static preamble; other providers cache identical prefixes automatically
+            dynamic = assembler.render(exclude=('preamble',))
+            system_content = [{"type": "text", "text": assembler.render(names=('preamble',)), "cache_control": {"type": "ephemeral"}}]
+            if dynamic:
+                system_content.append({"type": "text", "text": dynamic})
+        else:
+            system_content = assembler.render()
         
+        api_messages = [{"role": "system", "content": system_content}]
+        api_messages.extend(assembler.kept('history'))
         api_messages.append({"role": "user", "content": user_message})
+        return api_messages
+
+    def _build_api_messages(self, persona, messages, user_message, learned_knowledge=None, additional_context=None, relevant_memories=None, current_mood=None, conversation_summary=None, model_id=None):
+        assembler = self._assemble(persona, messages, user_message, additional_context, relevant_memories, current_mood, conversation_summary, learned_knowledge)
+        return self._api_messages(assembler, user_message, model_id)
+
+    def _headers(self):
+        # CLEAN HEADERS
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://emrys.app",
+            "X-Title": "EMRYS"
+        }
+
+    def resolve_models(self, model='balanced'):
+        """Concrete model ids for a tier (or explicit id), healthiest and fastest first"""
+        chain = self.MODEL_CHAINS.get(model) or [self.MODELS.get(model, model if '/' in str(model) else self.MODELS['balanced'])]
+        return ModelRouter.order(self.api_key, chain)
+
+    def _send(self, model_id, payload, stream=False, timeout=45):
+        """
+        POST one request to one model and return the 200 response.
+        Raises ModelUnavailable (recorded against the model) when the next model might succeed,
+        RuntimeError when the request itself is the problem.
+        """
+        try:
+            response = requests.post(self.BASE_URL, headers=self._headers(), json=payload, stream=stream, timeout=timeout)
+        except requests.RequestException as e:
+            ModelRouter.record_failure(self.api_key, model_id, e)
+            raise ModelUnavailable(f"{model_id}: {str(e)}")
+        
+        if response.status_code == 200:
+            return response
+        
+        print(f"OpenRouter Error {response.status_code} ({model_id}): {response.text}")
+        response.close()
+        kind = ModelRouter.record_failure(
+            self.api_key, model_id, f"{response.status_code}: {response.text[:200]}",
+            kind=classify_status(response.status_code),
+            retry_after=parse_retry_after(response.headers.get('Retry-After'))
+        )
+        if kind == CLIENT:
+            raise RuntimeError(f"API Error: {response.status_code}")
+        raise ModelUnavailable(f"API Error: {response.status_code}")
+
+    def chat(self, persona, messages, user_message, learned_knowledge=None, model='balanced', additional_context=None, relevant_memories=None, current_mood=None, conversation_summary=None):
+        if not self.api_key:
+            return {'success': False, 'error': 'API Key not configured'}
+
+        assembler = self._assemble(persona, messages, user_message, additional_context, relevant_memories, current_mood, conversation_summary, learned_knowledge)
         
+        # Streamed and raced on the first token (the same latency stream_chat records), so a
+        # losing hedge is closed as soon as another model starts answering
+        models = self.resolve_models(model)
         try:
-            # CLEAN HEADERS
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://emrys.app",
-                "X-Title": "EMRYS"
-            }
-            
-            selected_model = self.MODELS.get(model, self.MODELS['balanced'])
-            
+            (response, deltas, first), index = race(
+                [self._first_token(assembler, user_message, m) for m in models],
+                hedge_delays(self.api_key, models),
+                on_discard=lambda late: late and late[0].close()
+            )
+            model_id = models[index]
+            with response:
+                ai_response = (first or '') + "".join(deltas)
+        except Exception as e:
+            return {'success': False, 'error': str(e), 'safety_blocked': False}
+        
+        return {
+            'success': True,
+            'response': ai_response,
+            'safety_blocked': False,
+            'mood': current_mood['code'] if current_mood else 'default',
+            'retrieved': True if relevant_memories else False,
+            'model': model_id,
+            'prompt_tokens': self.last_prompt_report
+        }
+
+    def stream_chat(self, persona, messages, user_message, learned_knowledge=None, model='balanced', additional_context=None, relevant_memories=None, current_mood=None, conversation_summary=None):
+        """
+        Same as chat(), but yields response text deltas as OpenRouter streams them (stream: true).
+        Falls back (or hedges) to the next model only until the first token has arrived.
+        Raises RuntimeError if the request fails.
+        """
+        if not self.api_key:
+            raise RuntimeError('API Key not configured')
+
+        assembler = self._assemble(persona, messages, user_message, additional_context, relevant_memories, current_mood, conversation_summary, learned_knowledge)
+        
+        models = self.resolve_models(model)
+        (response, deltas, first), _ = race(
+            [self._first_token(assembler, user_message, m) for m in models],
+            hedge_delays(self.api_key, models),
+            on_discard=lambda late: late and late[0].close()
+        )
+        
+        with response:
+            if first:
+                yield first
+            for delta in deltas:
+                yield delta
+
+    def _first_token(self, assembler, user_message, model_id):
+        """
+        Race attempt: stream one model's reply up to its first token.
+        Returns (response, remaining deltas, first delta), or None once `cancelled` is set.
+        """
+        def run(cancelled):
             payload = {
-                "model": selected_model,
-                "messages": api_messages,
+                "model": model_id,
+                "messages": self._api_messages(assembler, user_message, model_id),
                 "temperature": 0.85,
-                "max_tokens": 1000
-            }
-            
-            response = requests.post(self.BASE_URL, headers=headers, json=payload, timeout=45)
-            
-            if response.status_code != 200:
-                print(f"OpenRouter Error {response.status_code}: {response.text}")
-                return {'success': False, 'error': f"API Error: {response.status_code}"}
-                
-            data = response.json()
-            ai_response = data['choices'][0]['message']['content']
-            
-            return {
-                'success': True,
-                'response': ai_response,
-                'safety_blocked': False,
-                'mood': current_mood['code'] if current_mood else 'default',
-                'retrieved': True if relevant_memories else False
+                "max_tokens": 1000,
+                "stream": True
             }
-            
-        except Exception as e:
-            return {'success': False, 'error': str(e), 'safety_blocked': False}
+            started = time.monotonic()
+            response = self._send(model_id, payload, stream=True, timeout=(10, 45))
+            deltas = self._iter_stream(response, cancelled)
+            try:
+                first = next(deltas, None)
+            except Exception:
+                response.close()
+                raise
+            # Time to first token is what a user waits on, and what the hedge delay is sized from
+            ModelRouter.record_success(self.api_key, model_id, time.monotonic() - started)
+            if cancelled.is_set():
+                response.close()
+                return None
+            return response, deltas, first
+        return run
 
-    def extract_knowledge(self, message, response, persona_name="the persona"):
-        """Extract information using AI"""
-        try:
-            extraction_prompt = f"Analyze conversation and extract facts about the USER in JSON format. User: {message} Bot: {response}"
-            headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+    def _iter_stream(self, response, cancelled=None):
+        """
+        Text deltas of an SSE response. Until the first delta arrives it stops early once
+        `cancelled` is set (a race was won elsewhere); after that the stream is the winner's.
+        """
+        for line in response.iter_lines(decode_unicode=True):
+            # Checked on every line, including OpenRouter's keep-alive comments before the first token
+            if cancelled is not None and cancelled.is_set():
+                break
+            # SSE comments (": OPENROUTER PROCESSING") and keep-alive blank lines
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            chunk = json.loads(data)
+            if chunk.get('error'):
+                raise RuntimeError(chunk['error'].get('message', 'Stream error'))
+            choices = chunk.get('choices') or [{}]
+            delta = choices[0].get('delta', {}).get('content')
+            if delta:
+                cancelled = None
+                yield delta
+
+    def complete(self, prompt, model='fast', max_tokens=400, temperature=0.3, timeout=20):
+        """Single-shot completion for internal tasks (summaries, extraction). Returns text or None."""
+        for model_id in self.resolve_models(model):
             payload = {
-                "model": "openai/gpt-3.5-turbo",
-                "messages": [{"role": "user", "content": extraction_prompt}],
-                "temperature": 0.3,
-                "max_tokens": 300
+                "model": model_id,
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": temperature,
+                "max_tokens": max_tokens
             }
-            res = requests.post(self.BASE_URL, headers=headers, json=payload, timeout=15)
-            if res.status_code == 200: return [] 
-            return []
-        except: return []
+            started = time.monotonic()
+            try:
+                res = self._send(model_id, payload, timeout=timeout)
+                text = res.json()['choices'][0]['message']['content'].strip()
+            except ModelUnavailable:
+                continue
+            except Exception as e:
+                print(f"OpenRouter completion error: {str(e)}")
+                return None
+            ModelRouter.record_success(self.api_key, model_id, time.monotonic() - started)
+            return text
+        return None
+
+    def extract_knowledge(self, message, response, persona_name="the persona"):
+        """Extract facts about the USER from one exchange (batches go through LearnedKnowledge directly)"""
+        return LearnedKnowledge.extract_facts(self.complete, [{'user': message, 'persona': response}], persona_name) or []
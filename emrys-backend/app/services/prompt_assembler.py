@@ -0,0 +1,259 @@
+"""
+Prompt Assembler for EMRYS
+Token-budgeted assembly of system prompts and chat history, shared by the Gemini and
+OpenRouter services so large personas can't blow up prompt size or overflow the context.
+"""
+
+import hashlib
+import json
+import re
+
+from app.config import Config
+from app.utils.cache import TTLCache
+from app.utils.settings import get_setting
+
+# Roughly how BPE tokenizers split English: words in ~4 character pieces, punctuation on its own
+TOKEN_ESTIMATE_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+ELLIPSIS = " …"
+
+# Budgeted chat sections: name -> (budget setting, priority). Lower priority is trimmed first
+# when the whole prompt is over PROMPT_MAX_TOKENS; sections not listed here are never cut.
+CHAT_SECTIONS = {
+    'history': ('PROMPT_BUDGET_HISTORY', 50),
+    'social': ('PROMPT_BUDGET_SOCIAL', 40),
+    'memories': ('PROMPT_BUDGET_MEMORIES', 30),
+    'learned': ('PROMPT_BUDGET_LEARNED', 25),
+    'background': ('PROMPT_BUDGET_IDENTITY', 20),
+    'summary': ('PROMPT_BUDGET_SUMMARY', 10),
+}
+
+
+def estimate_tokens(text):
+    """Local token estimate, close enough to real tokenizers for budgeting"""
+    if not text:
+        return 0
+    return len(TOKEN_ESTIMATE_PATTERN.findall(text))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text after its first max_tokens estimated tokens, preferring a word boundary"""
+    if max_tokens <= 0:
+        return ''
+    end = None
+    for i, match in enumerate(TOKEN_ESTIMATE_PATTERN.finditer(text)):
+        if i == max_tokens:
+            end = match.start()
+            break
+    if end is None:
+        return text
+    cut = text[:end]
+    space = cut.rfind(' ')
+    if space > len(cut) // 2:
+        cut = cut[:space]
+    return cut.rstrip() + ELLIPSIS
+
+
+class PromptSection:
+    def __init__(self, name, items, render=None, budget=None, priority=0, keep='head', header=None, footer=None, inline=True, tokens=None):
+        self.name = name
+        self.items = [item for item in items if item]
+        self.render = render or str
+        self.budget = budget       # None = never truncated
+        self.priority = priority   # lower priority sections are cut first when the total is over budget
+        self.keep = keep           # 'head' keeps the first items (ranked memories), 'tail' the last (history)
+        self.header = header
+        self.footer = footer
+        self.inline = inline       # False for sections that aren't part of the system text (history)
+        self.known_tokens = tokens # precomputed size of an unbudgeted section (compiled preambles)
+        self.kept = []
+        self.texts = []
+        self.tokens = 0
+        self.truncated = False
+
+    def fit(self, limit):
+        """Keep as many whole items as fit in `limit` tokens; an item that only partly fits is cut"""
+        if limit is None and self.known_tokens is not None:
+            self.kept = self.texts = list(self.items)
+            self.tokens = self.known_tokens
+            return
+
+        ordered = list(enumerate(self.items))
+        if self.keep == 'tail':
+            ordered.reverse()
+
+        kept, used = [], estimate_tokens(self.header) + estimate_tokens(self.footer)
+        for index, item in ordered:
+            text = self.render(item)
+            cost = estimate_tokens(text)
+            if limit is not None and used + cost > limit:
+                remaining = limit - used
+                # Text items can be shortened; structured items (messages) are kept whole or dropped
+                if isinstance(item, str) and remaining > 8:
+                    text = truncate_to_tokens(text, remaining)
+                    kept.append((index, text, text))
+                    used += estimate_tokens(text)
+                self.truncated = True
+                break
+            kept.append((index, item, text))
+            used += cost
+
+        kept.sort(key=lambda entry: entry[0])
+        self.kept = [item for _, item, _ in kept]
+        self.texts = [text for _, _, text in kept]
+        self.tokens = used if kept else 0
+
+    def text(self):
+        if not self.texts:
+            return ''
+        parts = [self.header] if self.header else []
+        parts.extend(self.texts)
+        if self.footer:
+            parts.append(self.footer)
+        return "\n".join(parts)
+
+
+class PromptAssembler:
+    """
+    Collects prompt sections, fits each one into its own budget, then trims the
+    lowest-priority sections until the whole prompt fits `max_tokens`.
+
+        assembler = PromptAssembler.for_chat(user_message)
+        assembler.add('identity', [...])
+        assembler.add('memories', chunks, header="MEMORIES:")
+        assembler.add('history', messages, render=lambda m: m['content'], keep='tail', inline=False)
+        system_prompt = assembler.assemble()
+        history = assembler.kept('history')
+    """
+
+    def __init__(self, max_tokens=None, reserve=0, layout=None):
+        self.max_tokens = max_tokens
+        self.reserve = reserve
+        self.layout = layout or {}
+        self.sections = []
+        self.prefix_hash = None
+
+    @classmethod
+    def for_chat(cls, user_message=''):
+        """Assembler with the configured chat budgets; the user's message is reserved off the total"""
+        return cls(
+            max_tokens=get_setting('PROMPT_MAX_TOKENS', 3500),
+            reserve=estimate_tokens(user_message),
+            layout=CHAT_SECTIONS
+        )
+
+    def add(self, name, items, **options):
+        if isinstance(items, str):
+            items = [items]
+        if name in self.layout and 'budget' not in options:
+            setting, priority = self.layout[name]
+            options['budget'] = get_setting(setting)
+            options.setdefault('priority', priority)
+        self.sections.append(PromptSection(name, items, **options))
+        return self
+
+    def add_compiled(self, name, preamble):
+        """Add a CompiledPreamble as-is; it must come first for providers to reuse it as a cached prefix"""
+        self.sections.append(PromptSection(name, [preamble.text], tokens=preamble.tokens))
+        self.prefix_hash = preamble.prefix_hash
+        return self
+
+    def section(self, name):
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+    def kept(self, name):
+        section = self.section(name)
+        return section.kept if section else []
+
+    def assemble(self, separator="\n\n"):
+        for section in self.sections:
+            section.fit(section.budget)
+
+        if self.max_tokens:
+            overflow = self.total_tokens() + self.reserve - self.max_tokens
+            trimmable = sorted((s for s in self.sections if s.budget is not None), key=lambda s: s.priority)
+            for section in trimmable:
+                if overflow <= 0:
+                    break
+                before = section.tokens
+                section.fit(max(0, before - overflow))
+                overflow -= before - section.tokens
+
+        return self.render(separator=separator)
+
+    def render(self, names=None, exclude=(), separator="\n\n"):
+        """Join the fitted inline sections (optionally only `names`, or all but `exclude`)"""
+        sections = [
+            s for s in self.sections
+            if s.inline and (names is None or s.name in names) and s.name not in exclude
+        ]
+        return separator.join(text for text in (s.text() for s in sections) if text)
+
+    def total_tokens(self):
+        return sum(section.tokens for section in self.sections)
+
+    def report(self):
+        """Estimated tokens per section, for logging and API responses"""
+        return {
+            'sections': {
+                s.name: {'tokens': s.tokens, 'budget': s.budget, 'items': len(s.kept), 'truncated': s.truncated}
+                for s in self.sections
+            },
+            'prefix_hash': self.prefix_hash,
+            'reserved': self.reserve,
+            'total': self.total_tokens() + self.reserve,
+            'max_tokens': self.max_tokens
+        }
+
+
+class CompiledPreamble:
+    """The static, per-persona head of a system prompt, ready to splice in"""
+
+    def __init__(self, text, tokens, sections):
+        self.text = text
+        self.tokens = tokens
+        self.sections = sections
+        # Identifies the prefix for provider-side prompt caching and for logs
+        self.prefix_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+class PreambleCache:
+    """
+    LRU of compiled persona preambles keyed by provider, persona version and mood.
+    Only memories, summary and social context are assembled per call.
+    """
+    preambles = TTLCache(maxsize=Config.PROMPT_CACHE_SIZE, ttl=Config.PROMPT_CACHE_TTL)
+
+    # The only persona columns a preamble renders; knowledge (data_dump, life_data, files) never is
+    PERSONA_FIELDS = ('name', 'age', 'occupation', 'location', 'relationship', 'background_story', 'personality_traits')
+
+    @classmethod
+    def persona_version(cls, persona):
+        """Hash of the rendered persona fields, so an identity edit produces a new preamble"""
+        payload = json.dumps([persona.get(f) for f in cls.PERSONA_FIELDS], default=str)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get(cls, provider, persona, mood_code, build):
+        """
+        Compiled preamble for this persona and mood; build(assembler) adds its
+        sections and is only called on a cache miss.
+        """
+        key = (
+            provider, str(persona.get('id')), cls.persona_version(persona),
+            mood_code, get_setting('PROMPT_BUDGET_IDENTITY')
+        )
+
+        def compile_preamble():
+            assembler = build(PromptAssembler(layout=CHAT_SECTIONS))
+            text = assembler.assemble()
+            return CompiledPreamble(text, assembler.total_tokens(), assembler.report()['sections'])
+
+        return cls.preambles.get_or_load(key, compile_preamble)
+
+    @classmethod
+    def stats(cls):
+        return cls.preambles.stats()
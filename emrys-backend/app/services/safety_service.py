@@ -0,0 +1,19 @@
+"""
+Safety Service for EMRYS
+Restricted-topic check for user messages, shared by every provider. Runs as the first
+stage of the turn pipeline, before any database, storage or retrieval work.
+"""
+
+from app.services.keyword_matcher import LEXICON, RESTRICTED_TOPICS
+
+
+class SafetyService:
+    RESTRICTED_TOPICS = RESTRICTED_TOPICS
+
+    @staticmethod
+    def check(message):
+        """(is_safe, reply to send instead) for a user message"""
+        topic = LEXICON.first(message, 'restricted')
+        if topic:
+            return False, f"I appreciate your trust, but I can't provide advice on {topic}. Please consult with a qualified professional for this matter."
+        return True, None
@@ -0,0 +1,161 @@
+"""
+Search Index for EMRYS
+Tokenized inverted index with BM25 ranking, used by KnowledgeService for persona memory retrieval.
+"""
+
+import hashlib
+import heapq
+import math
+import re
+import threading
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below
+between both but by can could did do does doing down during each few for from further had has have
+having he her here hers herself him himself his how i if in into is it its itself just me more most
+my myself no nor not now of off on once only or other our ours ourselves out over own same she should
+so some such than that the their theirs them themselves then there these they this those through to
+too under until up very was we were what when where which while who whom why will with would you your
+yours yourself yourselves i'm you're it's don't can't i've i'll i'd let's that's what's there's
+tell know like really also get got
+""".split())
+
+
+def tokenize(text):
+    """Lowercase word tokens with stopwords and single characters removed"""
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+def chunk_fingerprint(source_key, content):
+    return hashlib.sha1(f"{source_key}\0{content}".encode('utf-8')).hexdigest()
+
+
+class BM25Index:
+    """
+    In-memory inverted index. Each document is a chunk of persona knowledge;
+    queries only visit the posting lists of their own terms.
+
+    Chunks are keyed by a content fingerprint so a changed source only adds and
+    removes the chunks that actually differ. Removed chunks leave a tombstone
+    (None) in `docs` until the index is compacted.
+    """
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, version=None):
+        self.version = version   # content hash of every source, for downstream cache keys
+        self.revision = 0        # bumped on every applied change
+        self.lock = threading.RLock()
+        self.docs = []           # doc_id -> {'id': fingerprint, 'source': ..., 'content': ...} or None
+        self.doc_lengths = []
+        self.postings = {}       # term -> {doc_id: term frequency}
+        self.total_length = 0
+        self.live = 0
+        self.chunk_ids = {}      # chunk fingerprint -> doc_id
+        self.sources = {}        # source key -> (source hash, [chunk fingerprints])
+
+    def __len__(self):
+        return self.live
+
+    def add(self, source, content, fingerprint=None):
+        fingerprint = fingerprint or chunk_fingerprint(source, content)
+        if fingerprint in self.chunk_ids:
+            return self.chunk_ids[fingerprint]
+
+        tokens = tokenize(content)
+        doc_id = len(self.docs)
+        self.docs.append({'id': fingerprint, 'source': source, 'content': content})
+        self.doc_lengths.append(len(tokens))
+        self.total_length += len(tokens)
+        self.chunk_ids[fingerprint] = doc_id
+        self.live += 1
+
+        frequencies = {}
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+        for token, tf in frequencies.items():
+            self.postings.setdefault(token, {})[doc_id] = tf
+        return doc_id
+
+    def remove(self, fingerprint):
+        doc_id = self.chunk_ids.pop(fingerprint, None)
+        if doc_id is None:
+            return
+        doc = self.docs[doc_id]
+        for token in set(tokenize(doc['content'])):
+            posting = self.postings.get(token)
+            if posting:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[token]
+        self.total_length -= self.doc_lengths[doc_id]
+        self.doc_lengths[doc_id] = 0
+        self.docs[doc_id] = None
+        self.live -= 1
+
+    def sync_source(self, key, label, source_hash, chunks):
+        """
+        Bring one source up to date. `chunks` is only consumed when the source hash changed;
+        chunks whose fingerprint already exists keep their postings untouched.
+        Returns (added, removed) chunk counts.
+        """
+        current = self.sources.get(key)
+        if current and current[0] == source_hash:
+            return 0, 0
+
+        old_ids = set(current[1]) if current else set()
+        new_ids = []
+        added = 0
+        for content in chunks:
+            fingerprint = chunk_fingerprint(key, content)
+            new_ids.append(fingerprint)
+            if fingerprint not in self.chunk_ids:
+                self.add(label, content, fingerprint)
+                added += 1
+
+        removed = old_ids - set(new_ids)
+        for fingerprint in removed:
+            self.remove(fingerprint)
+
+        self.sources[key] = (source_hash, new_ids)
+        return added, len(removed)
+
+    def drop_source(self, key):
+        current = self.sources.pop(key, None)
+        if current:
+            for fingerprint in current[1]:
+                self.remove(fingerprint)
+
+    def compact(self):
+        """Rebuild doc ids without tombstones once they outnumber live chunks"""
+        if len(self.docs) - self.live <= self.live:
+            return False
+        docs = [doc for doc in self.docs if doc is not None]
+        self.docs, self.doc_lengths, self.postings = [], [], {}
+        self.total_length, self.live, self.chunk_ids = 0, 0, {}
+        for doc in docs:
+            self.add(doc['source'], doc['content'], doc['id'])
+        return True
+
+    def search(self, query, top_n=3):
+        """Return the top_n (doc_id, score) pairs for a free-text query"""
+        with self.lock:
+            if not self.live:
+                return []
+
+            n_docs = self.live
+            avg_length = (self.total_length / n_docs) or 1.0
+            scores = {}
+
+            for term in set(tokenize(query)):
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+                for doc_id, tf in posting.items():
+                    norm = self.K1 * (1 - self.B + self.B * self.doc_lengths[doc_id] / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.K1 + 1) / (tf + norm)
+
+            return heapq.nlargest(top_n, scores.items(), key=lambda x: x[1])
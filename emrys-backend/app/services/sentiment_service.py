@@ -1,4 +1,9 @@
+from app.services.keyword_matcher import LEXICON, MOOD_TRIGGERS
+
+
 class SentimentService:
+    TRIGGERS = MOOD_TRIGGERS
+
     MOODS = {
         'default': 'Stable & Neutral',
         'happy': 'Warm & Joyful',
@@ -10,42 +15,37 @@ class SentimentService:
         'distant': 'Reserved & Distant'
     }
 
+    @staticmethod
+    def score(text):
+        """Distinct trigger phrases found per mood in the text (whole words only)"""
+        return {mood: hits for mood, hits in LEXICON.counts(text).items() if mood in MOOD_TRIGGERS}
+
     @classmethod
-    def analyze_mood(cls, history, user_message):
-        """
-        Analyzes the last few messages to determine a 'Neural Pulse' (Mood).
-        For now, uses simple keyword detection + history length.
-        """
-        # In a high-end implementation, this would be an AI call.
-        # Let's use simple logic for speed.
-        
-        last_messages = [m.get('content', '').lower() for m in history[-3:]]
-        all_text = " ".join(last_messages) + " " + user_message.lower()
-        
-        # Keyword triggers
-        triggers = {
-            'happy': ['joy', 'happy', 'great', 'love', 'smile', 'excited', 'good news'],
-            'sad': ['miss', 'sorry', 'sad', 'pain', 'lonely', 'lost', 'tears', 'upset'],
-            'angry': ['hate', 'stop', 'why', 'annoyed', 'mad', 'angry', 'never'],
-            'nostalgic': ['remember', 'old times', 'back then', 'past', 'memory', 'childhood'],
-            'protective': ['safe', 'care', 'protect', 'help', 'worry', 'don\'t worry'],
-            'curious': ['how', 'what if', 'tell me', 'wondering', 'why did', 'curious']
-        }
-        
+    def pick(cls, scores, messages_seen, min_score=0):
+        """Mood with the highest score (first listed wins ties); neutral for thin evidence"""
         detected_mood = 'default'
         max_hits = 0
         
-        for mood, words in triggers.items():
-            hits = sum(1 for word in words if word in all_text)
-            if hits > max_hits:
-                max_hits = hits
+        for mood in cls.TRIGGERS:
+            if scores.get(mood, 0) > max_hits:
+                max_hits = scores[mood]
                 detected_mood = mood
         
         # If very few messages, stay neutral
-        if len(history) < 2 and max_hits < 2:
+        if (messages_seen < 2 and max_hits < 2) or max_hits < min_score:
             detected_mood = 'default'
             
         return {
             'code': detected_mood,
             'label': cls.MOODS[detected_mood]
         }
+
+    @classmethod
+    def analyze_mood(cls, history, user_message):
+        """
+        Analyzes the last few messages to determine a 'Neural Pulse' (Mood).
+        Stateless keyword detection + history length; chat turns use MoodTracker instead.
+        """
+        last_messages = [m.get('content') or '' for m in history[-3:]]
+        all_text = " ".join(last_messages) + " " + user_message
+        return cls.pick(cls.score(all_text), len(history))
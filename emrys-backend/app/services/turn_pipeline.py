@@ -0,0 +1,93 @@
+"""
+Turn Pipeline for EMRYS
+Pre-processing for a chat turn as an ordered list of named stages. Each stage is timed
+(per request and in aggregate for /health), optional stages can be switched off with
+PIPELINE_SKIP_STAGES, and any stage can end the turn early by raising PipelineHalt,
+so cheap checks such as the safety gate run before any database or retrieval work.
+"""
+
+import threading
+import time
+
+from app.utils.settings import get_setting
+
+
+class PipelineHalt(Exception):
+    """Raised by a stage to end the turn with (body, status) instead of continuing"""
+
+    def __init__(self, body, status=200):
+        super().__init__(body.get('error') or body.get('response'))
+        self.body = body
+        self.status = status
+
+
+class Stage:
+    def __init__(self, name, run, optional=True, defaults=None):
+        """
+        run(ctx) reads and fills the shared turn dict. Optional stages may be skipped,
+        in which case `defaults` are written into ctx in their place.
+        """
+        self.name = name
+        self.run = run
+        self.optional = optional
+        self.defaults = defaults or {}
+
+
+class TurnPipeline:
+    _lock = threading.Lock()
+    _stats = {}  # 'pipeline.stage' -> counters
+
+    def __init__(self, name, stages):
+        self.name = name
+        self.stages = stages
+
+    def _record(self, stage, elapsed_ms=None, skipped=False, halted=False):
+        key = f"{self.name}.{stage.name}"
+        with self._lock:
+            entry = self._stats.setdefault(key, {'runs': 0, 'skipped': 0, 'halted': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            if skipped:
+                entry['skipped'] += 1
+                return
+            entry['runs'] += 1
+            entry['halted'] += int(halted)
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+
+    def run(self, ctx):
+        """
+        Run every stage in order over ctx. ctx['timings'] gets each stage's wall time in ms
+        (None if skipped). Raises PipelineHalt from the stage that stopped the turn.
+        """
+        skip = set(get_setting('PIPELINE_SKIP_STAGES', []))
+        timings = ctx.setdefault('timings', {})
+        for stage in self.stages:
+            if stage.optional and stage.name in skip:
+                ctx.update(stage.defaults)
+                timings[stage.name] = None
+                self._record(stage, skipped=True)
+                continue
+
+            started = time.perf_counter()
+            try:
+                stage.run(ctx)
+            except PipelineHalt:
+                timings[stage.name] = round((time.perf_counter() - started) * 1000, 2)
+                self._record(stage, timings[stage.name], halted=True)
+                raise
+            timings[stage.name] = round((time.perf_counter() - started) * 1000, 2)
+            self._record(stage, timings[stage.name])
+        return ctx
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                key: {
+                    'runs': entry['runs'],
+                    'skipped': entry['skipped'],
+                    'halted': entry['halted'],
+                    'avg_ms': round(entry['total_ms'] / entry['runs'], 2) if entry['runs'] else 0.0,
+                    'max_ms': round(entry['max_ms'], 2)
+                }
+                for key, entry in sorted(cls._stats.items())
+            }
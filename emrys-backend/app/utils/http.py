@@ -0,0 +1,29 @@
+"""
+Shared HTTP session for EMRYS services.
+One keep-alive connection pool per process instead of a new TCP/TLS handshake per request.
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.utils.settings import get_setting
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """Return the process-wide pooled requests.Session"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = get_setting('HTTP_POOL_SIZE', 20)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
@@ -0,0 +1,159 @@
+"""
+Background job queue for EMRYS.
+Post-response work (knowledge extraction, summary updates, index refreshes) runs on a
+few worker threads so HTTP responses return as soon as the persona's reply is saved.
+The queue is bounded; when full it drops by policy, and failed jobs retry with backoff.
+"""
+
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+
+
+class Job:
+    __slots__ = ('name', 'fn', 'args', 'kwargs', 'dedupe_key', 'retries', 'attempt', 'enqueued_at')
+
+    def __init__(self, name, fn, args, kwargs, dedupe_key, retries):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.dedupe_key = dedupe_key
+        self.retries = retries
+        self.attempt = 0
+        self.enqueued_at = time.monotonic()
+
+
+class JobQueue:
+    DROP_POLICIES = ('drop_oldest', 'drop_new')
+
+    def __init__(self, app=None):
+        self._jobs = deque()
+        self._cond = threading.Condition()
+        self._pending_keys = set()
+        self._threads = []
+        self._running = 0
+        self._counts = {'submitted': 0, 'completed': 0, 'failed': 0, 'retried': 0, 'dropped': 0, 'deduplicated': 0}
+        self._by_name = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get('JOB_WORKERS', 2)
+        self.capacity = app.config.get('JOB_QUEUE_SIZE', 256)
+        self.max_retries = app.config.get('JOB_MAX_RETRIES', 2)
+        self.retry_backoff = app.config.get('JOB_RETRY_BACKOFF', 2.0)
+        self.drop_policy = app.config.get('JOB_DROP_POLICY', 'drop_oldest')
+        if self.drop_policy not in self.DROP_POLICIES:
+            self.drop_policy = 'drop_oldest'
+        app.extensions['job_queue'] = self
+
+    def _ensure_workers(self):
+        # Started on first use, so importing the app (or the reloader's parent process) spawns no threads
+        if len(self._threads) >= self.workers:
+            return
+        for i in range(len(self._threads), self.workers):
+            thread = threading.Thread(target=self._work, name=f"emrys-jobs-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _count(self, name, outcome):
+        self._counts[outcome] += 1
+        self._by_name.setdefault(name, {k: 0 for k in self._counts})[outcome] += 1
+
+    def submit(self, name, fn, *args, dedupe_key=None, retries=None, **kwargs):
+        """
+        Queue fn(*args, **kwargs) to run inside an app context on a worker thread.
+        A job whose dedupe_key is already waiting is skipped. Returns False if it was not queued.
+        """
+        job = Job(name, fn, args, kwargs, dedupe_key, self.max_retries if retries is None else retries)
+        return self._enqueue(job, fresh=True)
+
+    def _enqueue(self, job, fresh=False):
+        with self._cond:
+            self._ensure_workers()
+            if fresh:
+                self._count(job.name, 'submitted')
+            if job.dedupe_key is not None and job.dedupe_key in self._pending_keys:
+                self._count(job.name, 'deduplicated')
+                return False
+
+            if len(self._jobs) >= self.capacity:
+                if self.drop_policy == 'drop_new':
+                    self._count(job.name, 'dropped')
+                    print(f"Job queue full, dropped new job {job.name}")
+                    return False
+                dropped = self._jobs.popleft()
+                self._pending_keys.discard(dropped.dedupe_key)
+                self._count(dropped.name, 'dropped')
+                print(f"Job queue full, dropped oldest job {dropped.name}")
+
+            self._jobs.append(job)
+            if job.dedupe_key is not None:
+                self._pending_keys.add(job.dedupe_key)
+            self._cond.notify()
+        return True
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._jobs:
+                    self._cond.wait()
+                job = self._jobs.popleft()
+                # A job submitted from now on is new work, not a duplicate of this one
+                self._pending_keys.discard(job.dedupe_key)
+                self._running += 1
+
+            try:
+                with self.app.app_context():
+                    job.fn(*job.args, **job.kwargs)
+                outcome = 'completed'
+            except Exception as e:
+                outcome = self._retry(job, e)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._count(job.name, outcome)
+                    self._cond.notify_all()
+
+    def _retry(self, job, error):
+        if job.attempt >= job.retries:
+            print(f"Background job {job.name} failed after {job.attempt + 1} attempts: {str(error)}")
+            return 'failed'
+        delay = self.retry_backoff * (2 ** job.attempt)
+        job.attempt += 1
+        timer = threading.Timer(delay, self._enqueue, args=(job,))
+        timer.daemon = True
+        timer.start()
+        return 'retried'
+
+    def drain(self, timeout=None):
+        """Block until the queue is empty and no job is running (scheduled retries excluded)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._jobs or self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'capacity': self.capacity,
+                'queued': len(self._jobs),
+                'running': self._running,
+                'drop_policy': self.drop_policy,
+                **self._counts,
+                'by_name': {name: dict(counts) for name, counts in self._by_name.items()}
+            }
+
+
+def enqueue(name, fn, *args, **kwargs):
+    """Queue a background job on the current app's JobQueue"""
+    return current_app.extensions['job_queue'].submit(name, fn, *args, **kwargs)
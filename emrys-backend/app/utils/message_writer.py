@@ -0,0 +1,373 @@
+"""
+Write-behind message persistence for EMRYS.
+Chat messages are appended to a local spool file and acknowledged immediately; a
+background thread inserts them into Supabase in bulk. Readers flush a conversation's
+pending rows before querying it, and spooled rows left by a dead process are replayed
+(deduplicated against the table) the next time the writer starts.
+
+Each process only inserts its own spool, but flush(conversation_id) also returns the rows
+other processes sharing MESSAGE_SPOOL_DIR still have pending (read from their spool files,
+never inserted from here), so a backend read on any worker sees every saved message.
+Clients that query the messages table directly (the frontend) see a row once its process
+has flushed it, i.e. within about MESSAGE_FLUSH_INTERVAL.
+"""
+
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+
+from app.utils.supabase_pool import get_supabase
+
+try:
+    import fcntl
+    LOCKS_AVAILABLE = True
+except ImportError:  # Windows: no advisory locks, spools are only replayed by the next process
+    fcntl = None
+    LOCKS_AVAILABLE = False
+
+# Postgres error classes the table will keep rejecting (bad data, FK/unique violations, unknown column)
+PERMANENT_ERROR_CLASSES = ('22', '23', '42')
+
+
+def _rejected(error):
+    """True if the database refused the rows themselves, so retrying cannot succeed"""
+    code = str(getattr(error, 'code', '') or '')
+    return len(code) == 5 and code[:2] in PERMANENT_ERROR_CLASSES
+
+
+def _parse_stamp(value):
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def _read_spool(f):
+    """(rows by seq, seqs marked done) of a spool file"""
+    rows, done = {}, set()
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue  # torn final write
+        if 'row' in record:
+            rows[record['seq']] = record['row']
+        else:
+            done.update(record.get('done', []))
+    return rows, done
+
+
+def merge_pending(rows, pending):
+    """
+    A conversation's `pending` rows that are not among its `rows` read from the table, oldest
+    first. Another process may insert a row between the read of its spool and the read of
+    the table, so the same message can show up in both.
+    """
+    stored = {_parse_stamp(r.get('created_at')) for r in rows}
+    return sorted(
+        (m for m in pending if _parse_stamp(m.get('created_at')) not in stored),
+        key=lambda m: m.get('created_at') or ''
+    )
+
+
+class MessageWriter:
+    def __init__(self, app=None):
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # one insert at a time, so no row is ever sent twice
+        self._pending = []  # spooled entries not yet inserted, oldest first
+        self._seq = 0
+        self._last_stamp = None
+        self._spool = None
+        self._spool_path = None
+        self._thread = None
+        self._failures = 0
+        self._last_error = None
+        self._counts = {'saved': 0, 'flushed': 0, 'batches': 0, 'failed': 0, 'rejected': 0, 'replayed': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.write_behind = app.config.get('MESSAGE_WRITE_BEHIND', True)
+        self.flush_interval = app.config.get('MESSAGE_FLUSH_INTERVAL', 0.5)
+        self.batch_size = app.config.get('MESSAGE_FLUSH_BATCH', 100)
+        self.spool_dir = app.config.get('MESSAGE_SPOOL_DIR', os.path.join(os.getcwd(), '.emrys_cache', 'spool'))
+        self.fsync = app.config.get('MESSAGE_SPOOL_FSYNC', True)
+        app.extensions['message_writer'] = self
+
+    def _stamp(self):
+        # Rows in one bulk insert would all get the same now(); keep the order they were saved in
+        now = datetime.now(timezone.utc)
+        if self._last_stamp is not None and now <= self._last_stamp:
+            now = self._last_stamp + timedelta(microseconds=1)
+        self._last_stamp = now
+        return now.isoformat()
+
+    def _ensure_started(self):
+        # Started on first use (caller holds self._cond), so the reloader's parent process never replays spools
+        if self._thread is not None:
+            return
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._spool_path = os.path.join(self.spool_dir, f"messages-{os.getpid()}-{uuid.uuid4().hex[:8]}.log")
+        self._spool = open(self._spool_path, 'a', encoding='utf-8')
+        if LOCKS_AVAILABLE:
+            fcntl.flock(self._spool, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._adopt_orphans()
+
+        self._thread = threading.Thread(target=self._run, name='emrys-message-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self._flush_at_exit)
+
+    def _adopt_orphans(self):
+        """Move rows a dead process spooled but never inserted into this process's spool"""
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, 'messages-*.log'))):
+            if path == self._spool_path:
+                continue
+            try:
+                with open(path, 'r+', encoding='utf-8') as f:
+                    if LOCKS_AVAILABLE:
+                        try:
+                            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except OSError:
+                            continue  # still owned by a live process
+                    rows, done = _read_spool(f)
+                    for seq, row in sorted(rows.items()):
+                        if seq not in done:
+                            self._append(row, replayed=True)
+                            self._counts['replayed'] += 1
+                os.remove(path)
+            except OSError as e:
+                print(f"Message spool replay error for {path}: {str(e)}")
+
+    def _write_spool(self, record):
+        self._spool.write(json.dumps(record) + "\n")
+        self._spool.flush()
+        if self.fsync:
+            os.fsync(self._spool.fileno())
+
+    def _append(self, row, replayed=False):
+        self._seq += 1
+        entry = {'seq': self._seq, 'row': row, 'replayed': replayed}
+        self._write_spool({'seq': entry['seq'], 'row': row})
+        self._pending.append(entry)
+        return entry
+
+    def save(self, row):
+        """Persist a messages row; returns it with its created_at. Durable once this returns."""
+        row = dict(row)
+        if not self.write_behind:
+            get_supabase().table('messages').insert(row).execute()
+            return row
+
+        with self._cond:
+            self._ensure_started()
+            row.setdefault('created_at', self._stamp())
+            self._append(row)
+            self._counts['saved'] += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+        return row
+
+    def flush(self, conversation_id=None, supabase=None):
+        """
+        Insert pending rows (only one conversation's if given) before it is read.
+        Returns the rows that are still pending afterwards, so a reader can merge them in;
+        for one conversation that includes rows other processes have spooled but not inserted.
+        """
+        if not self.write_behind:
+            return []
+        def mine(entry):
+            return conversation_id is None or str(entry['row'].get('conversation_id')) == str(conversation_id)
+
+        def still_pending():
+            with self._cond:
+                rows = [dict(e['row']) for e in self._pending if mine(e)]
+            if conversation_id is not None:
+                rows.extend(self._peer_rows(conversation_id))
+            return rows
+
+        # Most reads find nothing pending: answer those without queueing behind another flush
+        with self._cond:
+            self._ensure_started()
+            if not any(mine(e) for e in self._pending):
+                return still_pending()
+        try:
+            supabase = supabase or get_supabase()  # before the lock, so no flush waits on a client while holding it
+        except Exception as e:
+            self._fail(e)
+            return still_pending()
+
+        with self._flush_lock:
+            with self._cond:
+                entries = [e for e in self._pending if mine(e)]
+            if entries:
+                try:
+                    for start in range(0, len(entries), self.batch_size):
+                        if not self._insert(supabase, entries[start:start + self.batch_size]):
+                            break
+                except Exception as e:
+                    self._fail(e)
+        return still_pending()
+
+    def _peer_rows(self, conversation_id):
+        """
+        A conversation's rows that other processes have spooled and not yet marked inserted.
+        Only read: the owning process (or whoever adopts its spool) is the one that inserts them.
+        """
+        rows = []
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, 'messages-*.log'))):
+            if path == self._spool_path:
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    spooled, done = _read_spool(f)
+            except OSError:
+                continue  # replayed and removed meanwhile
+            rows.extend(
+                row for seq, row in sorted(spooled.items())
+                if seq not in done and str(row.get('conversation_id')) == str(conversation_id)
+            )
+        return rows
+
+    def discard(self, conversation_id):
+        """Drop a conversation's rows that are not inserted yet (its messages were wiped). Returns how many."""
+        if not self.write_behind:
+            return 0
+        with self._flush_lock:
+            with self._cond:
+                self._ensure_started()
+                entries = [e for e in self._pending if str(e['row'].get('conversation_id')) == str(conversation_id)]
+            self._mark_done(entries)
+        return len(entries)
+
+    def _fail(self, error):
+        with self._cond:
+            self._failures += 1
+            self._counts['failed'] += 1
+            self._last_error = str(error)[:200]
+        print(f"Message flush failed ({self._failures} in a row): {str(error)}")
+
+    def _already_inserted(self, supabase, entries):
+        """Replayed rows the dead process did insert before it could mark them done"""
+        replayed = [e for e in entries if e['replayed']]
+        if not replayed:
+            return []
+        conversation_ids = sorted({str(e['row']['conversation_id']) for e in replayed})
+        oldest = min(e['row']['created_at'] for e in replayed)
+        existing = supabase.table('messages').select('conversation_id, created_at') \
+            .in_('conversation_id', conversation_ids).gte('created_at', oldest).execute().data or []
+        stored = {(str(m['conversation_id']), _parse_stamp(m['created_at'])) for m in existing}
+        return [
+            e for e in replayed
+            if (str(e['row']['conversation_id']), _parse_stamp(e['row']['created_at'])) in stored
+        ]
+
+    def _insert(self, supabase, entries):
+        """One bulk insert; returns False if rows were left pending for a later retry"""
+        duplicates = self._already_inserted(supabase, entries)
+        skip = {e['seq'] for e in duplicates}
+        to_insert = [e for e in entries if e['seq'] not in skip]
+
+        done, inserted = list(duplicates), 0
+        try:
+            if to_insert:
+                supabase.table('messages').insert([e['row'] for e in to_insert]).execute()
+            done.extend(to_insert)
+            inserted = len(to_insert)
+        except Exception as e:
+            if not _rejected(e):
+                self._fail(e)
+                self._mark_done(done)
+                return False
+            # A row the table refuses (e.g. its conversation was deleted) must not hold back the rest
+            for entry in to_insert:
+                try:
+                    supabase.table('messages').insert(entry['row']).execute()
+                    inserted += 1
+                except Exception as row_error:
+                    if not _rejected(row_error):
+                        self._fail(row_error)
+                        self._mark_done(done, inserted)
+                        return False
+                    print(f"Dropping message rejected by the database: {str(row_error)}")
+                    with self._cond:
+                        self._counts['rejected'] += 1
+                done.append(entry)
+
+        self._mark_done(done, inserted)
+        return True
+
+    def _mark_done(self, entries, inserted=0):
+        if not entries:
+            return
+        seqs = {e['seq'] for e in entries}
+        with self._cond:
+            self._pending = [e for e in self._pending if e['seq'] not in seqs]
+            if self._pending:
+                self._write_spool({'done': sorted(seqs)})
+            else:
+                # Everything is in the table: start the spool over instead of letting it grow
+                self._spool.seek(0)
+                self._spool.truncate()
+            if inserted:
+                self._failures = 0
+                self._counts['flushed'] += inserted
+                self._counts['batches'] += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                has_work = bool(self._pending)
+                failures = self._failures
+            if not has_work:
+                continue
+            if failures:
+                # Database unreachable: back off instead of hammering it every interval
+                time.sleep(min(self.flush_interval * (2 ** failures), 30))
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception as e:
+                self._fail(e)
+
+    def _flush_at_exit(self):
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception as e:
+            print(f"Message flush at exit failed, rows stay spooled: {str(e)}")
+
+    def stats(self):
+        with self._cond:
+            return {
+                'write_behind': self.write_behind,
+                'pending': len(self._pending),
+                'spool_bytes': self._spool.tell() if self._spool else 0,
+                'consecutive_failures': self._failures,
+                'last_error': self._last_error,
+                **self._counts
+            }
+
+
+def save_message(row):
+    """Persist a messages row through the current app's MessageWriter"""
+    return current_app.extensions['message_writer'].save(row)
+
+
+def discard_messages(conversation_id):
+    """Forget a wiped conversation's rows that were saved but not inserted yet"""
+    return current_app.extensions['message_writer'].discard(conversation_id)
+
+
+def flush_messages(conversation_id=None, supabase=None):
+    """Flush pending rows before reading them back; returns rows that could not be flushed yet"""
+    return current_app.extensions['message_writer'].flush(conversation_id, supabase)
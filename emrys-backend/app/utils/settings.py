@@ -0,0 +1,27 @@
+"""
+Settings helper for EMRYS services.
+Services run both inside requests and in worker threads, so config lookups
+fall back to the base Config when no Flask app context is active.
+"""
+
+from flask import current_app, has_app_context
+from app.config import Config
+
+
+def get_setting(name, default=None):
+    """Read a config value from the active app, or from Config outside an app context"""
+    if has_app_context():
+        return current_app.config.get(name, default)
+    return getattr(Config, name, default)
+
+
+def bind_app_context(fn):
+    """Wrap fn so it runs inside the current app's context when called from a worker thread"""
+    if not has_app_context():
+        return fn
+    app = current_app._get_current_object()
+
+    def wrapper(*args, **kwargs):
+        with app.app_context():
+            return fn(*args, **kwargs)
+    return wrapper
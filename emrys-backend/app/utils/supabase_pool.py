@@ -0,0 +1,163 @@
+"""
+Supabase client pool for EMRYS.
+One thread-safe client is created per process and shared by every request, so requests reuse
+warm keep-alive (HTTP/2) connections instead of rebuilding a client with create_client.
+Concurrency is bounded per database round-trip, not per request: a slot is held only while
+an HTTP request to Supabase is in flight, so a chat turn waiting 45s on the LLM holds nothing.
+"""
+
+import threading
+import time
+from dataclasses import fields
+
+import httpx
+from flask import current_app
+from supabase import ClientOptions, create_client
+
+
+class PoolExhausted(Exception):
+    """No Supabase request slot became free within SUPABASE_POOL_TIMEOUT"""
+
+
+class _SlotStream(httpx.SyncByteStream):
+    """Response body that gives its request slot back once it has been read and closed"""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release()
+
+
+class _SlotTransport(httpx.HTTPTransport):
+    """HTTP transport that takes a pool slot for each request until its response is closed"""
+
+    def __init__(self, pool, **kwargs):
+        super().__init__(**kwargs)
+        self._owner = pool
+
+    def handle_request(self, request):
+        self._owner.acquire()
+        try:
+            response = super().handle_request(request)
+        except Exception:
+            self._owner.release()
+            raise
+        response.stream = _SlotStream(response.stream, self._owner.release)
+        return response
+
+
+class SupabasePool:
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._client = None
+        self._slots = None
+        self._in_use = 0
+        self._waiting = 0
+        self._peak_in_use = 0
+        self._exhausted = 0
+        self._acquired = 0
+        self._wait_seconds = 0.0
+        self._limited = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.url = app.config.get('SUPABASE_URL')
+        self.key = app.config.get('SUPABASE_KEY')
+        self.size = app.config.get('SUPABASE_POOL_SIZE', 10)
+        self.acquire_timeout = app.config.get('SUPABASE_POOL_TIMEOUT', 10)
+        self.max_connections = app.config.get('SUPABASE_MAX_CONNECTIONS', 20)
+        self.request_timeout = app.config.get('SUPABASE_REQUEST_TIMEOUT', 30)
+        self._slots = threading.BoundedSemaphore(self.size)
+        app.extensions['supabase_pool'] = self
+
+    def _create_client(self):
+        option_kwargs = {'postgrest_client_timeout': self.request_timeout}
+        # Older supabase-py releases don't accept a custom httpx client (no per-request slots then)
+        if 'httpx_client' in {f.name for f in fields(ClientOptions)}:
+            option_kwargs['httpx_client'] = httpx.Client(
+                transport=_SlotTransport(
+                    self,
+                    http2=True,
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_connections,
+                        keepalive_expiry=60
+                    )
+                ),
+                timeout=self.request_timeout,
+                follow_redirects=True
+            )
+            self._limited = True
+        client = create_client(self.url, self.key, options=ClientOptions(**option_kwargs))
+        client.postgrest  # built lazily by supabase-py; build it once here, not racing on first use
+        return client
+
+    def client(self):
+        """The process-wide client, created on first use"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client()
+        return self._client
+
+    def acquire(self):
+        """Take a request slot (called by the transport for every Supabase HTTP request)"""
+        if self._slots.acquire(blocking=False):
+            waited = 0.0
+        else:
+            with self._lock:
+                self._waiting += 1
+            started = time.monotonic()
+            acquired = self._slots.acquire(timeout=self.acquire_timeout)
+            waited = time.monotonic() - started
+            with self._lock:
+                self._waiting -= 1
+                if not acquired:
+                    self._exhausted += 1
+            if not acquired:
+                raise PoolExhausted(f"All {self.size} Supabase request slots busy for {self.acquire_timeout}s")
+
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+            self._wait_seconds += waited
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+
+    def release(self):
+        with self._lock:
+            self._in_use -= 1
+        self._slots.release()
+
+    def health(self):
+        with self._lock:
+            saturation = self._in_use / self.size if self.size else 1.0
+            return {
+                'size': self.size,
+                'created': int(self._client is not None),
+                'limited': self._limited,
+                'in_use': self._in_use,
+                'idle': self.size - self._in_use,
+                'waiting': self._waiting,
+                'peak_in_use': self._peak_in_use,
+                'acquired_total': self._acquired,
+                'exhausted_total': self._exhausted,
+                'avg_wait_ms': round(self._wait_seconds * 1000 / self._acquired, 2) if self._acquired else 0.0,
+                'saturation': round(saturation, 3),
+                'saturated': self._in_use >= self.size and self._waiting > 0
+            }
+
+
+def get_supabase():
+    """The shared Supabase client; request slots are only held while a query is in flight"""
+    return current_app.extensions['supabase_pool'].client()
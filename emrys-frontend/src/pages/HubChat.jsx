@@ -102,6 +102,17 @@ export default function HubChat({ user }) {
             const response = await axios.post(`${BACKEND_URL}/api/chat/group/send`, requestData)
             setIsRetrieving(false)
 
+            if (response.data.safety_blocked) {
+                setMessages(prev => [...prev, {
+                    id: Date.now() + 99,
+                    sender_type: 'system',
+                    content: response.data.error,
+                    safety_blocked: true,
+                    created_at: new Date().toISOString()
+                }])
+                return
+            }
+
             if (response.data.error) {
                 throw new Error(response.data.error)
             }
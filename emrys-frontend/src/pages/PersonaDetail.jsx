@@ -27,7 +27,7 @@ export default function PersonaDetail({ user }) {
             const personaData = await personaHelpers.getById(personaId)
             setPersona(personaData)
 
-            const knowledgeData = await knowledgeHelpers.getAll(personaId)
+            const knowledgeData = await knowledgeHelpers.getAll(personaId, user.id)
             setKnowledge(knowledgeData)
         } catch (error) {
             console.error('Error loading persona:', error)
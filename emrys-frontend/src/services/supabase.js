@@ -3,6 +3,22 @@ import { createClient } from '@supabase/supabase-js'
 // These will be replaced with your actual Supabase credentials
 const supabaseUrl = import.meta.env.VITE_SUPABASE_URL
 const supabaseAnonKey = import.meta.env.VITE_SUPABASE_ANON_KEY
+const BACKEND_URL = import.meta.env.VITE_BACKEND_URL || 'http://localhost:5000'
+
+// Tell the backend to drop its cached copy of a persona (fire-and-forget)
+const invalidatePersonaCache = (personaId) => {
+    fetch(`${BACKEND_URL}/api/persona/${personaId}/invalidate`, { method: 'POST' }).catch(() => { })
+}
+
+// Same for a hub, whenever it or its members change (fire-and-forget)
+const invalidateGroupCache = (groupId) => {
+    fetch(`${BACKEND_URL}/api/chat/group/${groupId}/invalidate`, { method: 'POST' }).catch(() => { })
+}
+
+// Drop the backend's pending messages, summary and mood of a conversation that is being wiped
+const invalidateConversationCache = (conversationId) => {
+    return fetch(`${BACKEND_URL}/api/chat/history/${conversationId}/invalidate`, { method: 'POST' }).catch(() => { })
+}
 
 // Debug: Log what we're using (remove in production)
 console.log('🔍 Supabase URL:', supabaseUrl)
@@ -129,6 +145,7 @@ export const personaHelpers = {
             .single()
 
         if (error) throw error
+        invalidatePersonaCache(personaId)
         return data
     },
 
@@ -139,6 +156,7 @@ export const personaHelpers = {
             .eq('id', personaId)
 
         if (error) throw error
+        invalidatePersonaCache(personaId)
     },
 
     incrementUseCount: async (personaId) => {
@@ -236,6 +254,7 @@ export const groupHelpers = {
             .single()
 
         if (error) throw error
+        invalidateGroupCache(groupId)
         return data
     },
 
@@ -246,6 +265,7 @@ export const groupHelpers = {
             .eq('id', groupId)
 
         if (error) throw error
+        invalidateGroupCache(groupId)
     },
 
     addMembers: async (groupId, personaIds) => {
@@ -259,6 +279,7 @@ export const groupHelpers = {
             .insert(members)
 
         if (error) throw error
+        invalidateGroupCache(groupId)
     },
 
     removeMember: async (groupId, personaId) => {
@@ -269,6 +290,7 @@ export const groupHelpers = {
             .eq('persona_id', personaId)
 
         if (error) throw error
+        invalidateGroupCache(groupId)
     }
 }
 
@@ -348,6 +370,8 @@ export const chatHelpers = {
     },
 
     clearHistory: async (conversationId) => {
+        // Awaited first, so messages still queued on the backend can't be inserted after the wipe
+        await invalidateConversationCache(conversationId)
         const { error } = await supabase
             .from('messages')
             .delete()
@@ -360,12 +384,13 @@ export const chatHelpers = {
 
 // Knowledge helpers
 export const knowledgeHelpers = {
-    add: async (personaId, category, key, value, source = 'conversation') => {
+    add: async (personaId, userId, category, key, value, source = 'conversation') => {
         const { data, error } = await supabase
             .from('persona_knowledge')
             .insert([
                 {
                     persona_id: personaId,
+                    user_id: userId,
                     category,
                     key,
                     value,
@@ -379,11 +404,13 @@ export const knowledgeHelpers = {
         return data
     },
 
-    getAll: async (personaId) => {
+    // Facts are about the user who told them, so only that user's are listed
+    getAll: async (personaId, userId) => {
         const { data, error } = await supabase
             .from('persona_knowledge')
             .select('*')
             .eq('persona_id', personaId)
+            .eq('user_id', userId)
             .order('learned_at', { ascending: false })
 
         if (error) throw error
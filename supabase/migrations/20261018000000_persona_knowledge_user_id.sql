@@ -0,0 +1,13 @@
+-- Learned facts are about the user who revealed them, so they are scoped per (persona, user).
+alter table public.persona_knowledge
+    add column if not exists user_id uuid;
+
+-- Facts learned before this column existed: attribute them to the persona's owner
+update public.persona_knowledge k
+set user_id = p.user_id
+from public.personas p
+where p.id = k.persona_id
+  and k.user_id is null;
+
+create index if not exists persona_knowledge_persona_user_idx
+    on public.persona_knowledge (persona_id, user_id, learned_at desc);
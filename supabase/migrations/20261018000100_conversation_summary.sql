@@ -0,0 +1,6 @@
+-- Rolling summary of the turns that have scrolled out of a conversation's history window.
+-- summary_turns only grows, so the backend also uses it as the row's version for updates.
+alter table public.conversations
+    add column if not exists summary text,
+    add column if not exists summary_covered_until timestamptz,
+    add column if not exists summary_turns integer not null default 0;
@@ -0,0 +1,5 @@
+-- Decayed mood scores of a conversation (and of each persona within a hub).
+-- mood_messages counts the messages folded in; the backend also uses it as the row's version.
+alter table public.conversations
+    add column if not exists mood_state jsonb,
+    add column if not exists mood_messages integer not null default 0;